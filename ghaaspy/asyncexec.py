@@ -0,0 +1,151 @@
+"""Asyncio execution of generated sql batches across many schemas at once, on an asyncpg connection pool.
+
+asyncpg is an optional dependency (pip install ghaaspy[async]), it is only imported when batches are run.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+BATCH_STATUSES = ('ok', 'failed', 'cancelled')
+
+
+@dataclass
+class SqlBatch:
+    """Statements executed together in one transaction"""
+    schema: str
+    name: str
+    statements: list
+
+
+@dataclass
+class BatchResult:
+    """Outcome of one SqlBatch, status is one of BATCH_STATUSES"""
+    schema: str
+    name: str
+    status: str
+    seconds: float = 0.0
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+
+def pivot_batches(groups):
+    """Batches creating the pivot table then the yearly views of each pivot group
+
+    Args:
+        groups (list): pivot groups from pivot.build_pivot_groups
+
+    Returns:
+        list: SqlBatch per pivot group
+    """
+    return [SqlBatch(schema=g['schema'], name=g['pivot_table'], statements=[g['table_sql'], g['view_sql']])
+            for g in groups]
+
+
+def print_progress(result, done, total):
+    """Default progress callback, one line per finished batch"""
+    print('[{}/{}] "{}"."{}" {} {:.1f}s'.format(done, total, result.schema, result.name, result.status, result.seconds))
+
+
+async def _run_schema(pool, semaphore, batches, results, progress, total, stop, stop_on_error=False):
+    """Run the batches of one schema one after another, in order. A failed batch doesn't stop the next ones unless
+    stop_on_error, statements depending on each other belong in the same batch."""
+    for batch in batches:
+        if stop.is_set():
+            result = BatchResult(schema=batch.schema, name=batch.name, status='cancelled')
+        else:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with pool.acquire() as conn:
+                        async with conn.transaction():
+                            for statement in batch.statements:
+                                await conn.execute(statement)
+                    result = BatchResult(schema=batch.schema, name=batch.name, status='ok',
+                                         seconds=time.perf_counter() - start)
+                except asyncio.CancelledError:
+                    results[id(batch)] = BatchResult(schema=batch.schema, name=batch.name, status='cancelled',
+                                                     seconds=time.perf_counter() - start)
+                    raise
+                except Exception as err:
+                    # asyncpg raises PostgresError subclasses for sql errors, but also connection errors
+                    result = BatchResult(schema=batch.schema, name=batch.name, status='failed',
+                                         seconds=time.perf_counter() - start, error=str(err))
+                    if stop_on_error:
+                        stop.set()
+
+        results[id(batch)] = result
+        if progress is not None:
+            progress(result, len(results), total)
+
+
+async def _cancel_on(stop, tasks):
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+
+
+async def run_batches_async(db, batches, concurrency=4, progress=print_progress, stop=None, stop_on_error=False):
+    """Run sql batches concurrently across schemas, in order within each schema.
+
+    At most concurrency batches run at once, each on its own pooled connection and transaction, so a failed
+    batch is rolled back. Session settings (search_path..) are reset when connections go back to the pool.
+    Setting stop cancels running statements server side and reports every unfinished batch as cancelled.
+    Cancelling the task itself does the same but raises CancelledError.
+
+    Args:
+        db (PostgresDB): database to run on, only its connection parameters are used
+        batches (list): SqlBatch to run
+        concurrency (int, optional): maximum number of batches running at once. Defaults to 4.
+        progress (callable, optional): called as progress(BatchResult, done, total) after each batch,
+            None for silence. Defaults to print_progress.
+        stop (asyncio.Event, optional): event cancelling the run when set. Defaults to None.
+        stop_on_error (bool, optional): set stop as soon as a batch fails. Defaults to False.
+
+    Returns:
+        list: BatchResult of each batch, in the order of batches
+    """
+    import asyncpg
+
+    by_schema = OrderedDict()
+    for batch in batches:
+        by_schema.setdefault(batch.schema, []).append(batch)
+
+    stop = stop if stop is not None else asyncio.Event()
+    results = {}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    pool = await asyncpg.create_pool(host=db.host, port=db.port, user=db.user, password=db.password,
+                                     database=db.database, min_size=1, max_size=max(1, concurrency))
+    tasks = [asyncio.ensure_future(_run_schema(pool, semaphore, schema_batches, results, progress, len(batches), stop,
+                                               stop_on_error=stop_on_error))
+             for schema_batches in by_schema.values()]
+    watcher = asyncio.ensure_future(_cancel_on(stop, tasks))
+    try:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    except asyncio.CancelledError:
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        watcher.cancel()
+        await pool.close()
+        # batches which never got to run
+        for batch in batches:
+            if id(batch) not in results:
+                results[id(batch)] = BatchResult(schema=batch.schema, name=batch.name, status='cancelled')
+
+    return [results[id(batch)] for batch in batches]
+
+
+def run_batches(db, batches, concurrency=4, progress=print_progress, stop_on_error=False):
+    """Blocking wrapper of run_batches_async. Ctrl-C cancels the running statements.
+
+    Returns:
+        list: BatchResult of each batch, in the order of batches
+    """
+    return asyncio.run(run_batches_async(db, batches, concurrency=concurrency, progress=progress,
+                                         stop_on_error=stop_on_error))
@@ -1,8 +1,15 @@
 import argparse
+import json
+import sys
 from pathlib import Path
 
-from ..gpkg import import_gpkg
-from ..util import sanitize_path,list_to_file
+from psycopg2 import Error as PostgresError
+
+from ..gpkg import import_gpkgs, collect_import_tasks, find_gpkgs, IMPORT_ENGINES
+from ..pgcopy import PARTITION_INDEXES
+from ..manifest import MANIFEST_TABLE
+from ..plan import THROUGHPUT_FILE, TEMPORAL_CLASSES, build_import_plan, load_throughput, plan_summary
+from ..util import list_to_file, sanitize_path
 from ..postgres import PostgresDB
 
 def main():
@@ -14,39 +21,92 @@ def main():
 
     parser.add_argument('--pgpass_file', type=Path, help="location of .pgpass. Defaults to ~/.pgpass", required=False)
 
-    parser.add_argument('gpkg', type=Path,
-                        help="GHAAS geopackage file or filepath")
+    parser.add_argument('gpkg', nargs='+',
+                        help="GHAAS geopackage files, directories to search for geopackages or glob patterns")
     parser.add_argument('-t', '--tablenames', type=Path, help="file to write created table names to", required=False)
-    parser.add_argument('--update', action='store_true', help="update table (truncate , then append) instead of overwriting existing tables")
-    parser.add_argument('--include_geography', action='store_true', help="if importing a modeloutput geopackage, import embedded geography tables as well")
+    load_group = parser.add_argument_group('load mode', description="without a load mode existing \
+        tables are overwritten, dropping the views depending on them. Geometry tiers of geography tables \
+        (postgis_pivot --geometry_tiers) are prepared again after the overwrite, unserved in between; reload tiered \
+        geography with --swap or --update to keep them, and the yearly views, in place")
+    load_mode = load_group.add_mutually_exclusive_group()
+    load_mode.add_argument('--update', action='store_true', help="update table (truncate , then append) instead of overwriting existing tables")
+    load_mode.add_argument('--delta', action='store_true', help="merge only new or changed years/months/days into existing model tables (INSERT ... ON CONFLICT DO UPDATE), other tables are updated")
+    load_mode.add_argument('--swap', action='store_true', help="load into unlogged staging tables, then index, analyze and atomically swap them in place of existing tables")
+    parser.add_argument('--swap_unlogged', action='store_true', help="with --swap, leave swapped tables UNLOGGED instead \
+                        of rewriting them into the WAL with SET LOGGED: faster, but emptied after a crash and not replicated")
+    parser.add_argument('--include_geography', action='store_true', help="if importing a modeloutput geopackage, import embedded geography tables as well. Copies identical to the loaded table are skipped, copies that differ are not imported and fail the run")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of tables to import concurrently, default=1")
+    parser.add_argument('--engine', choices=sorted(IMPORT_ENGINES), default='ogr2ogr',
+                        help="ogr2ogr: one ogr2ogr process per table, vectortranslate: in-process gdal.VectorTranslate, \
+                        copy: binary COPY of attribute-only tables (ogr2ogr for tables with geometry). default=ogr2ogr")
+    parser.add_argument('--incremental', action='store_true', help="skip tables unchanged since the last import, tracked in a manifest table")
+    parser.add_argument('--manifest_table', default=MANIFEST_TABLE, help="schema.table of import manifest, default={}".format(MANIFEST_TABLE))
+    parser.add_argument('--exclude_temporal', nargs='+', choices=TEMPORAL_CLASSES, default=[],
+                        help="leave out annual/monthly/daily tables")
+    parser.add_argument('--plan', action='store_true', help="print import plan (json) with size and load time estimates and exit without importing")
+    parser.add_argument('--throughput_file', type=Path, default=THROUGHPUT_FILE,
+                        help="throughput measured in earlier runs, used for load time estimates. default={}".format(THROUGHPUT_FILE))
+    parser.add_argument('--report', type=Path, help="write a json report of seconds per table and load stage \
+                        (create, copy, primary key, swap..) against the plan estimates to this file")
+    parser.add_argument('--partition_years', type=int, help="with --engine copy, create monthly and daily tables \
+                        range partitioned on year, this many years per partition")
+    parser.add_argument('--partition_index', choices=PARTITION_INDEXES, default='btree',
+                        help="index on (sampleid, year) of partitioned tables, brin is much smaller on large tables loaded in year order. default=btree")
     args = parser.parse_args()
 
+    if args.swap_unlogged and not args.swap:
+        parser.error("--swap_unlogged needs --swap")
+
+    if args.partition_years is not None and (args.engine != 'copy' or args.partition_years < 1):
+        parser.error("--partition_years needs --engine copy and at least 1 year per partition")
+
+    gpkgs = find_gpkgs(args.gpkg)
+    if not gpkgs:
+        parser.error("no geopackages found in {}".format(' '.join(args.gpkg)))
+
+    if args.plan:
+        tasks, gpkg_metas = collect_import_tasks(gpkgs, args.include_geography, args.exclude_temporal)
+        plan = build_import_plan(tasks, engine=args.engine, throughput=load_throughput(args.throughput_file), exact=True)
+        json.dump({'summary': plan_summary(plan, jobs=args.jobs), 'tables': plan}, sys.stdout, indent=2)
+        print()
+        for gpkg_meta in gpkg_metas.values():
+            gpkg_meta['catalog'].close()
+        return
+
     if args.pg_con:
-        db = PostgresDB.from_gdal_string(args.pg_con)
+        db = PostgresDB.from_gdal_string(args.pg_con, verify=False)
     elif args.pgpass_id:
         if args.pgpass_file:
             pgpass = args.pgpass_file.resolve(strict=True)
-            db = PostgresDB.from_pgpass(args.pgpass_id,pgpass=pgpass)
+            db = PostgresDB.from_pgpass(args.pgpass_id,pgpass=pgpass, verify=False)
         else:
-            db = PostgresDB.from_pgpass(args.pgpass_id)
+            db = PostgresDB.from_pgpass(args.pgpass_id, verify=False)
+
+    try:
+        db.verify()
+    except PostgresError as err:
+        sys.exit("can't connect to postgres: {}".format(err))
+    finally:
+        db.close()
 
     pg_con = db.get_gdal_string()
-    gpkg = sanitize_path(args.gpkg)
 
-    if args.update:
-        if args.include_geography:
-            postgres_tables, gpkg_meta = import_gpkg(pg_con, gpkg, update=True, include_embedded_geography_tables=True)
-        else:
-            postgres_tables, gpkg_meta = import_gpkg(pg_con, gpkg, update=True, include_embedded_geography_tables=False)
-    else:
-        if args.include_geography:
-            postgres_tables, gpkg_meta = import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=True)
-        else: 
-            postgres_tables, gpkg_meta = import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=False)
+    results, gpkg_metas = import_gpkgs(pg_con, gpkgs, update=args.update,
+        include_embedded_geography_tables=args.include_geography, jobs=args.jobs, engine=args.engine,
+        incremental=args.incremental, manifest_table=args.manifest_table,
+        exclude_temporal=args.exclude_temporal, throughput_file=args.throughput_file, swap=args.swap,
+        delta=args.delta, report_file=sanitize_path(args.report) if args.report else None,
+        partition_years=args.partition_years, partition_index=args.partition_index, swap_logged=not args.swap_unlogged)
+
+    failed = [r for r in results if not r.ok]
+    for r in failed:
+        print("{} failed importing {} from {}:\n{}".format(r.pg_table, r.gpkg_table, r.gpkg, r.stderr.strip()), file=sys.stderr)
 
     if args.tablenames:
-        list_to_file(postgres_tables, args.tablenames)
+        list_to_file([r.pg_table for r in results if r.ok], args.tablenames)
 
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
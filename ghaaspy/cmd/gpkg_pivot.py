@@ -0,0 +1,99 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from psycopg2 import Error as PostgresError
+
+from ..geomtier import geometry_tier_targets, prepare_geometry_tiers
+from ..gpkg import find_gpkgs
+from ..nppivot import NUMPY_VIEW_MODES, gpkg_pivot_groups, execute_numpy_pivots
+from ..pivot import pivot_report
+from ..sqlgen import PIVOT_LAYOUTS
+from ..postgres import PostgresDB
+from ..util import sanitize_path, list_to_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Build pivot tables and yearly views of model output geopackages \
+                                     with numpy, without importing their annual/monthly tables. Requires numpy")
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--pg_con', help="postgres gdal driver connection string, \"dbname='databasename' host='addr' port='5432' user='x' password='y'\"")
+    group.add_argument('--pgpass_id', help="identifying substring of of .pgpass entry. Could be a database name, host:port, etc.")
+    parser.add_argument('--pgpass_file', type=Path, help="location of .pgpass. Defaults to ~/.pgpass", required=False)
+
+    parser.add_argument('gpkg', nargs='+',
+                        help="GHAAS model output geopackage files, directories to search for geopackages or glob patterns")
+    parser.add_argument('-p', '--pivot_names', type=Path, help="file to write created pivot table names to", required=False)
+    parser.add_argument('-v', '--view_names', type=Path, help="file to write created views to", required=False)
+    parser.add_argument('--start_year', type=int, help="starting year of pivot tables, default=first year of each group's data", required=False)
+    parser.add_argument('--end_year', type=int, help="end year of pivot tables, default=last year of each group's data", required=False)
+    parser.add_argument('--layout', choices=PIVOT_LAYOUTS, default='crosstab', help="pivot table layout: crosstab creates \
+                        a column per year, array one column holding an array indexed by year. default=crosstab")
+    parser.add_argument('--views', choices=NUMPY_VIEW_MODES, default='yearly', help="yearly creates a view per year, \
+                        materialized a materialized view per year indexed on sampleid and geometry. default=yearly")
+    parser.add_argument('--geometry_tiers', action='store_true', help="prepare simplified geometry tiers of basin, \
+                        subbasin, country and state geographies and add them to the yearly views, see postgis_pivot. Requires PostGIS")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of pivot groups to build concurrently, each \
+                        holding its annual/monthly data in memory. default=1")
+    parser.add_argument('--report', type=Path, help="write a json report of seconds per pivot table and stage \
+                        (read, create, copy, primary key, views) to this file")
+
+    args = parser.parse_args()
+
+    if bool(args.start_year) != bool(args.end_year):
+        parser.error("must provide --start_year and --end_year")
+
+    gpkgs = find_gpkgs(args.gpkg)
+    if not gpkgs:
+        parser.error("no geopackages found in {}".format(' '.join(args.gpkg)))
+
+    groups = gpkg_pivot_groups(gpkgs, layout=args.layout, year_start=args.start_year, year_end=args.end_year)
+
+    if args.pg_con:
+        db = PostgresDB.from_gdal_string(args.pg_con, verify=False, maxconn=max(1, args.jobs))
+    elif args.pgpass_file:
+        db = PostgresDB.from_pgpass(args.pgpass_id, pgpass=args.pgpass_file.resolve(strict=True), verify=False,
+                                    maxconn=max(1, args.jobs))
+    else:
+        db = PostgresDB.from_pgpass(args.pgpass_id, verify=False, maxconn=max(1, args.jobs))
+
+    try:
+        db.verify()
+    except PostgresError as err:
+        db.close()
+        sys.exit("can't connect to postgres: {}".format(err))
+
+    try:
+        if args.geometry_tiers:
+            try:
+                prepare_geometry_tiers(db, geometry_tier_targets(groups))
+            except PostgresError as err:
+                sys.exit("preparing geometry tiers failed: {}".format(err))
+        try:
+            results = execute_numpy_pivots(db, groups, views=args.views, geometry_tiers=args.geometry_tiers, jobs=args.jobs)
+        except PostgresError as err:
+            sys.exit("numpy pivots failed: {}".format(err))
+    finally:
+        db.close()
+
+    if args.report:
+        with open(sanitize_path(args.report), 'w') as f:
+            json.dump(pivot_report(results), f, indent=2)
+
+    for g, r in zip(groups, results):
+        if not r.ok:
+            print('"{}"."{}" failed:\n{}'.format(g['schema'], g['pivot_table'], r.error), file=sys.stderr)
+
+    created = [g for g, r in zip(groups, results) if r.ok]
+    if args.pivot_names:
+        list_to_file([g['pivot_table'] for g in created], args.pivot_names)
+
+    if args.view_names:
+        list_to_file([v for g in created for v in g['view_names']], args.view_names)
+
+    if len(created) < len(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
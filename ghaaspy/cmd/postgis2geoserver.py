@@ -1,14 +1,17 @@
 
 import argparse
+import json
+import sys
 from pathlib import Path
 
 from ..util import sanitize_path, file_to_list
-from ..geoserver import publish_geoserver_sqlview_batch, connect_geoserver
+from ..geoserver import GeoserverSession, publish_geoserver_sqlviews, publish_report
 
 def main():
     parser = argparse.ArgumentParser(description="Publish postgis tables/views as 'sql views' on a \
         geoserver instance using a simple 'SELECT * FROM _'. You will need to first create a geoserver store \
-        for the postgis database.schema you are referencing")
+        for the postgis database.schema you are referencing. Long format views from postgis_pivot --views long are \
+        published as their <pivot>_by_year(%%year%%) function, the year given by &viewparams=year:1990")
 
     parser.add_argument('viewnames_file', type=Path,
                         help="file containing list of existing postgres views/table names")
@@ -19,19 +22,31 @@ def main():
     parser.add_argument('geoserver_store', help='geoserver postgis store where to connect sql views with')
     parser.add_argument('geoserver_workspace', help='existing geoserver workspace to publish to')
     parser.add_argument('--geography', help='indicate tables are "geography tables" and not model outputs', action='store_true')
-    
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="number of layers to publish concurrently, default=4")
+    parser.add_argument('--retries', type=int, default=3, help="retries of a layer after a connection error, timeout \
+                        or 429/502/503/504 response, with exponentially growing waits, default=3")
+    parser.add_argument('--report', type=Path, help="write a json report of status, attempts and seconds per layer to this file")
+
     args = parser.parse_args()
-    
-    geo = connect_geoserver(args.geoserver_url, user=args.geoserver_user, password=args.geoserver_password)
 
     views = file_to_list(args.viewnames_file)
 
-    if args.geography:
-        publish_geoserver_sqlview_batch(geo, views, args.geoserver_store, args.geoserver_workspace, geography=True)
-    else:
-        publish_geoserver_sqlview_batch(geo, views, args.geoserver_store, args.geoserver_workspace, geography=False)
+    with GeoserverSession(args.geoserver_url, args.geoserver_user, args.geoserver_password,
+                          pool_size=max(1, args.jobs), retries=args.retries) as session:
+        results = publish_geoserver_sqlviews(session, views, args.geoserver_store, args.geoserver_workspace,
+                                             geography=args.geography, jobs=args.jobs)
+
+    if args.report:
+        with open(sanitize_path(args.report), 'w') as f:
+            json.dump(publish_report(results), f, indent=2)
+
+    failed = [r for r in results if not r.ok]
+    for r in failed:
+        print('{} failed: {}'.format(r.layer, r.error), file=sys.stderr)
+    if failed:
+        sys.exit("{} of {} layers failed to publish".format(len(failed), len(results)))
 
 
 if __name__ == '__main__':
     main()
-    
+
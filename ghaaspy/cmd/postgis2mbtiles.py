@@ -0,0 +1,62 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from psycopg2 import Error as PostgresError
+
+from ..postgres import PostgresDB
+from ..util import sanitize_path, split_pg_tablename
+from ..vectortiles import build_pivot_mbtiles
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the years of a pivot table into MBTiles vector tile files, \
+                                     one per year named after its yearly view, for static tile serving. Requires PostGIS 3")
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--pg_con', help="postgres gdal driver connection string, \"dbname='databasename' host='addr' port='5432' user='x' password='y'\"")
+    group.add_argument('--pgpass_id', help="identifying substring of of .pgpass entry. Could be a database name, host:port, etc.")
+    parser.add_argument('--pgpass_file', type=Path, help="location of .pgpass. Defaults to ~/.pgpass", required=False)
+
+    parser.add_argument('pivot_table', help="pivot table in schema.table form ie brazil.\"runoff_basin_terra+wbm04_01min_pivot\"")
+    parser.add_argument('output_dir', type=Path, help="directory to write the MBTiles files to")
+    parser.add_argument('--start_year', type=int, help="first year to render, default=first year of the pivot table")
+    parser.add_argument('--end_year', type=int, help="last year to render, default=last year of the pivot table. \
+                        Give the same year as --start_year to regenerate a single updated year, other files are left as they are")
+    parser.add_argument('--min_zoom', type=int, default=0, help="first zoom level, default=0")
+    parser.add_argument('--max_zoom', type=int, default=8, help="last zoom level, default=8")
+    parser.add_argument('--geometry_tiers', action='store_true', help="draw basins, subbasins, countries and states with \
+                        the simplified geometry tier of each zoom level, prepared by postgis_pivot --geometry_tiers")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of tile batches to render concurrently, default=1")
+    parser.add_argument('--report', type=Path, help="write a json report of tiles, bytes and seconds per year to this file")
+
+    args = parser.parse_args()
+
+    if not 0 <= args.min_zoom <= args.max_zoom <= 22:
+        parser.error("zoom levels must satisfy 0 <= --min_zoom <= --max_zoom <= 22")
+
+    schema, pivot_table = split_pg_tablename(args.pivot_table)
+
+    if args.pg_con:
+        db = PostgresDB.from_gdal_string(args.pg_con, verify=False, maxconn=max(1, args.jobs))
+    elif args.pgpass_file:
+        db = PostgresDB.from_pgpass(args.pgpass_id, pgpass=args.pgpass_file.resolve(strict=True), verify=False,
+                                    maxconn=max(1, args.jobs))
+    else:
+        db = PostgresDB.from_pgpass(args.pgpass_id, verify=False, maxconn=max(1, args.jobs))
+
+    try:
+        results = build_pivot_mbtiles(db, schema, pivot_table, sanitize_path(args.output_dir),
+                                      year_start=args.start_year, year_end=args.end_year, min_zoom=args.min_zoom,
+                                      max_zoom=args.max_zoom, jobs=args.jobs, geometry_tiers=args.geometry_tiers)
+    except (PostgresError, ValueError) as err:
+        sys.exit("rendering tiles of {} failed: {}".format(args.pivot_table, err))
+    finally:
+        db.close()
+
+    if args.report:
+        with open(sanitize_path(args.report), 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
-
 import argparse
+import json
+import sys
 from pathlib import Path
 
-from ..pivot import create_pivot_annual_monthly_tables
+from psycopg2 import Error as PostgresError
+
+from ..pivot import create_pivot_annual_monthly_tables, build_pivot_groups, execute_pivot_groups, pivot_report, \
+    benchmark_pivot_layouts, detect_year_spans
+from ..manifest import MANIFEST_TABLE
+from ..geomtier import geometry_tier_targets, prepare_geometry_tiers
+from ..sqlgen import PIVOT_LAYOUTS, VIEW_MODES, refresh_materialized_views
+from ..asyncexec import run_batches, pivot_batches
+from ..postgres import PostgresDB
 from ..util import sanitize_path, list_to_file
 
 def main():
@@ -10,35 +19,159 @@ def main():
 
     parser.add_argument('tablenames_file', type=Path,
                         help="file containing list of imported geopackage postgres tables")
-    parser.add_argument('output_file', type=Path,
-                        help="file to output sql to")
+    parser.add_argument('output_file', type=Path, nargs='?',
+                        help="file to output sql to, required unless --execute")
     parser.add_argument('-p', '--pivot_names', type=Path, help="file to write created pivot table names to", required=False)
     parser.add_argument('-v', '--view_names', type=Path, help="file to write created views to", required=False)
     parser.add_argument('--start_year', type=int, help="starting year of data, default=1958",required=False)
     parser.add_argument('--end_year', type=int, help="end year of data, default=2019", required=False)
+    parser.add_argument('--detect_years', nargs='?', const='query', choices=('query', 'manifest'), help="size each pivot \
+                        group to the years its annual/monthly tables hold, found with min/max queries (query, the default) \
+                        or from the import manifest of incremental imports, falling back on queries (manifest). \
+                        --start_year/--end_year then only apply to groups without data. Requires --pg_con or --pgpass_id")
+    parser.add_argument('--manifest_table', default=MANIFEST_TABLE, help="schema.table of import manifest for \
+                        --detect_years manifest, default={}".format(MANIFEST_TABLE))
+
+    parser.add_argument('--layout', choices=PIVOT_LAYOUTS, default='crosstab', help="pivot table layout: crosstab creates \
+                        a column per year (needs tablefunc), array one column holding an array indexed by year. default=crosstab")
+    parser.add_argument('--views', choices=VIEW_MODES, default='yearly', help="yearly creates a view per year, materialized \
+                        a materialized view per year indexed on sampleid and geometry, long one long format view (sampleid, year, month, values) and a <pivot>_by_year(year) function for GeoServer \
+                        SQL views with viewparams, reading the annual and monthly tables (indexed on year) without building a pivot table. default=yearly")
+    parser.add_argument('--daily', action='store_true', help="also pivot daily tables into <group>_daily_pivot tables, \
+                        a real[] of the days of each sampleid and year, built one year at a time, with <group>_daily_pivot_on(date) \
+                        and <group>_daily_pivot_series(sampleid, start, end) accessor functions")
+    parser.add_argument('--geometry_tiers', action='store_true', help="for basin, subbasin, country and state layers, \
+                        prepare <geography>_tiers (geometry simplified for a few scale ranges, GiST indexed) and \
+                        <geography>_subdivided materialized views, and add the tier geometry columns to the yearly \
+                        views for styles to draw the tier of the map scale. Requires PostGIS, not with --views long")
+    parser.add_argument('--refresh_script', type=Path, help="with --views materialized, file to write the sql refreshing \
+                        the created materialized views concurrently (without blocking readers) to")
+    parser.add_argument('--execute', action='store_true', help="run the sql of each pivot group directly against the database, \
+                        each group in its own transaction. Requires --pg_con or --pgpass_id")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--pg_con', help="postgres gdal driver connection string, \"dbname='databasename' host='addr' port='5432' user='x' password='y'\"")
+    group.add_argument('--pgpass_id', help="identifying substring of of .pgpass entry. Could be a database name, host:port, etc.")
+    parser.add_argument('--pgpass_file', type=Path, help="location of .pgpass. Defaults to ~/.pgpass", required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of pivot groups to execute concurrently, default=1")
+    parser.add_argument('--asyncio', action='store_true', help="with --execute, run on asyncio/asyncpg: schemas (regions) \
+                        run concurrently, groups of a schema one after another. Requires asyncpg")
+    parser.add_argument('--report', type=Path, help="with --execute, time every statement of the pivot tables by stage \
+                        and write a json report keyed by schema, pivot table and stage to this file")
+    parser.add_argument('--explain', action='store_true', help="with --report, capture EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) \
+                        of the aggregate/join and crosstab statements in the report")
+    parser.add_argument('--benchmark', action='store_true', help="compare the pivot layouts on build time, table size \
+                        and view scan time in transactions that are rolled back, print json and exit. Requires --pg_con or --pgpass_id")
+    parser.add_argument('--work_mem', help="with --execute, work_mem for each pivot group transaction ie 256MB")
 
     args = parser.parse_args()
 
+    if not (args.execute or args.benchmark) and args.output_file is None:
+        parser.error("output_file is required unless --execute or --benchmark")
+    if args.asyncio and not args.execute:
+        parser.error("--asyncio requires --execute")
+    if (args.report or args.work_mem) and not args.execute:
+        parser.error("--report and --work_mem require --execute")
+    if args.asyncio and (args.report or args.work_mem):
+        parser.error("--report and --work_mem can't be combined with --asyncio")
+    if args.explain and not args.report:
+        parser.error("--explain requires --report")
+    if (args.execute or args.benchmark or args.detect_years) and not (args.pg_con or args.pgpass_id):
+        parser.error("--execute, --benchmark and --detect_years require --pg_con or --pgpass_id")
+    if args.geometry_tiers and args.views == 'long':
+        parser.error("--geometry_tiers requires --views yearly or materialized")
+    if args.refresh_script and args.views != 'materialized':
+        parser.error("--refresh_script requires --views materialized")
+    if bool(args.start_year) != bool(args.end_year):
+        parser.error("must provide --start_year and --end_year")
+
+    years = dict(year_start=args.start_year, year_end=args.end_year) if args.start_year else {}
+
     table_names = sanitize_path(args.tablenames_file)
-    output_file = sanitize_path(args.output_file)
 
     with open(table_names, 'r') as f:
         tables_raw = f.readlines()
         tables = [x.strip() for x in tables_raw] 
 
-        if args.start_year and args.end_year:
-            pivot_table_names, view_names = create_pivot_annual_monthly_tables(tables, output_file, year_start=args.start_year, year_end=args.end_year)
-        elif args.start_year or args.end_year:
-            raise("must provide --start_year and --end_year")
+    db = None
+    if args.execute or args.benchmark or args.detect_years:
+        if args.pg_con:
+            db = PostgresDB.from_gdal_string(args.pg_con, verify=False, maxconn=max(1, args.jobs))
+        elif args.pgpass_file:
+            db = PostgresDB.from_pgpass(args.pgpass_id, pgpass=args.pgpass_file.resolve(strict=True), verify=False,
+                                        maxconn=max(1, args.jobs))
         else:
-            pivot_table_names, view_names = create_pivot_annual_monthly_tables(tables, output_file)
-    
-        if args.pivot_names:
-            list_to_file(pivot_table_names, args.pivot_names)
-        
-        if args.view_names:
-            list_to_file(view_names, args.view_names)
+            db = PostgresDB.from_pgpass(args.pgpass_id, verify=False, maxconn=max(1, args.jobs))
+        try:
+            db.verify()
+        except PostgresError as err:
+            db.close()
+            sys.exit("can't connect to postgres: {}".format(err))
+
+    try:
+        year_spans = None
+        if args.detect_years:
+            with db.connection() as conn:
+                year_spans = detect_year_spans(conn, tables,
+                    manifest_table=args.manifest_table if args.detect_years == 'manifest' else None)
+
+        if args.output_file:
+            pivot_table_names, view_names = create_pivot_annual_monthly_tables(tables, sanitize_path(args.output_file),
+                layout=args.layout, views=args.views, year_spans=year_spans, daily=args.daily,
+                geometry_tiers=args.geometry_tiers, **years)
+
+        if args.benchmark:
+            json.dump(benchmark_pivot_layouts(db, tables, year_spans=year_spans, **years), sys.stdout, indent=2)
+            print()
+            return
+
+        if args.execute:
+            groups = build_pivot_groups(tables, layout=args.layout, views=args.views, year_spans=year_spans,
+                                        daily=args.daily, geometry_tiers=args.geometry_tiers, **years)
+            if args.geometry_tiers:
+                try:
+                    prepare_geometry_tiers(db, geometry_tier_targets(groups))
+                except PostgresError as err:
+                    sys.exit("preparing geometry tiers failed: {}".format(err))
+            if args.asyncio:
+                try:
+                    results = run_batches(db, pivot_batches(groups), concurrency=args.jobs)
+                except KeyboardInterrupt:
+                    sys.exit("interrupted, running pivot groups were rolled back")
+            else:
+                results = execute_pivot_groups(db, groups, jobs=args.jobs, instrument=bool(args.report),
+                                               explain=args.explain, work_mem=args.work_mem)
+    finally:
+        if db is not None:
+            db.close()
+
+    if args.execute:
+        if args.report:
+            with open(sanitize_path(args.report), 'w') as f:
+                json.dump(pivot_report(results), f, indent=2)
+
+        # only report what was actually created
+        created = {(g['schema'], g['pivot_table']) for g, r in zip(groups, results) if r.ok}
+        pivot_table_names = [g['pivot_table'] for g in groups
+                             if (g['schema'], g['pivot_table']) in created and g['layout'] != 'long']
+        view_names = [v for g in groups if (g['schema'], g['pivot_table']) in created for v in g['view_names']]
+
+        for g, r in zip(groups, results):
+            if not r.ok:
+                print('"{}"."{}" {}:\n{}'.format(g['schema'], g['pivot_table'], getattr(r, 'status', 'failed'), r.error or ''),
+                      file=sys.stderr)
+
+    if args.pivot_names:
+        list_to_file(pivot_table_names, args.pivot_names)
+
+    if args.view_names:
+        list_to_file(view_names, args.view_names)
+
+    if args.refresh_script:
+        with open(sanitize_path(args.refresh_script), 'w') as f:
+            f.write(refresh_materialized_views(view_names))
+
+    if args.execute and len(created) < len(results):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,188 @@
+"""Delta loading of model output tables: merge only the periods (year, month, day) which are new or changed
+in the geopackage into an existing postgres table with INSERT ... ON CONFLICT DO UPDATE"""
+
+import math
+import time
+
+from psycopg2 import sql
+
+from .pgcopy import CopyBinaryStream, attach_fid_sequence
+from .util import split_pg_tablename
+
+# postgres columns identifying a row of a model output table, in key order. sampleid is required along with at
+# least one period column
+DELTA_KEYS = ('sampleid', 'year', 'month', 'day')
+
+
+def delta_keys(columns):
+    """Key columns of a model output table
+
+    Args:
+        columns (list): column mapping from gpkg_copy_columns
+
+    Returns:
+        list: postgres key columns in DELTA_KEYS order, None if the table has no sampleid or no period column
+    """
+    names = {c[1] for c in columns}
+    keys = [k for k in DELTA_KEYS if k in names]
+    if 'sampleid' not in keys or len(keys) < 2:
+        return None
+    return keys
+
+
+def _aggregated(columns, keys):
+    """Columns summed per period: everything but the keys and ogc_fid"""
+    return [c for c in columns if c[1] not in keys and c[1] != 'ogc_fid']
+
+
+def changed_periods(pg_conn, gpkg_conn, gpkg_table, pg_table_name, columns, keys, tolerance=1e-6):
+    """Periods of a geopackage table which are missing from the postgres table or differ from it.
+
+    Periods are compared on row count, the sum of every value column (total length for text and blobs) and its
+    sum weighted by sampleid, computed on both sides with one GROUP BY each. The weighted sum tells values moved
+    between sampleids, which leave the plain sum as it is. Sums match within tolerance relative to the sum of
+    absolute values, to absorb float rounding (FLOAT columns are stored as real in postgres).
+
+    Args:
+        pg_conn (psycopg2.extensions.connection): postgres connection
+        gpkg_conn (sqlite3.Connection): open geopackage connection
+        gpkg_table (str): name of table in geopackage
+        pg_table_name (str): postgres table name in schema.table form
+        columns (list): column mapping from gpkg_copy_columns
+        keys (list): key columns from delta_keys
+        tolerance (float, optional): relative tolerance on sums. Defaults to 1e-6.
+
+    Returns:
+        list: period tuples (values of keys after sampleid) to merge
+    """
+    gpkg_names = {c[1]: c[0] for c in columns}
+    periods = keys[1:]
+    values = _aggregated(columns, keys)
+
+    gpkg_sampleid = '"{}"'.format(gpkg_names['sampleid'])
+    gpkg_aggregates = ['count(*)']
+    pg_aggregates = [sql.SQL('count(*)')]
+    for gpkg_col, pg_col, pg_type, fmt in values:
+        if fmt is None:
+            gpkg_value = 'length("{}")'.format(gpkg_col)
+            pg_value = sql.SQL('length({})::double precision').format(sql.Identifier(pg_col))
+        else:
+            gpkg_value = '"{}"'.format(gpkg_col)
+            cast = '::integer::double precision' if pg_type == 'boolean' else '::double precision'
+            pg_value = sql.SQL('{}{}').format(sql.Identifier(pg_col), sql.SQL(cast))
+        for gpkg_weighted, pg_weighted in ((gpkg_value, pg_value), (
+                '{} * {}'.format(gpkg_sampleid, gpkg_value),
+                sql.SQL('sampleid::double precision * {}').format(pg_value))):
+            gpkg_aggregates += ['total({})'.format(gpkg_weighted), 'total(abs({}))'.format(gpkg_weighted)]
+            pg_aggregates.append(sql.SQL('sum({})').format(pg_weighted))
+
+    gpkg_periods = ', '.join('"{}"'.format(gpkg_names[p]) for p in periods)
+    source = gpkg_conn.execute('SELECT {0}, {1} FROM "{2}" GROUP BY {0}'.format(
+        gpkg_periods, ', '.join(gpkg_aggregates), gpkg_table)).fetchall()
+
+    pg_periods = sql.SQL(', ').join(map(sql.Identifier, periods))
+    with pg_conn:
+        with pg_conn.cursor() as cur:
+            cur.execute(sql.SQL('SELECT {0}, {1} FROM {2} GROUP BY {0}').format(
+                pg_periods, sql.SQL(', ').join(pg_aggregates), sql.Identifier(*split_pg_tablename(pg_table_name))))
+            loaded = {tuple(row[:len(periods)]): row[len(periods):] for row in cur.fetchall()}
+
+    changed = []
+    for row in source:
+        period, count, sums = tuple(row[:len(periods)]), row[len(periods)], row[len(periods) + 1:]
+        target = loaded.get(period)
+        if target is None or target[0] != count:
+            changed.append(period)
+            continue
+        for i, pg_sum in enumerate(target[1:]):
+            gpkg_sum, gpkg_abs = sums[2 * i], sums[2 * i + 1]
+            if not math.isclose(gpkg_sum, pg_sum or 0.0, rel_tol=0, abs_tol=tolerance * max(gpkg_abs, 1.0)):
+                changed.append(period)
+                break
+
+    return changed
+
+
+def merge_gpkg_table(pg_conn, gpkg_conn, gpkg_table, pg_table_name, columns, keys, batch_size=50000, timings=None):
+    """Merge the new or changed periods of a geopackage table into an existing postgres table.
+
+    Rows of changed periods are streamed with a binary COPY into a temporary table, then upserted on the key
+    columns in one transaction. A unique index on the key columns is created first if missing. Rows which
+    only exist in postgres are left alone. New rows get ogc_fid from the column's sequence, created by
+    pgcopy.attach_fid_sequence if the table has none. Concurrent merges into the same table wait on each other.
+
+    Args:
+        pg_conn (psycopg2.extensions.connection): postgres connection
+        gpkg_conn (sqlite3.Connection): open geopackage connection
+        gpkg_table (str): name of table in geopackage
+        pg_table_name (str): postgres table name in schema.table form
+        columns (list): column mapping from gpkg_copy_columns
+        keys (list): key columns from delta_keys
+        batch_size (int, optional): rows fetched from sqlite per batch. Defaults to 50000.
+        timings (dict, optional): filled with seconds spent per stage: compare, key_index, copy, upsert and commit.
+            Defaults to None.
+
+    Returns:
+        int, int, float: rows merged, periods merged, seconds spent
+    """
+    start = time.perf_counter()
+    timings = {} if timings is None else timings
+    periods = changed_periods(pg_conn, gpkg_conn, gpkg_table, pg_table_name, columns, keys)
+    timings['compare'] = time.perf_counter() - start
+    if not periods:
+        return 0, 0, time.perf_counter() - start
+
+    # periods to select from the geopackage, the temp table is per connection and per number of period columns
+    gpkg_names = {c[1]: c[0] for c in columns}
+    n = len(keys) - 1
+    gpkg_conn.execute('CREATE TEMP TABLE IF NOT EXISTS delta_periods_{} ({})'.format(
+        n, ', '.join('p{}'.format(i) for i in range(n))))
+    gpkg_conn.execute('DELETE FROM temp.delta_periods_{}'.format(n))
+    gpkg_conn.executemany('INSERT INTO temp.delta_periods_{} VALUES ({})'.format(n, ', '.join('?' * n)), periods)
+    select = 'SELECT {} FROM "{}" t JOIN temp.delta_periods_{} p ON {}'.format(
+        ', '.join('t."{}"'.format(c[0]) for c in columns), gpkg_table, n,
+        ' AND '.join('t."{}" = p.p{}'.format(gpkg_names[k], i) for i, k in enumerate(keys[1:])))
+
+    schema, table = split_pg_tablename(pg_table_name)
+    target = sql.Identifier(schema, table)
+    suffix = '_{}_key'.format('_'.join(keys))
+    key_index = sql.Identifier(table[:63 - len(suffix)] + suffix)
+    key_columns = sql.SQL(', ').join(map(sql.Identifier, keys))
+    merged = [c[1] for c in columns if c[1] != 'ogc_fid']
+    merged_columns = sql.SQL(', ').join(map(sql.Identifier, merged))
+
+    has_fid = any(c[1] == 'ogc_fid' for c in columns)
+    insert = sql.SQL('INSERT INTO {target} ({merged}) SELECT {merged} FROM delta')
+
+    updates = [sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(c)) for c in merged if c not in keys]
+    if updates:
+        conflict = sql.SQL('ON CONFLICT ({}) DO UPDATE SET {}').format(key_columns, sql.SQL(', ').join(updates))
+    else:
+        conflict = sql.SQL('ON CONFLICT ({}) DO NOTHING').format(key_columns)
+
+    with pg_conn:
+        with pg_conn.cursor() as cur:
+            stage = time.perf_counter()
+            # self conflicting, merges into the same table queue while readers and plain inserts go on
+            cur.execute(sql.SQL('LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE').format(target))
+            cur.execute(sql.SQL('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})').format(key_index, target, key_columns))
+            if has_fid:
+                attach_fid_sequence(cur, pg_table_name)
+            timings['key_index'] = time.perf_counter() - stage
+
+            stage = time.perf_counter()
+            cur.execute(sql.SQL('CREATE TEMP TABLE delta ({}) ON COMMIT DROP').format(sql.SQL(', ').join(
+                sql.SQL('{} {}').format(sql.Identifier(c[1]), sql.SQL(c[2])) for c in columns)))
+
+            stream = CopyBinaryStream(gpkg_conn.execute(select), [c[3] for c in columns], batch_size=batch_size)
+            cur.copy_expert(sql.SQL('COPY delta ({}) FROM STDIN (FORMAT binary)').format(
+                sql.SQL(', ').join(sql.Identifier(c[1]) for c in columns)).as_string(cur), stream, size=1 << 20)
+            timings['copy'] = time.perf_counter() - stage
+
+            stage = time.perf_counter()
+            cur.execute(sql.SQL('{} {}').format(insert.format(target=target, merged=merged_columns), conflict))
+            timings['upsert'] = time.perf_counter() - stage
+        stage = time.perf_counter()
+    timings['commit'] = time.perf_counter() - stage
+
+    return stream.rows, len(periods), time.perf_counter() - start
@@ -0,0 +1,270 @@
+"""Geometry prepared once for serving the yearly layers of polygon units (basins, subbasins, countries, states).
+
+Every polygon geography table gets two materialized views in the schemas of its pivot tables:
+
+- <geography>_tiers: the geometry simplified (ST_SimplifyPreserveTopology) at the tolerance of each tier in
+  GEOMETRY_TIERS, one GiST indexed column per tier. Yearly views built with geometry_tiers carry these columns
+  next to the full geometry, and styles draw the tier of the map scale (see tier_for_scale, tier_style_rules),
+  so smaller scales read and render far fewer vertices.
+- <geography>_subdivided: the full geometry cut with ST_Subdivide into parts of at most SUBDIVIDE_VERTICES
+  vertices, GiST indexed, for fast intersection and point in polygon queries against large polygons.
+
+Both are created if missing (prepare_geometry_tiers) and, once the geography is reloaded, refreshed with
+REFRESH MATERIALIZED VIEW CONCURRENTLY (refresh_geometry_tiers) using their unique indexes on (id) and (id, part).
+Overwriting imports drop them along with the geography table, they are prepared again (tiered_geography).
+"""
+
+from collections import OrderedDict
+
+from .tablename import TableName
+from .util import pg_identifier, split_pg_tablename
+
+# (tier, smallest scale denominator drawn with it), from the largest scale to the smallest. full is the geography
+# geometry itself.
+GEOMETRY_TIERS = (('full', 0), ('medium', 1000000), ('coarse', 5000000), ('overview', 25000000))
+
+# size of a rendered pixel (OGC standard 0.28mm) and meters per degree at the equator, geography is EPSG:4326
+PIXEL_METERS = 0.00028
+METERS_PER_DEGREE = 111320
+
+SUBDIVIDE_VERTICES = 256
+
+GEOMETRY_TIERS_TEMPLATE = """SET search_path="{schema}", public;
+DO $$
+DECLARE
+    geom_col name;
+BEGIN
+    SELECT a.attname INTO geom_col FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+    WHERE a.attrelid = to_regclass('{geography_table}') AND a.attnum > 0 AND NOT a.attisdropped AND t.typname = 'geometry'
+    ORDER BY a.attnum LIMIT 1;
+    IF geom_col IS NULL THEN
+        RAISE EXCEPTION 'no geometry column in %', '{geography_table}';
+    END IF;
+    EXECUTE format('CREATE MATERIALIZED VIEW IF NOT EXISTS %1$I.%2$I AS SELECT id, {tier_columns} FROM %4$I WHERE %3$I IS NOT NULL',
+                   '{schema}', '{tiers_view}', geom_col, '{geography_table}');
+    EXECUTE format('CREATE MATERIALIZED VIEW IF NOT EXISTS %1$I.%2$I AS SELECT id, row_number() OVER (PARTITION BY id) AS part, geom
+                    FROM (SELECT id, ST_Subdivide(%3$I, {max_vertices}) AS geom FROM %4$I WHERE %3$I IS NOT NULL) parts',
+                   '{schema}', '{subdivided_view}', geom_col, '{geography_table}');
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS "{tiers_id_index}" ON "{schema}"."{tiers_view}" (id);
+{tier_indexes}
+CREATE UNIQUE INDEX IF NOT EXISTS "{subdivided_id_index}" ON "{schema}"."{subdivided_view}" (id, part);
+CREATE INDEX IF NOT EXISTS "{subdivided_geom_index}" ON "{schema}"."{subdivided_view}" USING GIST (geom);
+ANALYZE "{schema}"."{tiers_view}";
+ANALYZE "{schema}"."{subdivided_view}";
+"""
+
+# tiers and subdivided views built on geography tables, by name, wherever they were created
+TIER_VIEWS_SQL = """
+SELECT DISTINCT vn.nspname, v.relname, t.nspname, t.relname
+FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[]) AS t(nspname, relname, tiers_view, subdivided_view)
+JOIN pg_namespace tn ON tn.nspname = t.nspname
+JOIN pg_class tc ON tc.relnamespace = tn.oid AND tc.relname = t.relname
+JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.refobjid = tc.oid
+JOIN pg_rewrite r ON r.oid = d.objid
+JOIN pg_class v ON v.oid = r.ev_class AND v.relkind = 'm' AND v.relname IN (t.tiers_view, t.subdivided_view)
+JOIN pg_namespace vn ON vn.oid = v.relnamespace
+ORDER BY 1, 2
+"""
+
+
+def tier_tolerance(tier):
+    """Simplification tolerance of a tier in degrees, a pixel at the smallest scale denominator the tier is drawn at,
+    so the simplified geometry is off by at most a pixel
+
+    Args:
+        tier (str): tier name, one of GEOMETRY_TIERS
+
+    Returns:
+        float: tolerance, 0 for the full geometry
+    """
+    return dict(GEOMETRY_TIERS)[tier] * PIXEL_METERS / METERS_PER_DEGREE
+
+
+def tier_column(tier):
+    """Geometry column of a tier in <geography>_tiers and the tiered yearly views, None for the full geometry"""
+    if tier not in dict(GEOMETRY_TIERS):
+        raise ValueError("unknown geometry tier {}, expected one of {}".format(tier, [t for t, _ in GEOMETRY_TIERS]))
+    return None if tier == 'full' else 'geom_{}'.format(tier)
+
+
+def tier_for_scale(scale_denominator):
+    """Geometry tier to draw a map at, ie 'coarse' at 1:10,000,000
+
+    Args:
+        scale_denominator (float): map scale denominator
+
+    Returns:
+        str: tier name
+    """
+    tier = GEOMETRY_TIERS[0][0]
+    for name, min_scale in GEOMETRY_TIERS:
+        if scale_denominator >= min_scale:
+            tier = name
+    return tier
+
+
+def tier_scale_ranges():
+    """Scale denominator range of each tier
+
+    Returns:
+        list: (tier, min scale denominator, max scale denominator or None) tuples, the max is exclusive
+    """
+    bounds = [min_scale for _, min_scale in GEOMETRY_TIERS[1:]] + [None]
+    return [(name, min_scale, max_scale) for (name, min_scale), max_scale in zip(GEOMETRY_TIERS, bounds)]
+
+
+def geometry_tier_names(geography_table):
+    """Names of the tiers and subdivided materialized views of a geography table, unqualified
+
+    Returns:
+        str, str: tiers view, subdivided view
+    """
+    return pg_identifier(geography_table, '_tiers'), pg_identifier(geography_table, '_subdivided')
+
+
+def create_geometry_tiers(schema, geography_table, max_vertices=SUBDIVIDE_VERTICES):
+    """Sql creating the tiers and subdivided materialized views of a geography table in schema, with their indexes.
+    Existing views are kept, see refresh_geometry_tiers after the geography changes. Requires PostGIS.
+
+    Args:
+        schema (str): schema the views are created in, the geography table is looked up in schema then public
+        geography_table (str): geography table name ie hydrostn30_basin_01min
+        max_vertices (int, optional): max vertices of the parts of the subdivided view. Defaults to SUBDIVIDE_VERTICES.
+
+    Returns:
+        str: sql
+    """
+    tiers_view, subdivided_view = geometry_tier_names(geography_table)
+    tiers = [t for t, _ in GEOMETRY_TIERS if tier_column(t) is not None]
+    tier_columns = ', '.join('ST_SimplifyPreserveTopology(%3$I, {:.6g}) AS {}'.format(tier_tolerance(t), tier_column(t))
+                             for t in tiers)
+    tier_indexes = '\n'.join('CREATE INDEX IF NOT EXISTS "{}" ON "{}"."{}" USING GIST ({});'.format(
+        pg_identifier(tiers_view, '_{}_idx'.format(tier_column(t))), schema, tiers_view, tier_column(t)) for t in tiers)
+
+    return GEOMETRY_TIERS_TEMPLATE.format(schema=schema, geography_table=geography_table, tiers_view=tiers_view,
+        subdivided_view=subdivided_view, tier_columns=tier_columns, tier_indexes=tier_indexes, max_vertices=max_vertices,
+        tiers_id_index=pg_identifier(tiers_view, '_id_idx'),
+        subdivided_id_index=pg_identifier(subdivided_view, '_id_idx'),
+        subdivided_geom_index=pg_identifier(subdivided_view, '_geom_idx'))
+
+
+def geometry_tier_targets(groups):
+    """Polygon geography tables the yearly views of pivot groups join, once per schema
+
+    Args:
+        groups (list): dicts with schema and pivot_table, ie from pivot.build_pivot_groups or
+            nppivot.gpkg_pivot_groups. Daily pivot groups are left out.
+
+    Returns:
+        list: (schema, geography table) tuples in the order of groups
+    """
+    targets = OrderedDict()
+    for g in groups:
+        name = TableName.parse(g['pivot_table'])
+        if g.get('layout') != 'daily' and name.temporal != 'daily' and name.is_polygon:
+            targets[(g['schema'], name.hunit_table())] = None
+    return list(targets)
+
+
+def prepare_geometry_tiers(db, targets, max_vertices=SUBDIVIDE_VERTICES):
+    """Create the geometry tiers of geography tables, each in its own transaction on a pooled connection
+
+    Args:
+        db (PostgresDB): database to run on
+        targets (list): (schema, geography table) tuples from geometry_tier_targets
+        max_vertices (int, optional): see create_geometry_tiers. Defaults to SUBDIVIDE_VERTICES.
+
+    Returns:
+        list: schema qualified tiers and subdivided view names
+    """
+    created = []
+    with db.connection() as conn:
+        for schema, geography_table in targets:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(create_geometry_tiers(schema, geography_table, max_vertices=max_vertices))
+                    cur.execute('RESET search_path')
+            created += ['"{}"."{}"'.format(schema, v) for v in geometry_tier_names(geography_table)]
+    return created
+
+
+def _tier_views(conn, pg_tables):
+    """(view schema, view, table schema, table) of the tiers and subdivided views built on pg_tables"""
+    names = [split_pg_tablename(t) for t in pg_tables]
+    views = [geometry_tier_names(table) for _, table in names]
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(TIER_VIEWS_SQL, ([n[0] for n in names], [n[1] for n in names], [v[0] for v in views],
+                                         [v[1] for v in views]))
+            return cur.fetchall()
+
+
+def tiered_geography(db, pg_tables):
+    """Geometry tiers built on geography tables. An overwriting import drops a table with every view depending on
+    it, these are the targets to prepare again once the table is reloaded.
+
+    Args:
+        db (PostgresDB): database to run on
+        pg_tables (list): tables in schema.table form
+
+    Returns:
+        dict: {table of pg_tables: [(schema, geography table)] targets for prepare_geometry_tiers}, tables without
+            tiers are left out
+    """
+    tables = {split_pg_tablename(t): t for t in pg_tables}
+    tiered = OrderedDict()
+    with db.connection() as conn:
+        for schema, _, table_schema, table in _tier_views(conn, pg_tables):
+            targets = tiered.setdefault(tables[(table_schema, table)], [])
+            if (schema, table) not in targets:
+                targets.append((schema, table))
+    return tiered
+
+
+def refresh_geometry_tiers(db, pg_tables):
+    """Refresh the tiers and subdivided views of reloaded geography tables CONCURRENTLY, each in its own transaction,
+    so layers keep being served the previous geometry until the new one is in place. Tables without tiers (model
+    output tables, geography never pivoted with geometry tiers) are passed over.
+
+    Args:
+        db (PostgresDB): database to run on
+        pg_tables (list): reloaded tables in schema.table form
+
+    Returns:
+        list: schema qualified names of the refreshed views
+    """
+    refreshed = []
+    with db.connection() as conn:
+        targets = _tier_views(conn, pg_tables)
+        for schema, view, _, _ in targets:
+            qualified = '"{}"."{}"'.format(schema, view)
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY {}'.format(qualified))
+                    cur.execute('ANALYZE {}'.format(qualified))
+            refreshed.append(qualified)
+    return refreshed
+
+
+def tier_style_rules(symbolizer):
+    """SLD rules drawing a symbolizer with the geometry tier of each scale range, for the styles of tiered layers
+
+    Args:
+        symbolizer (str): SLD symbolizer element, with a {geometry} placeholder where its Geometry element goes ie
+            <PolygonSymbolizer>{geometry}<Fill>...</Fill></PolygonSymbolizer>
+
+    Returns:
+        str: one Rule element per tier
+    """
+    rules = []
+    for tier, min_scale, max_scale in tier_scale_ranges():
+        column = tier_column(tier)
+        geometry = '' if column is None else '<Geometry><ogc:PropertyName>{}</ogc:PropertyName></Geometry>'.format(column)
+        scales = ''
+        if min_scale:
+            scales += '<MinScaleDenominator>{}</MinScaleDenominator>'.format(min_scale)
+        if max_scale is not None:
+            scales += '<MaxScaleDenominator>{}</MaxScaleDenominator>'.format(max_scale)
+        rules.append('<Rule><Name>{}</Name>{}{}</Rule>'.format(tier, scales, symbolizer.replace('{geometry}', geometry)))
+    return '\n'.join(rules)
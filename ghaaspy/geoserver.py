@@ -1,27 +1,292 @@
 """Geoserver REST scripting"""
 
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from xml.sax.saxutils import escape
+
+import requests
+from requests.adapters import HTTPAdapter
 from geo.Geoserver import Geoserver
 
+from .sqlgen import long_view_names, geoserver_year_sql_view
+from .tablename import TableName
+
+# responses worth retrying: geoserver or its proxy overloaded or restarting
+TRANSIENT_STATUS = (429, 502, 503, 504)
+
+FEATURETYPE_TEMPLATE = """<featureType>
+    <name>{name}</name>
+    <enabled>true</enabled>
+    <namespace><name>{workspace}</name></namespace>
+    <title>{name}</title>
+    <srs>EPSG:{srid}</srs>
+    <metadata>
+        <entry key="JDBC_VIRTUAL_TABLE">
+            <virtualTable>
+                <name>{name}</name>
+                <sql>{sql}</sql>
+                <escapeSql>true</escapeSql>
+                <geometry><name>{geom_name}</name><type>{geom_type}</type><srid>{srid}</srid></geometry>{key_columns}\
+{parameters}
+            </virtualTable>
+        </entry>
+    </metadata>
+</featureType>"""
+
 def connect_geoserver(geoserver_url, user, password):
     return Geoserver(geoserver_url, user, password)
 
-def publish_geoserver_sqlview(geo, view_name, store_name, workspace, geography=False):
+def geoserver_sqlview(view_name, geography=False):
+    """Layer name, sql and key column of the sql view publishing a postgres view or table. A long format view,
+    a row per sampleid, year and month, is published through its year function instead, see
+    geoserver_long_sqlview.
+
+    Args:
+        view_name (str): postgres view or table name in schema.table form
+        geography (bool, optional): a geography table, keyed on id rather than sampleid. Defaults to False.
+
+    Returns:
+        str, str, str: layer name, sql, key column
+    """
     sql = 'SELECT * FROM {}'.format(view_name)
+    table_name = TableName.parse(view_name)
+    if table_name.kind == 'long':
+        name, sql_view = geoserver_long_sqlview(table_name)
+        return name, sql_view['sql'], 'sampleid,month'
 
     # handle faogaul_country / state -9999 admin null rows
-    if '_country_' in view_name or '_state_' in view_name:
+    if table_name.is_admin:
         sql += (' WHERE geom is not NULL')
-    
-    name = view_name.split('.')[1].replace('+','-').replace('"','')
+
+    name = table_name.table.replace('+','-')
 
     # geography tables PK distinction
     key_col = 'sampleid'
-    if geography: 
+    if geography:
         key_col = 'id'
 
-    geo.publish_featurestore_sqlview(name=name, store_name=store_name, sql=sql, key_column=key_col, workspace=workspace)
+    return name, sql, key_col
+
+def geoserver_long_sqlview(table_name, default_year=1958):
+    """Layer name and sql view of a long format view, selecting the rows of the year given by the viewparams of
+    the request through the year function of the view, see sqlgen.geoserver_year_sql_view. The rows of a year are
+    keyed on sampleid and month, NULL for the annual value.
+
+    Args:
+        table_name (TableName): parsed long format view name
+        default_year (int, optional): year served without viewparams. Defaults to 1958.
+
+    Returns:
+        str, dict: layer name, sql and parameters of the sql view
+    """
+    _, function_name = long_view_names(table_name.table[:-len('long')] + 'pivot')
+    if table_name.schema:
+        function_name = '"{}"."{}"'.format(table_name.schema, function_name)
+    else:
+        function_name = '"{}"'.format(function_name)
+    return function_name.split('.')[-1].strip('"').replace('+', '-'), \
+        geoserver_year_sql_view(function_name, default_year=default_year)
+
+
+def geoserver_sqlview_parameters(view_name):
+    """Parameters of the sql view publishing a postgres view or table, see geoserver_sqlview
+
+    Returns:
+        dict: {name: (default value, validation regex)}, empty but for long format views
+    """
+    table_name = TableName.parse(view_name)
+    if table_name.kind != 'long':
+        return {}
+    return geoserver_long_sqlview(table_name)[1]['parameters']
+
+
+def featuretype_xml(name, workspace, sql, key_column, parameters=None, geom_name='geom', geom_type='Geometry',
+                    srid=4326):
+    """featureType body of a sql view layer for the geoserver REST api
+
+    Args:
+        key_column (str): key column, or comma separated key columns
+        parameters (dict, optional): {name: (default value, validation regex)} of the %name% placeholders of sql.
+            Defaults to None.
+
+    Returns:
+        str: xml
+    """
+    key_columns = ''.join('\n                <keyColumn>{}</keyColumn>'.format(escape(k))
+                          for k in key_column.split(','))
+    parameters = ''.join('\n                <parameter><name>{}</name><defaultValue>{}</defaultValue>'
+                         '<regexpValidator>{}</regexpValidator></parameter>'.format(escape(k), escape(d), escape(r))
+                         for k, (d, r) in (parameters or {}).items())
+    return FEATURETYPE_TEMPLATE.format(name=escape(name), workspace=escape(workspace), sql=escape(sql),
+                                       geom_name=escape(geom_name), geom_type=escape(geom_type), srid=srid,
+                                       key_columns=key_columns, parameters=parameters)
+
+
+def publish_geoserver_sqlview(geo, view_name, store_name, workspace, geography=False):
+    name, sql, key_col = geoserver_sqlview(view_name, geography=geography)
+    parameters = [dict(name=k, defaultValue=d, regexpValidator=r)
+                  for k, (d, r) in geoserver_sqlview_parameters(view_name).items()] or None
+    geo.publish_featurestore_sqlview(name=name, store_name=store_name, sql=sql, parameters=parameters,
+                                     key_column=key_col, workspace=workspace)
     print(name)
 
 def publish_geoserver_sqlview_batch(geo, views_list, store_name, workspace, geography=False):
     for v in views_list:
         publish_geoserver_sqlview(geo, v, store_name, workspace, geography=geography)
+
+
+@dataclass
+class PublishResult:
+    """Outcome of publishing one sql view layer. status is 'created', 'exists' (a layer of that name was already
+    published, left as it is) or 'failed'."""
+    view: str
+    layer: str
+    status: str = 'failed'
+    status_code: int = None
+    attempts: int = 0
+    seconds: float = 0.0
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.status != 'failed'
+
+
+class GeoserverSession:
+    """Geoserver REST client on a single requests.Session, keeping up to pool_size connections alive so that
+    concurrent requests from a thread pool reuse them rather than connecting for every request. Connection errors,
+    timeouts and TRANSIENT_STATUS responses are retried with exponential backoff.
+
+    Args:
+        geoserver_url (str): url of geoserver ie http://localhost:8080/geoserver
+        user (str): geoserver user
+        password (str): geoserver password
+        pool_size (int, optional): connections kept alive, should match the threads using the session. Defaults to 8.
+        retries (int, optional): retries of a request after a transient error. Defaults to 3.
+        backoff (float, optional): seconds waited before the first retry, doubled for each following one.
+            Defaults to 0.5.
+        timeout (float, optional): seconds to wait for geoserver to respond. Defaults to 120.
+    """
+
+    def __init__(self, geoserver_url, user, password, pool_size=8, retries=3, backoff=0.5, timeout=120):
+        self.service_url = geoserver_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def request(self, method, path, **kwargs):
+        """Send a REST request, retrying transient errors
+
+        Args:
+            method (str): http method
+            path (str): path under the service url ie /rest/workspaces
+
+        Returns:
+            requests.Response, int: last response, number of attempts made
+
+        Raises:
+            requests.RequestException: connection error or timeout on the last attempt
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.session.request(method, self.service_url + path, timeout=self.timeout, **kwargs)
+                if response.status_code not in TRANSIENT_STATUS or attempt > self.retries:
+                    return response, attempt
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt > self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def publish_sqlview(self, view_name, store_name, workspace, geography=False, geom_name='geom',
+                        geom_type='Geometry', srid=4326):
+        """Publish a postgres view or table as a sql view layer, see geoserver_sqlview
+
+        Returns:
+            PublishResult
+        """
+        name, sql, key_col = geoserver_sqlview(view_name, geography=geography)
+        result = PublishResult(view=view_name, layer=name)
+        body = featuretype_xml(name, workspace, sql, key_col, parameters=geoserver_sqlview_parameters(view_name),
+                               geom_name=geom_name, geom_type=geom_type, srid=srid)
+
+        start = time.perf_counter()
+        try:
+            response, result.attempts = self.request(
+                'post', '/rest/workspaces/{}/datastores/{}/featuretypes'.format(workspace, store_name),
+                data=body.encode(), headers={'content-type': 'text/xml'})
+        except requests.RequestException as err:
+            result.attempts = self.retries + 1
+            result.error = str(err)
+        else:
+            result.status_code = response.status_code
+            if response.status_code == 201:
+                result.status = 'created'
+            elif 'already exists' in response.text:
+                result.status = 'exists'
+            else:
+                result.error = response.text.strip()[:1000]
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def close(self):
+        self.session.close()
+
+
+def publish_geoserver_sqlviews(session, views_list, store_name, workspace, geography=False, jobs=8):
+    """Publish postgres views or tables as sql view layers, jobs at a time over a shared GeoserverSession. A failed
+    layer does not stop the others.
+
+    Args:
+        session (GeoserverSession): session whose pool_size is at least jobs
+        views_list (list): postgres view or table names in schema.table form
+        store_name (str): geoserver postgis store of the views
+        workspace (str): geoserver workspace to publish to
+        geography (bool, optional): views are geography tables, see geoserver_sqlview. Defaults to False.
+        jobs (int, optional): number of layers published concurrently. Defaults to 8.
+
+    Returns:
+        list: PublishResult of each view, in the order of views_list
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(session.publish_sqlview, v, store_name, workspace, geography=geography): i
+                   for i, v in enumerate(views_list)}
+        for future in as_completed(futures):
+            r = future.result()
+            results[futures[future]] = r
+            print('{} {}'.format(r.layer, r.status if r.ok else 'FAILED'))
+
+    return [results[i] for i in range(len(views_list))]
+
+
+def publish_report(results):
+    """Report of published layers
+
+    Args:
+        results (list): PublishResult from publish_geoserver_sqlviews
+
+    Returns:
+        dict: counts per status, total attempts and seconds, and {layer: {'view', 'status', 'status_code',
+            'attempts', 'seconds', 'error'}}
+    """
+    counts = {}
+    for r in results:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    return dict(counts=counts, attempts=sum(r.attempts for r in results), seconds=sum(r.seconds for r in results),
+                layers={r.layer: dict(view=r.view, status=r.status, status_code=r.status_code, attempts=r.attempts,
+                                      seconds=r.seconds, error=r.error) for r in results})
@@ -1,11 +1,32 @@
 """Geopackage manipulation and import to PostGIS"""
 
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+import glob
+import json
 import subprocess as sp
+import sqlite3
+import struct
 import shlex
+import threading
+import time
+from urllib.parse import quote
 import pkg_resources
 
-from .util import group_geography_vs_model
+from psycopg2 import Error as PostgresError
+
+from .postgres import PostgresDB
+from .pgcopy import gpkg_copy_columns, copy_gpkg_table, launder
+from .manifest import (MANIFEST_TABLE, plan_incremental, record_manifest, table_digest, table_stats, manifest_entry,
+                       compare_digests)
+from .staging import staging_tablename, finalize_staging, swap_staging
+from .delta import delta_keys, merge_gpkg_table
+from .plan import THROUGHPUT_FILE, build_import_plan, classify_temporal, load_throughput, record_throughput
+from .tablename import TableName, TableCatalog
+from .geomtier import refresh_geometry_tiers, prepare_geometry_tiers, tiered_geography
+from .util import sanitize_path, split_pg_tablename
 
 
 def read_constants():
@@ -37,37 +58,184 @@ def read_constants():
 MODEL_OUTPUTS, SPATIAL_UNITS, MODEL_SHORTNAMES = read_constants()
 
 
+def connect_gpkg(gpkg, immutable=False):
+    """Open a read-only sqlite connection to a geopackage
+
+    Args:
+        gpkg (Path): geopackage file
+        immutable (bool, optional): tell sqlite the file can't change, skipping file locking. Defaults to False.
+
+    Returns:
+        sqlite3.Connection: connection usable from any thread
+    """
+    uri = 'file:{}?mode=ro'.format(quote(str(gpkg)))
+    if immutable:
+        uri += '&immutable=1'
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+@dataclass
+class GpkgTable:
+    """Entry of gpkg_contents joined with gpkg_geometry_columns"""
+    name: str
+    data_type: str
+    srs_id: int = None
+    extent: tuple = None
+    geometry_column: str = None
+    geometry_type: str = None
+
+    @property
+    def has_geometry(self):
+        return self.geometry_column is not None
+
+
+class GpkgCatalog:
+    """Metadata index of a geopackage. The geopackage is opened once, read-only, and table kind, geometry type,
+    SRS and extent are read in bulk from gpkg_contents/gpkg_geometry_columns. Row counts and column schemas
+    are read on first use and cached.
+    """
+
+    def __init__(self, gpkg):
+        self.gpkg = gpkg
+        self.conn = connect_gpkg(gpkg, immutable=True)
+        self._lock = threading.RLock()
+        self._row_counts = {}
+        self._max_rowids = {}
+        self._columns = {}
+        self._digests = {}
+        self._stats = {}
+        self._year_spans = {}
+        self._tables = self._read_contents()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _read_contents(self):
+        try:
+            res = self.conn.execute("""SELECT c.table_name, c.data_type, c.srs_id, c.min_x, c.min_y, c.max_x, c.max_y,
+                                              g.column_name, g.geometry_type_name
+                                       FROM gpkg_contents c
+                                       LEFT JOIN gpkg_geometry_columns g ON c.table_name = g.table_name
+                                       ORDER BY c.rowid""")
+        except sqlite3.OperationalError:
+            # plain sqlite file without geopackage metadata tables
+            res = self.conn.execute("SELECT name, 'attributes', NULL, NULL, NULL, NULL, NULL, NULL, NULL "
+                                    "FROM sqlite_master WHERE type='table' ORDER BY rowid")
+
+        tables = {}
+        for name, data_type, srs_id, min_x, min_y, max_x, max_y, geom_col, geom_type in res:
+            if name.startswith('rtree') or name.startswith('gpkg') or name.startswith('sqlite'):
+                continue
+            extent = None if min_x is None else (min_x, min_y, max_x, max_y)
+            tables[name] = GpkgTable(name=name, data_type=data_type, srs_id=srs_id, extent=extent,
+                                     geometry_column=geom_col, geometry_type=geom_type)
+        return tables
+
+    @property
+    def tables(self):
+        """list: names of data tables"""
+        return list(self._tables)
+
+    def table(self, name):
+        """GpkgTable: metadata of table name"""
+        return self._tables[name]
+
+    def has_geometry(self, name):
+        return self._tables[name].has_geometry
+
+    def _cached(self, cache, name, query):
+        with self._lock:
+            if name not in cache:
+                cache[name] = query()
+            return cache[name]
+
+    def row_count(self, name):
+        """int: exact number of rows of table name"""
+        return self._cached(self._row_counts, name,
+            lambda: self.conn.execute('SELECT count(*) FROM "{}"'.format(name)).fetchone()[0])
+
+    def known_row_count(self, name):
+        """int: number of rows of table name if already read by row_count or stats, else None without reading it"""
+        with self._lock:
+            if name in self._row_counts:
+                return self._row_counts[name]
+            if name in self._stats:
+                return self._stats[name]['row_count']
+        return None
+
+    def max_rowid(self, name):
+        """int: max rowid of table name, a cheap row count estimate"""
+        return self._cached(self._max_rowids, name,
+            lambda: self.conn.execute('SELECT max(rowid) FROM "{}"'.format(name)).fetchone()[0] or 0)
+
+    def columns(self, name):
+        """list: PRAGMA table_info rows (cid, name, type, notnull, default, pk) of table name"""
+        return self._cached(self._columns, name,
+            lambda: self.conn.execute('PRAGMA table_info("{}")'.format(name)).fetchall())
+
+    def content_digest(self, name):
+        """str: full content digest of table name, see manifest.table_digest. The rows are counted on the way"""
+        with self._lock:
+            if name not in self._digests:
+                self._digests[name], self._row_counts[name] = table_digest(self, name, count=True)
+            return self._digests[name]
+
+    def stats(self, name):
+        """dict: row count, content hash and year span of table name, see manifest.table_stats"""
+        return self._cached(self._stats, name, lambda: table_stats(self, name))
+
+    def year_span(self, name):
+        """tuple: first and last year of table name, (None, None) without a year column or rows. Taken from
+        stats if they were already read (ie by an incremental import), else from a min/max scan"""
+        with self._lock:
+            if name in self._stats:
+                return self._stats[name]['year_min'], self._stats[name]['year_max']
+        return self._cached(self._year_spans, name, lambda: self._read_year_span(name))
+
+    def _read_year_span(self, name):
+        year_column = next((c[1] for c in self.columns(name) if launder(c[1]) == 'year'), None)
+        if year_column is None:
+            return None, None
+        return tuple(self.conn.execute('SELECT min("{0}"), max("{0}") FROM "{1}"'.format(year_column, name)).fetchone())
+
+    def close(self):
+        self.conn.close()
+
+
 def extract_tables(gpkg):
     """Extract tablenames from geopackage without indexes or metadata tables.
 
     Args:
         gpkg (Path): Path to geopackages
 
-    Yields:
-        Generator: Generator of table names
+    Returns:
+        list: table names
     """
-    import sqlite3
-    conn = sqlite3.connect(gpkg)                                
-    cursor = conn.cursor()
+    with GpkgCatalog(gpkg) as catalog:
+        return catalog.tables
 
-    res = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for name_t in res:
-        name= name_t[0]
-        if not name.startswith('rtree') and not name.startswith('gpkg') and not name.startswith('sqlite'):
-            yield name
 
-
-def extract_gpkg_meta(gpkg):
+def extract_gpkg_meta(gpkg, catalog=None):
     """Extract information from geopackage filepath and filename
 
     Args:
         gpkg (Path): geopackage file
+        catalog (GpkgCatalog, optional): opened catalog of gpkg, kept in the metadata for later reads and closed
+            by the caller. Defaults to reading the tables from a catalog opened and closed here.
 
     Returns:
-        dict: metadata from filename
+        dict: metadata from filename, with table names and the GpkgCatalog they were read from (None unless passed)
     """
     gpkg_info = [component.lower() for component in gpkg.name.split('_')]
-    tables = extract_tables(gpkg)
+    if catalog is None:
+        with GpkgCatalog(gpkg) as own_catalog:
+            tables = own_catalog.tables
+    else:
+        tables = catalog.tables
 
     # Geography only geopackage (no model output)
     if gpkg_info[1] == 'geography':
@@ -75,7 +243,8 @@ def extract_gpkg_meta(gpkg):
             is_output=False,
             geography=gpkg_info[0],
             resolution=gpkg_info[2].split('.')[0],
-            tables=tables
+            tables=tables,
+            catalog=catalog
         )
         return meta
     else:
@@ -98,12 +267,13 @@ def extract_gpkg_meta(gpkg):
             geography=gpkg_info[0],
             model_short=model_short,
             resolution=gpkg_info[2].split('.')[0], 
-            tables=tables
+            tables=tables,
+            catalog=catalog
         )
         return meta
 
 
-def _import_gpkg(pg_con, gpkg, table_name, target_gpkg_table, update=False):
+def _import_gpkg(pg_con, gpkg, table_name, target_gpkg_table, update=False, unlogged=False):
     """Generate ogr2ogr command string
 
     Args:
@@ -112,13 +282,14 @@ def _import_gpkg(pg_con, gpkg, table_name, target_gpkg_table, update=False):
         table_name (str): name of table to be created in postgres
         target_gpkg_table (str): name of table in geopackage to import
         update (bool, optional): If True, will try to truncate then append to table rather than overwriting by default
+        unlogged (bool, optional): If True, create an UNLOGGED table without spatial index, for bulk loading staging tables
 
     Returns:
         str: ogr2ogr command string
     """
 
     template_create = 'ogr2ogr -overwrite -f "PostgreSQL" PG:"{pg_con}" \
-        -lco OVERWRITE=YES \
+        -lco OVERWRITE=YES {unlogged} \
         --config PG_USE_COPY YES \
         -nlt PROMOTE_TO_MULTI \
         -nln {table_name} \
@@ -138,28 +309,436 @@ def _import_gpkg(pg_con, gpkg, table_name, target_gpkg_table, update=False):
         return cmd
     else:
         cmd = template_create.format(pg_con=pg_con, table_name=table_name,
-                            gpkg=gpkg, target_gpkg_table=target_gpkg_table)
+                            gpkg=gpkg, target_gpkg_table=target_gpkg_table,
+                            unlogged='-lco UNLOGGED=YES -lco SPATIAL_INDEX=NONE' if unlogged else '')
 
         return cmd
 
 
-def import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=False):
-    """Execute ogr2ogr commands importing all tables from geopackage with renamed tables
+@dataclass
+class ImportResult:
+    """Outcome of importing a single geopackage table into postgres"""
+    pg_table: str
+    gpkg_table: str
+    returncode: int
+    stderr: str
+    seconds: float
+    rows: int = None
+    skipped: bool = False
+    gpkg: Path = None
+    stages: dict = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def rows_per_second(self):
+        if self.rows is None or not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+
+class Ogr2OgrEngine:
+    """Import tables by shelling out to ogr2ogr, one process per table"""
+
+    def __init__(self, pg_con, update=False, unlogged=False):
+        self.pg_con = pg_con
+        self.update = update
+        self.unlogged = unlogged
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        """Import a single geopackage table
+
+        Returns:
+            int, str, None: exit code, stderr, rows loaded (not known)
+        """
+        cmd = _import_gpkg(self.pg_con, catalog.gpkg, pg_table_name, gpkg_table, update=self.update, unlogged=self.unlogged)
+        try:
+            proc = sp.run(shlex.split(cmd), capture_output=True, text=True)  # split preserving quoted strings
+        except OSError as err:
+            # ogr2ogr missing from PATH etc.
+            return 127, str(err), None
+
+        return proc.returncode, proc.stderr, None
+
+
+class VectorTranslateEngine:
+    """Import tables in-process with gdal.VectorTranslate, using the same options as the ogr2ogr command string.
+
+    The source geopackage and destination postgres datasets are opened once and reused for every table.
+    GDAL datasets are not thread safe, so each worker thread keeps its own pair.
+    """
+
+    def __init__(self, pg_con, update=False, unlogged=False):
+        from osgeo import gdal
+
+        self.gdal = gdal
+        self.pg_con = pg_con
+        self.update = update
+        self.unlogged = unlogged
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _datasets(self, gpkg):
+        # thread local attributes are invisible from other threads, keep each thread's datasets in a
+        # dict registered with the engine so close() can release them
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            state = self._local.state = {'dst': None, 'sources': {}}
+            with self._lock:
+                self._opened.append(state)
+
+        if state['dst'] is None:
+            state['dst'] = self.gdal.OpenEx('PG:' + self.pg_con, self.gdal.OF_VECTOR | self.gdal.OF_UPDATE)
+
+        if gpkg not in state['sources']:
+            state['sources'][gpkg] = self.gdal.OpenEx(str(gpkg), self.gdal.OF_VECTOR | self.gdal.OF_READONLY)
+
+        return state['sources'][gpkg], state['dst']
+
+    def _options(self, pg_table_name, gpkg_table):
+        # ogr2ogr -nln receives the name with shell quotes already stripped
+        layer_name = pg_table_name.replace('"', '')
+        if self.update:
+            return self.gdal.VectorTranslateOptions(accessMode='append', layers=[gpkg_table],
+                layerName=layer_name, geometryType='PROMOTE_TO_MULTI')
+        else:
+            lco = ['OVERWRITE=YES']
+            if self.unlogged:
+                lco += ['UNLOGGED=YES', 'SPATIAL_INDEX=NONE']
+            return self.gdal.VectorTranslateOptions(accessMode='overwrite', layers=[gpkg_table],
+                layerName=layer_name, geometryType='PROMOTE_TO_MULTI', layerCreationOptions=lco)
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        """Import a single geopackage table
+
+        Returns:
+            int, str, None: 0 on success else 1, collected GDAL error messages, rows loaded (not known)
+        """
+        gdal = self.gdal
+        messages = []
+
+        def _handler(err_class, err_no, msg):
+            if err_class >= gdal.CE_Warning:
+                messages.append(msg)
+
+        gdal.SetThreadLocalConfigOption('PG_USE_COPY', 'YES')
+        gdal.SetThreadLocalConfigOption('OGR_TRUNCATE', 'YES' if self.update else None)
+        gdal.PushErrorHandler(_handler)
+        try:
+            src, dst = self._datasets(catalog.gpkg)
+            if src is None or dst is None:
+                return 1, '\n'.join(messages), None
+
+            ret = gdal.VectorTranslate(dst, src, options=self._options(pg_table_name, gpkg_table))
+            # end the COPY for this layer before moving on to the next table
+            dst.FlushCache()
+        except RuntimeError as err:
+            messages.append(str(err))
+            ret = None
+        finally:
+            gdal.PopErrorHandler()
+
+        if ret is None:
+            # a failed load can leave the connection in an aborted transaction, the next table opens a new one
+            self._local.state['dst'] = None
+
+        return (0 if ret is not None else 1), '\n'.join(messages), None
+
+    def close(self):
+        with self._lock:
+            for state in self._opened:
+                state['sources'] = {}
+                state['dst'] = None
+            self._opened = []
+
+
+class CopyEngine:
+    """Load attribute-only tables natively, reading them with sqlite3 and streaming them into postgres with a
+    binary COPY. Tables with geometry, or with column types the binary loader does not handle, go through ogr2ogr.
+
+    Postgres connections are borrowed from the pool of db for each table, each worker thread keeps its own
+    geopackage connections for streaming rows, table metadata comes from the shared GpkgCatalog.
+
+    With partition_years, monthly and daily tables are created range partitioned on year, see
+    pgcopy.copy_gpkg_table.
+    """
+
+    # temporal classes of tables partitioned on year
+    PARTITIONED_TEMPORAL = ('monthly', 'daily')
+
+    def __init__(self, pg_con, update=False, unlogged=False, batch_size=50000, db=None, partition_years=None,
+                 partition_index='btree'):
+        # a pool shared with the caller is left open on close
+        self._owns_db = db is None
+        self.db = PostgresDB.from_gdal_string(pg_con, verify=False) if db is None else db
+        self.update = update
+        self.unlogged = unlogged
+        self.batch_size = batch_size
+        self.partition_years = partition_years
+        self.partition_index = partition_index
+        self.fallback = Ogr2OgrEngine(pg_con, update=update, unlogged=unlogged)
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _source(self, gpkg):
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            state = self._local.state = {'sources': {}}
+            with self._lock:
+                self._opened.append(state)
+
+        if gpkg not in state['sources']:
+            state['sources'][gpkg] = connect_gpkg(gpkg)
+
+        return state['sources'][gpkg]
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        """Import a single geopackage table
+
+        Returns:
+            int, str, int, dict: 0 on success else 1, error message, rows loaded, seconds per load stage
+        """
+        timings = {}
+        try:
+            columns = None if catalog.has_geometry(gpkg_table) else gpkg_copy_columns(catalog.columns(gpkg_table))
+            if columns is None:
+                return self.fallback.import_table(catalog, pg_table_name, gpkg_table)
+
+            partition_years = self.partition_years if classify_temporal(gpkg_table) in self.PARTITIONED_TEMPORAL else None
+            years = catalog.year_span(gpkg_table) if partition_years else None
+            with self.db.connection() as pg_conn:
+                rows, _ = copy_gpkg_table(pg_conn, self._source(catalog.gpkg), gpkg_table, pg_table_name, columns,
+                                          update=self.update, unlogged=self.unlogged, batch_size=self.batch_size,
+                                          timings=timings, partition_years=partition_years,
+                                          partition_index=self.partition_index, years=years)
+        except (PostgresError, sqlite3.Error, struct.error) as err:
+            return 1, str(err), None, timings
+
+        return 0, '', rows, timings
+
+    def close(self):
+        with self._lock:
+            for state in self._opened:
+                for conn in state['sources'].values():
+                    conn.close()
+                state['sources'] = {}
+            self._opened = []
+        if self._owns_db:
+            self.db.close()
+
+
+class StagingSwapEngine:
+    """Wrap an import engine so each table is loaded into an UNLOGGED staging table, without spatial index,
+    then made durable, indexed, analyzed and swapped in place of the live table in one transaction.
+    Readers keep seeing the old table until the swap commits. With logged=False tables are swapped in
+    UNLOGGED, skipping the rewrite of SET LOGGED but lost on a crash (see staging.finalize_staging).
+    """
+
+    def __init__(self, engine, pg_con, db=None, logged=True):
+        self.engine = engine
+        self.logged = logged
+        self._owns_db = db is None
+        self.db = PostgresDB.from_gdal_string(pg_con, verify=False) if db is None else db
+
+    def __enter__(self):
+        self.engine.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self._owns_db:
+            self.db.close()
+        return self.engine.__exit__(*exc)
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        """Import a single geopackage table through a staging table
+
+        Returns:
+            int, str, int, dict: exit code, stderr, rows loaded as reported by the wrapped engine, seconds per stage
+        """
+        staging = staging_tablename(pg_table_name)
+        start = time.perf_counter()
+        returncode, stderr, rows, *stages = self.engine.import_table(catalog, staging, gpkg_table)
+        timings = dict(stages[0]) if stages else {'load': time.perf_counter() - start}
+        if returncode != 0:
+            return returncode, stderr, rows, timings
+
+        try:
+            with self.db.connection() as conn:
+                start = time.perf_counter()
+                finalize_staging(conn, staging, logged=self.logged)
+                timings['finalize'] = time.perf_counter() - start
+                start = time.perf_counter()
+                swap_staging(conn, staging, pg_table_name)
+                timings['swap'] = time.perf_counter() - start
+        except PostgresError as err:
+            return 1, 'swapping {} into place failed, staging table kept: {}'.format(staging, err), rows, timings
+
+        return returncode, stderr, rows, timings
+
+
+class DeltaEngine(CopyEngine):
+    """Merge only new or changed periods of model output tables into existing postgres tables, see
+    delta.merge_gpkg_table. Tables which don't exist yet, have geometry, have no sampleid/period key columns
+    or column types the binary loader does not handle are imported in full by the fallback engine.
+    """
+
+    def __init__(self, pg_con, fallback, batch_size=50000, db=None):
+        super().__init__(pg_con, update=True, batch_size=batch_size, db=db)
+        self.fallback = fallback
+
+    def __enter__(self):
+        self.fallback.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return self.fallback.__exit__(*exc)
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        """Merge a single geopackage table
+
+        Returns:
+            int, str, int, dict: 0 on success else 1, error message, rows merged, seconds per merge stage
+        """
+        timings = {}
+        try:
+            columns = None if catalog.has_geometry(gpkg_table) else gpkg_copy_columns(catalog.columns(gpkg_table))
+            keys = None if columns is None else delta_keys(columns)
+            if keys is None:
+                return self.fallback.import_table(catalog, pg_table_name, gpkg_table)
+
+            with self.db.transaction() as cur:
+                cur.execute('SELECT to_regclass(%s)', (pg_table_name,))
+                exists = cur.fetchone()[0] is not None
+            if not exists:
+                return self.fallback.import_table(catalog, pg_table_name, gpkg_table)
+
+            with self.db.connection() as pg_conn:
+                rows, _, _ = merge_gpkg_table(pg_conn, self._source(catalog.gpkg), gpkg_table, pg_table_name, columns,
+                                              keys, batch_size=self.batch_size, timings=timings)
+        except (PostgresError, sqlite3.Error, struct.error) as err:
+            return 1, str(err), None, timings
+
+        return 0, '', rows, timings
+
+
+IMPORT_ENGINES = {'ogr2ogr': Ogr2OgrEngine, 'vectortranslate': VectorTranslateEngine, 'copy': CopyEngine}
+
+
+def _run_import(engine, catalog, pg_table_name, gpkg_table):
+    """Import a single table with engine, capturing exit code, stderr and wall time
 
     Args:
-        pg_con (str): gdal postgres driver connection string, see https://gdal.org/drivers/vector/pg.html
-        gpkg (Path): geopackage file
-        update (bool, optional): try to trunacate then append to table, rather than overwriting by default
-        include_embedded_geography_tables (bool, optional): In the case of a model output geopackage, import embedded geography tables (hydrostn, faogaul..)
-            as well as model tables. There are separate geopackages with just the geography, these are more likely to be up to date. 
+        engine (Ogr2OgrEngine|VectorTranslateEngine|CopyEngine): import engine
+        catalog (GpkgCatalog): catalog of geopackage
+        pg_table_name (str): postgres table name in schema.table form
+        gpkg_table (str): name of table in geopackage being imported
 
     Returns:
-        list: list of newly created/replaced postgres table names in schema.table form
+        ImportResult: per table result
     """
+    start = time.perf_counter()
+    # engines loading tables themselves also report seconds per stage
+    returncode, stderr, rows, *stages = engine.import_table(catalog, pg_table_name, gpkg_table)
+    seconds = time.perf_counter() - start
+    stages = stages[0] if stages else {'load': seconds}
+
+    # engines shelling out to gdal don't report rows, use the count if the catalog already has it rather than
+    # scanning the table again
+    if returncode == 0 and rows is None:
+        rows = catalog.known_row_count(gpkg_table)
 
-    gpkg_meta = extract_gpkg_meta(gpkg)
-    cmds = []
+    return ImportResult(pg_table=pg_table_name, gpkg_table=gpkg_table, returncode=returncode,
+                        stderr=stderr, seconds=seconds, rows=rows, gpkg=catalog.gpkg, stages=stages)
+
+
+def import_report(results, plan=()):
+    """Instrumentation report of an import run, for finding regressions between runs
+
+    Args:
+        results (list): ImportResult of the run
+        plan (list, optional): plan entries from build_import_plan, adds the estimated load time. Defaults to ().
+
+    Returns:
+        dict: {schema: {table: {'ok', 'skipped', 'rows', 'seconds', 'est_seconds', 'stages': {stage: {'seconds'}}}}}
+    """
+    estimates = {p['pg_table']: p['est_seconds'] for p in plan}
+    report = OrderedDict()
+    for r in results:
+        schema, table = split_pg_tablename(r.pg_table)
+        report.setdefault(schema, OrderedDict())[table] = dict(
+            ok=r.ok, skipped=r.skipped, rows=r.rows, seconds=r.seconds, est_seconds=estimates.get(r.pg_table),
+            stages={stage: {'seconds': seconds} for stage, seconds in (r.stages or {}).items()})
+    return report
+
+
+def run_imports(engine, tasks, jobs=1):
+    """Import geopackage tables with engine in a bounded pool of worker threads. Tasks are submitted
+    in the order given, order them largest first to keep the pool busy until the end.
+
+    Args:
+        engine (Ogr2OgrEngine|VectorTranslateEngine|CopyEngine): import engine
+        tasks (list): (GpkgCatalog, postgres table name in schema.table form, geopackage table name) tuples
+        jobs (int, optional): maximum number of concurrent imports. Defaults to 1.
+
+    Returns:
+        list: ImportResult per task, in the same order as tasks
+    """
+    results = [None] * len(tasks)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(_run_import, engine, catalog, pg, gt): i
+                   for i, (catalog, pg, gt) in enumerate(tasks)}
+        for fut in as_completed(futures):
+            res = fut.result()
+            results[futures[fut]] = res
+            if res.ok:
+                status = 'ok {:.1f}s'.format(res.seconds)
+                if res.rows_per_second is not None:
+                    status += ' {} rows {:.0f} rows/s'.format(res.rows, res.rows_per_second)
+            else:
+                status = 'FAILED ({})'.format(res.returncode)
+            print('{} {}'.format(res.pg_table, status))
+
+    return results
+
+
+def gpkg_import_tables(gpkg_meta, include_embedded_geography_tables=False):
+    """Postgres table names for the tables of a geopackage as imported by import_gpkg
+
+    Args:
+        gpkg_meta (dict): geopackage metadata from extract_gpkg_meta
+        include_embedded_geography_tables (bool, optional): In the case of a model output geopackage, include embedded
+            geography tables (hydrostn, faogaul..) as well as model tables. Defaults to False.
+
+    Returns:
+        list, list: postgres table names in schema.table form, geopackage table names
+    """
     postgres_tables = []
+    gpkg_tables = []
 
     def _clean_pg_tablename(t):
         # for some reason hyphens show up as underscores in postgres after the ogr2ogr import
@@ -170,7 +749,8 @@ def import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=Fa
 
         # model output geopackages can/do contain embedded geography tables as well
         # we don't always want to import these as they may be out of date
-        geography_tables, model_tables = group_geography_vs_model(gpkg_meta['tables'])
+        catalog = TableCatalog(gpkg_meta['tables'])
+        geography_tables, model_tables = catalog.geography(), catalog.model()
         for mo in model_tables:
             schema = '"{}"'.format(gpkg_meta['geography'])
 
@@ -180,28 +760,293 @@ def import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=Fa
             pg_table_name = ".".join([schema, table_name])
 
             postgres_tables.append(pg_table_name)
-            cmd = _import_gpkg(pg_con, gpkg, pg_table_name, mo, update=update)
-            cmds.append(cmd)
+            gpkg_tables.append(mo)
         if include_embedded_geography_tables:
             for geo in geography_tables:
                 pg_table_name = '{}."{}_{}"'.format(
                     gpkg_meta['geography'], geo.lower(), gpkg_meta['resolution'])
                 postgres_tables.append(pg_table_name)
-                cmd = _import_gpkg(pg_con, gpkg, pg_table_name, geo, update=update)
-                cmds.append(cmd)
+                gpkg_tables.append(geo)
     else:
         for su in gpkg_meta['tables']:
             pg_table_name = '{}."{}_{}"'.format(
                 gpkg_meta['geography'], su.lower(), gpkg_meta['resolution'])
             postgres_tables.append(pg_table_name)
-            cmd = _import_gpkg(pg_con, gpkg, pg_table_name, su, update=update)
-            cmds.append(cmd)
+            gpkg_tables.append(su)
+
+    return postgres_tables, gpkg_tables
+
 
-    for cmd, pg in zip(cmds, postgres_tables):
-        sp.run(shlex.split(cmd))  # split preserving quoted strings
-        print(pg)
+def is_embedded_geography(gpkg_meta, gpkg_table):
+    """Whether gpkg_table is a geography table (hydrostn, faogaul..) embedded in a model output geopackage
+
+    Args:
+        gpkg_meta (dict): geopackage metadata from extract_gpkg_meta
+        gpkg_table (str): name of table in geopackage
+
+    Returns:
+        bool
+    """
+    return gpkg_meta['is_output'] and TableName.parse(gpkg_table).kind == 'geography'
 
-    return postgres_tables, gpkg_meta
 
+def find_gpkgs(paths):
+    """Expand geopackage files, directories (searched recursively) and glob patterns into geopackage files
 
+    Args:
+        paths (list): Path or str of files, directories or glob patterns ie GPKGresults/*/TerraClimate*/*.gpkg
+
+    Returns:
+        list: absolute Paths of geopackages, without duplicates
+    """
+    found = []
+    for p in paths:
+        p = Path(p).expanduser()
+        if p.is_dir():
+            found += sorted(p.rglob('*.gpkg'))
+        elif p.is_file():
+            found.append(p)
+        else:
+            found += [Path(g) for g in sorted(glob.glob(str(p), recursive=True)) if g.endswith('.gpkg')]
+
+    return list(dict.fromkeys(sanitize_path(g) for g in found))
+
+
+def collect_import_tasks(gpkgs, include_embedded_geography_tables=False, exclude_temporal=()):
+    """Build one work list of tables to import from several geopackages.
+
+    Embedded geography tables repeat across the model output geopackages of a region, only the first copy
+    of each is imported. Later copies are compared by content digest, copies that differ are reported.
+
+    Args:
+        gpkgs (list): geopackage files
+        include_embedded_geography_tables (bool, optional): In the case of a model output geopackage, include embedded
+            geography tables (hydrostn, faogaul..) as well as model tables. Defaults to False.
+        exclude_temporal (tuple, optional): temporal classes ('annual', 'monthly', 'daily') of tables to leave out.
+
+    Returns:
+        list, dict: (GpkgCatalog, postgres table name in schema.table form, geopackage table name) tuples,
+            {gpkg: geopackage metadata}. The caller closes the catalog of each geopackage metadata.
+    """
+    gpkg_metas = {}
+    tasks = []
+    scheduled = {}
+    catalogs = []
+    try:
+        for gpkg in gpkgs:
+            catalogs.append(GpkgCatalog(gpkg))
+            gpkg_meta = extract_gpkg_meta(gpkg, catalog=catalogs[-1])
+            gpkg_metas[gpkg] = gpkg_meta
+            for pg, gt in zip(*gpkg_import_tables(gpkg_meta, include_embedded_geography_tables)):
+                if classify_temporal(gt) in exclude_temporal:
+                    continue
+                if pg in scheduled:
+                    first_catalog, first_gt = scheduled[pg]
+                    if is_embedded_geography(gpkg_meta, gt) and \
+                            first_catalog.content_digest(first_gt) != gpkg_meta['catalog'].content_digest(gt):
+                        print('{} in {} differs from the copy in {}, not imported'.format(pg, gpkg, first_catalog.gpkg))
+                    else:
+                        print('{} already imported from {}, ignoring copy in {}'.format(pg, first_catalog.gpkg, gpkg))
+                    continue
+                scheduled[pg] = (gpkg_meta['catalog'], gt)
+                tasks.append((gpkg_meta['catalog'], pg, gt))
+    except BaseException:
+        for catalog in catalogs:
+            catalog.close()
+        raise
+
+    return tasks, gpkg_metas
+
+
+def import_gpkgs(pg_con, gpkgs, update=False, include_embedded_geography_tables=False, jobs=1, engine='ogr2ogr',
+                 incremental=False, manifest_table=MANIFEST_TABLE, exclude_temporal=(), throughput_file=THROUGHPUT_FILE,
+                 swap=False, delta=False, report_file=None, partition_years=None, partition_index='btree',
+                 swap_logged=True):
+    """Import all tables from several geopackages with renamed tables. Tables from every geopackage are
+    scheduled together, largest first according to the import plan, over one pool of workers sharing one
+    import engine. The geometry tiers of reloaded geography tables are refreshed, see geomtier.refresh_geometry_tiers.
+    Overwriting imports (neither update, delta nor swap) drop geography tables along with their tiers, which are
+    prepared again once the table is reloaded and can't be served in between. Tiers which can't be prepared again
+    fail the import of their table. Reload tiered geography with swap or update to keep them served.
+
+    Args:
+        pg_con (str): gdal postgres driver connection string, see https://gdal.org/drivers/vector/pg.html
+        gpkgs (list): geopackage files
+        update (bool, optional): try to trunacate then append to table, rather than overwriting by default
+        include_embedded_geography_tables (bool, optional): In the case of a model output geopackage, import embedded geography tables (hydrostn, faogaul..)
+            as well as model tables. There are separate geopackages with just the geography, these are more likely to be up to date. 
+            Each distinct copy is imported once: copies identical to the loaded table (by full content digest, recorded
+            in the manifest) are skipped, copies that differ are not imported and reported as failed.
+        jobs (int, optional): number of tables to import concurrently. Defaults to 1.
+        engine (str, optional): one of IMPORT_ENGINES, 'ogr2ogr' runs an ogr2ogr process per table,
+            'vectortranslate' runs gdal.VectorTranslate in-process, 'copy' loads attribute-only tables with a
+            binary COPY and uses ogr2ogr for tables with geometry. Defaults to 'ogr2ogr'.
+        incremental (bool, optional): skip tables whose fingerprint matches the import manifest kept in postgres,
+            recording fingerprints of imported tables. Defaults to False.
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+        exclude_temporal (tuple, optional): temporal classes ('annual', 'monthly', 'daily') of tables to leave out.
+        throughput_file (Path, optional): throughput history used for the plan and updated after the run,
+            None to leave it alone. Defaults to THROUGHPUT_FILE.
+        swap (bool, optional): load each table into an UNLOGGED staging table and atomically swap it in place
+            of the live table once indexed and analyzed. Can't be combined with update. Defaults to False.
+        delta (bool, optional): merge only the years/months/days which are new or changed into existing model
+            output tables, see DeltaEngine. Other tables are updated in full with engine. Defaults to False.
+        report_file (Path, optional): write a json report of seconds per table and load stage against the plan
+            estimates, see import_report. Defaults to None.
+        partition_years (int, optional): with the copy engine, create monthly and daily tables range partitioned
+            on year, partition_years years per partition. Defaults to None.
+        partition_index (str, optional): 'btree' or 'brin', index on (sampleid, year) of partitioned tables.
+            Defaults to 'btree'.
+        swap_logged (bool, optional): with swap, SET LOGGED staging tables before swapping them in, see
+            staging.finalize_staging. False keeps swapped tables UNLOGGED. Defaults to True.
+
+    Returns:
+        list, dict: ImportResult for each table (postgres table names in schema.table form), {gpkg: geopackage metadata}
+    """
+    if swap and (update or delta):
+        raise ValueError("swap imports always replace tables, they can't be combined with update or delta")
+    if partition_years and engine != 'copy':
+        raise ValueError("partitioned tables are only created by the copy engine")
+
+    tasks, gpkg_metas = collect_import_tasks(gpkgs, include_embedded_geography_tables, exclude_temporal)
+
+    # one pool shared by the manifest steps and the engines, a connection per worker
+    db = PostgresDB.from_gdal_string(pg_con, verify=False, maxconn=max(1, jobs))
+    digests = {}
+    entries = {}
+    skipped = {}
+    conflicts = {}
+    try:
+        if include_embedded_geography_tables:
+            digests = {pg: catalog.content_digest(gt) for catalog, pg, gt in tasks
+                       if is_embedded_geography(gpkg_metas[catalog.gpkg], gt)}
+
+        if incremental:
+            with db.connection() as conn:
+                for gpkg_meta in gpkg_metas.values():
+                    catalog = gpkg_meta['catalog']
+                    gpkg_tasks = [t for t in tasks if t[0] is catalog]
+                    gpkg_entries, gpkg_unchanged = plan_incremental(conn, catalog, [t[1] for t in gpkg_tasks],
+                        [t[2] for t in gpkg_tasks], manifest_table=manifest_table)
+                    entries.update(gpkg_entries)
+                    skipped.update((pg, 'unchanged') for pg in gpkg_unchanged)
+
+        if digests:
+            with db.connection() as conn:
+                identical, conflicts = compare_digests(conn, digests, manifest_table=manifest_table)
+            skipped.update((pg, 'identical to loaded geography') for pg in identical)
+            for pg, prev in conflicts.items():
+                skipped[pg] = 'differs from geography loaded from {}, not overwritten'.format(prev['gpkg_path'])
+
+        todo = {t[1]: t for t in tasks if t[1] not in skipped}
+        throughput = load_throughput(throughput_file) if throughput_file is not None else None
+        plan = build_import_plan(todo.values(), engine=engine, throughput=throughput,
+                                 row_counts={pg: e['row_count'] for pg, e in entries.items()})
+        engine_options = {'db': db, 'partition_years': partition_years, 'partition_index': partition_index} \
+            if engine == 'copy' else {}
+        import_engine = IMPORT_ENGINES[engine](pg_con, update=update or delta, unlogged=swap, **engine_options)
+        if swap:
+            import_engine = StagingSwapEngine(import_engine, pg_con, db=db, logged=swap_logged)
+        elif delta:
+            import_engine = DeltaEngine(pg_con, import_engine, db=db)
+        # an overwriting import drops geography tables with CASCADE, taking their tiers along
+        overwrite = not (swap or update or delta)
+        tiered = tiered_geography(db, list(todo)) if overwrite else {}
+        with import_engine:
+            imported = {r.pg_table: r for r in run_imports(import_engine, [todo[p['pg_table']] for p in plan], jobs=jobs)}
+
+        # overwritten tables lost their materialized views, swapped in tables come with them rebuilt, tables
+        # loaded in place leave them stale
+        if overwrite:
+            for pg, targets in tiered.items():
+                result = imported[pg]
+                if not result.ok:
+                    print('{} failed, its geometry tiers may be gone: {}'.format(pg, ', '.join(
+                        '{}.{}'.format(*t) for t in targets)))
+                    continue
+                try:
+                    for view in prepare_geometry_tiers(db, targets):
+                        print('{} recreated'.format(view))
+                except PostgresError as err:
+                    result.returncode = 1
+                    result.stderr = 'geometry tiers dropped by the overwrite could not be prepared again: {}'.format(err)
+        elif not swap:
+            for view in refresh_geometry_tiers(db, [pg for pg, r in imported.items() if r.ok]):
+                print('{} refreshed'.format(view))
+
+        results = []
+        for catalog, pg, gt in tasks:
+            if pg in imported:
+                results.append(imported[pg])
+            else:
+                print('{} skipped ({})'.format(pg, skipped[pg]))
+                rows = entries[pg]['row_count'] if pg in entries else None
+                # a conflicting geography copy is neither loaded nor what is loaded, it fails the import
+                results.append(ImportResult(pg_table=pg, gpkg_table=gt, returncode=1 if pg in conflicts else 0,
+                                            stderr=skipped[pg], seconds=0.0, rows=rows, skipped=True, gpkg=catalog.gpkg))
+
+        if incremental or digests:
+            # unchanged tables are recorded too, refreshing their mtime so the next run skips them without hashing.
+            # geography which differs from the loaded copy keeps the entry of the loaded copy
+            manifest_entries = []
+            for r in results:
+                if not r.ok:
+                    continue
+                elif r.pg_table in entries:
+                    entry = entries[r.pg_table]
+                elif r.pg_table in digests:
+                    # counted by the digest scan, the table isn't read again
+                    catalog = gpkg_metas[r.gpkg]['catalog']
+                    entry = manifest_entry(catalog, r.pg_table, r.gpkg_table, content_digest=digests[r.pg_table],
+                                           row_count=catalog.known_row_count(r.gpkg_table))
+                else:
+                    continue
+                if r.pg_table in digests:
+                    entry['content_digest'] = digests[r.pg_table]
+                manifest_entries.append(entry)
+            with db.connection() as conn:
+                record_manifest(conn, manifest_entries, manifest_table=manifest_table)
+
+        # merged periods say nothing about full table throughput
+        if throughput_file is not None and not delta:
+            record_throughput(results, plan, engine, path=throughput_file)
+
+        if report_file is not None:
+            with open(report_file, 'w') as f:
+                json.dump(import_report(results, plan), f, indent=2)
+    finally:
+        db.close()
+        for gpkg_meta in gpkg_metas.values():
+            gpkg_meta['catalog'].close()
+
+    return results, gpkg_metas
+
+
+def import_gpkg(pg_con, gpkg, update=False, include_embedded_geography_tables=False, jobs=1, engine='ogr2ogr',
+                incremental=False, manifest_table=MANIFEST_TABLE, swap=False, delta=False):
+    """Import all tables from geopackage with renamed tables
+
+    Args:
+        pg_con (str): gdal postgres driver connection string, see https://gdal.org/drivers/vector/pg.html
+        gpkg (Path): geopackage file
+        update (bool, optional): try to trunacate then append to table, rather than overwriting by default
+        include_embedded_geography_tables (bool, optional): In the case of a model output geopackage, import embedded geography tables (hydrostn, faogaul..)
+            as well as model tables. There are separate geopackages with just the geography, these are more likely to be up to date. 
+            Each distinct copy is imported once: copies identical to the loaded table (by full content digest, recorded
+            in the manifest) are skipped, copies that differ are not imported and reported as failed.
+        jobs (int, optional): number of tables to import concurrently. Defaults to 1.
+        engine (str, optional): one of IMPORT_ENGINES, see import_gpkgs. Defaults to 'ogr2ogr'.
+        incremental (bool, optional): skip tables whose fingerprint matches the import manifest kept in postgres,
+            recording fingerprints of imported tables. Defaults to False.
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+        swap (bool, optional): load through staging tables swapped in atomically, see import_gpkgs. Defaults to False.
+        delta (bool, optional): merge only new or changed periods of model tables, see import_gpkgs. Defaults to False.
+
+    Returns:
+        list, dict: ImportResult for each table (postgres table names in schema.table form), geopackage metadata
+    """
+    results, gpkg_metas = import_gpkgs(pg_con, [gpkg], update=update,
+        include_embedded_geography_tables=include_embedded_geography_tables, jobs=jobs, engine=engine,
+        incremental=incremental, manifest_table=manifest_table, swap=swap, delta=delta)
 
+    return results, gpkg_metas[gpkg]
@@ -0,0 +1,270 @@
+"""Import manifest kept in postgres, fingerprinting geopackage tables for incremental imports"""
+
+import hashlib
+
+from psycopg2 import sql
+
+from .pgcopy import GPKG_COLUMN_TYPES, launder
+from .util import split_pg_tablename
+
+MANIFEST_TABLE = 'public.gpkg_import_manifest'
+
+MANIFEST_COLUMNS = ('pg_table', 'gpkg_path', 'gpkg_table', 'gpkg_mtime', 'gpkg_size', 'row_count', 'content_hash',
+                    'content_digest', 'year_min', 'year_max')
+
+
+def _manifest_identifier(manifest_table):
+    return sql.Identifier(*split_pg_tablename(manifest_table))
+
+
+def ensure_manifest(conn, manifest_table=MANIFEST_TABLE):
+    """Create manifest table if it doesn't exist
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+    """
+    create = sql.SQL("""CREATE TABLE IF NOT EXISTS {} (
+        pg_table text PRIMARY KEY,
+        gpkg_path text NOT NULL,
+        gpkg_table text NOT NULL,
+        gpkg_mtime double precision NOT NULL,
+        gpkg_size bigint NOT NULL,
+        row_count bigint NOT NULL,
+        content_hash text NOT NULL,
+        content_digest text,
+        year_min integer,
+        year_max integer,
+        imported_at timestamptz NOT NULL DEFAULT now()
+    )""").format(_manifest_identifier(manifest_table))
+    # manifests created before full content digests and year spans were tracked
+    upgrade = sql.SQL("""ALTER TABLE {} ADD COLUMN IF NOT EXISTS content_digest text,
+        ADD COLUMN IF NOT EXISTS year_min integer, ADD COLUMN IF NOT EXISTS year_max integer""").format(
+        _manifest_identifier(manifest_table))
+
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(create)
+            cur.execute(upgrade)
+
+
+def fetch_manifest(conn, pg_tables, manifest_table=MANIFEST_TABLE):
+    """Read manifest entries for tables that still exist in the database
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        pg_tables (list): postgres table names in schema.table form
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+
+    Returns:
+        dict: {pg_table: {column: value}}
+    """
+    # matched on pg_class rather than to_regclass(pg_table), stored names may be unquoted ("se-asia" or mixed
+    # case) and to_regclass would downcase or reject them
+    query = sql.SQL("""SELECT {columns} FROM {manifest} m
+        INNER JOIN unnest(%s::text[], %s::text[], %s::text[]) AS t(pg_table, nspname, relname) ON m.pg_table = t.pg_table
+        INNER JOIN pg_namespace n ON n.nspname = t.nspname
+        INNER JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = t.relname""").format(
+        columns=sql.SQL(', ').join(sql.Identifier('m', c) for c in MANIFEST_COLUMNS),
+        manifest=_manifest_identifier(manifest_table))
+
+    pg_tables = list(pg_tables)
+    names = [split_pg_tablename(t) for t in pg_tables]
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (pg_tables, [n[0] for n in names], [n[1] for n in names]))
+            return {row[0]: dict(zip(MANIFEST_COLUMNS, row)) for row in cur.fetchall()}
+
+
+def record_manifest(conn, entries, manifest_table=MANIFEST_TABLE):
+    """Insert or replace manifest entries
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        entries (list): dicts with MANIFEST_COLUMNS keys
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+    """
+    columns = list(MANIFEST_COLUMNS)
+    upsert = sql.SQL("""INSERT INTO {manifest} ({columns}) VALUES ({values})
+        ON CONFLICT (pg_table) DO UPDATE SET {updates}, imported_at = now()""").format(
+        manifest=_manifest_identifier(manifest_table),
+        columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        values=sql.SQL(', ').join(sql.Placeholder(c) for c in columns),
+        updates=sql.SQL(', ').join(sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(c)) for c in columns[1:]))
+
+    with conn:
+        with conn.cursor() as cur:
+            for e in entries:
+                cur.execute(upsert, e)
+
+
+def gpkg_file_stat(gpkg):
+    """mtime and size of geopackage file
+
+    Args:
+        gpkg (Path): geopackage file
+
+    Returns:
+        float, int: mtime, size in bytes
+    """
+    st = gpkg.stat()
+    return st.st_mtime, st.st_size
+
+
+def table_stats(catalog, gpkg_table):
+    """Cheap content fingerprint of a geopackage table computed by sqlite in a single scan: the row count,
+    max rowid, sum of every numeric column and total length of every text/blob column, each also weighted by
+    rowid so values moved between rows change it. The span of the year column, if any, comes from the same scan.
+
+    Args:
+        catalog (GpkgCatalog): catalog of geopackage
+        gpkg_table (str): name of table in geopackage
+
+    Returns:
+        dict: row_count, content_hash (md5 hex digest of the aggregates), year_min and year_max (None without
+            a year column or rows)
+    """
+    aggregates = ['count(*)', 'max(rowid)']
+    year_column = None
+    for _, name, decl_type, _, _, _ in catalog.columns(gpkg_table):
+        base_type = decl_type.upper().split('(')[0].strip()
+        if GPKG_COLUMN_TYPES.get(base_type, (None, None))[1] is not None:
+            aggregates += ['total("{}")'.format(name), 'total("{}" * rowid)'.format(name)]
+        else:
+            # text, blobs and geometry
+            aggregates += ['total(length("{}"))'.format(name), 'total(length("{}") * rowid)'.format(name)]
+        if launder(name) == 'year':
+            year_column = name
+
+    years = ['min("{0}")'.format(year_column), 'max("{0}")'.format(year_column)] if year_column else ['NULL', 'NULL']
+    row = catalog.conn.execute('SELECT {} FROM "{}"'.format(', '.join(aggregates + years), gpkg_table)).fetchone()
+    return dict(row_count=row[0], content_hash=hashlib.md5(repr(row[:-2]).encode()).hexdigest(),
+                year_min=row[-2], year_max=row[-1])
+
+
+def table_digest(catalog, gpkg_table, batch_size=10000, count=False):
+    """Full content digest of a geopackage table: md5 over the column names and every row, geometry blobs
+    included, in rowid order. Unlike the content hash of table_stats this reads the whole table, it is meant for
+    geography tables that need to be compared exactly across geopackages.
+
+    Args:
+        catalog (GpkgCatalog): catalog of geopackage
+        gpkg_table (str): name of table in geopackage
+        batch_size (int, optional): rows fetched from sqlite per batch. Defaults to 10000.
+        count (bool, optional): return the number of rows read as well. Defaults to False.
+
+    Returns:
+        str: md5 hex digest, or md5 hex digest, row count if count
+    """
+    digest = hashlib.md5(repr([c[1:3] for c in catalog.columns(gpkg_table)]).encode())
+    cur = catalog.conn.execute('SELECT * FROM "{}" ORDER BY rowid'.format(gpkg_table))
+    rows = 0
+    batch = cur.fetchmany(batch_size)
+    while batch:
+        for row in batch:
+            digest.update(repr(row).encode())
+        rows += len(batch)
+        batch = cur.fetchmany(batch_size)
+    return (digest.hexdigest(), rows) if count else digest.hexdigest()
+
+
+def manifest_entry(catalog, pg_table, gpkg_table, content_digest=None, row_count=None):
+    """Manifest entry of a geopackage table as it is now
+
+    Args:
+        catalog (GpkgCatalog): catalog of geopackage
+        pg_table (str): postgres table name in schema.table form
+        gpkg_table (str): name of table in geopackage
+        content_digest (str, optional): full content digest from table_digest. Defaults to None.
+        row_count (int, optional): row count read along with content_digest. Given both, the digest stands in
+            for the content hash and the table isn't scanned for table_stats. Defaults to None.
+
+    Returns:
+        dict: entry with MANIFEST_COLUMNS keys
+    """
+    mtime, size = gpkg_file_stat(catalog.gpkg)
+    entry = dict(pg_table=pg_table, gpkg_path=str(catalog.gpkg), gpkg_table=gpkg_table, gpkg_mtime=mtime,
+                 gpkg_size=size, content_digest=content_digest)
+    if content_digest is not None and row_count is not None:
+        year_min, year_max = catalog.year_span(gpkg_table)
+        entry.update(row_count=row_count, content_hash=content_digest, year_min=year_min, year_max=year_max)
+    else:
+        entry.update(catalog.stats(gpkg_table))
+    return entry
+
+
+def compare_digests(conn, digests, manifest_table=MANIFEST_TABLE):
+    """Compare full content digests of tables about to be imported with the digests recorded when they were
+    last loaded. Tables without a recorded digest are neither identical nor differing.
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        digests (dict): {pg_table: content digest from table_digest}
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+
+    Returns:
+        list, dict: pg_tables identical to what is loaded, {pg_table: manifest entry} of tables which differ
+    """
+    ensure_manifest(conn, manifest_table=manifest_table)
+    existing = fetch_manifest(conn, list(digests), manifest_table=manifest_table)
+
+    identical = []
+    differing = {}
+    for pg_table, digest in digests.items():
+        prev = existing.get(pg_table)
+        if prev is None or prev['content_digest'] is None:
+            continue
+        if prev['content_digest'] == digest:
+            identical.append(pg_table)
+        else:
+            differing[pg_table] = prev
+
+    return identical, differing
+
+
+def plan_incremental(conn, catalog, pg_tables, gpkg_tables, manifest_table=MANIFEST_TABLE):
+    """Compare geopackage tables against the manifest, returning which tables need importing.
+
+    Tables are unchanged if the geopackage file mtime and size match the manifest, or failing that,
+    if the row count and content hash of the table match.
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        catalog (GpkgCatalog): catalog of geopackage
+        pg_tables (list): postgres table names in schema.table form
+        gpkg_tables (list): geopackage table names, one per postgres table
+        manifest_table (str, optional): manifest table in schema.table form. Defaults to MANIFEST_TABLE.
+
+    Returns:
+        dict, list: {pg_table: manifest entry} for every table, pg_tables which are unchanged
+    """
+    ensure_manifest(conn, manifest_table=manifest_table)
+    existing = fetch_manifest(conn, pg_tables, manifest_table=manifest_table)
+    gpkg = catalog.gpkg
+    mtime, size = gpkg_file_stat(gpkg)
+
+    entries = {}
+    unchanged = []
+    for pg_table, gpkg_table in zip(pg_tables, gpkg_tables):
+        prev = existing.get(pg_table)
+        entry = dict(pg_table=pg_table, gpkg_path=str(gpkg), gpkg_table=gpkg_table, gpkg_mtime=mtime, gpkg_size=size,
+                     content_digest=None)
+
+        if prev is not None and (prev['gpkg_path'], prev['gpkg_table'], prev['gpkg_mtime'], prev['gpkg_size']) == \
+                (str(gpkg), gpkg_table, mtime, size):
+            entry.update(row_count=prev['row_count'], content_hash=prev['content_hash'],
+                         content_digest=prev['content_digest'], year_min=prev['year_min'], year_max=prev['year_max'])
+            if entry['year_min'] is None and any(launder(c[1]) == 'year' for c in catalog.columns(gpkg_table)):
+                # recorded before year spans were tracked
+                year_min, year_max = catalog.year_span(gpkg_table)
+                entry.update(year_min=year_min, year_max=year_max)
+            unchanged.append(pg_table)
+        else:
+            entry.update(catalog.stats(gpkg_table))
+            if prev is not None and (prev['gpkg_table'], prev['row_count'], prev['content_hash']) == \
+                    (gpkg_table, entry['row_count'], entry['content_hash']):
+                unchanged.append(pg_table)
+
+        entries[pg_table] = entry
+
+    return entries, unchanged
@@ -0,0 +1,426 @@
+"""Pivot tables built client side with numpy, straight from model output geopackages.
+
+The annual and monthly tables of each temporal group are read from the geopackage into (sampleid, year, month)
+arrays, encoded as binary COPY rows of the composite pivot columns and loaded into postgres. The annual and
+monthly tables never go to postgres, and the database does no aggregation. The pivot tables have the same
+layouts as the ones built by sqlgen, so the same yearly views serve them.
+
+numpy is an optional dependency (pip install ghaaspy[numpy]), it is only imported when pivots are built.
+"""
+
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from psycopg2 import Error as PostgresError
+
+from .gpkg import GpkgCatalog, extract_gpkg_meta, gpkg_import_tables
+from .pgcopy import COPY_HEADER, COPY_TRAILER, launder
+from .pivot import PivotResult
+from .sqlgen import GROUP1, PIVOT_LAYOUTS, DAILY_PIVOT_VALUES, COMPOSITE_TYPES, pivot_year_column, \
+    group1_create_yearly_views, group2_create_yearly_views
+from .tablename import TableCatalog
+
+# postgres float4/float8 oids -> big endian numpy type
+FLOAT_OIDS = {700: '>f4', 701: '>f8'}
+
+# view modes which only read the pivot table
+NUMPY_VIEW_MODES = ('yearly', 'materialized')
+
+COMPOSITE_FIELDS_SQL = """
+SELECT a.attname, a.atttypid, t.typcategory <> 'A', CASE WHEN t.typcategory = 'A' THEN t.typelem ELSE a.atttypid END
+FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+WHERE a.attrelid = (SELECT typrelid FROM pg_type WHERE oid = %s::regtype) AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum
+"""
+
+
+def composite_fields(cur, type_name):
+    """Fields of a pivot composite type, which must be float scalars (annual) and float arrays (monthly)
+
+    Args:
+        cur (psycopg2.extensions.cursor): postgres cursor, with the search_path of the pivot schema
+        type_name (str): composite type name, see COMPOSITE_TYPES
+
+    Returns:
+        int, list: oid of the type, (name, type oid, element oid or None for scalars, numpy format) per field
+    """
+    cur.execute('SELECT %s::regtype::oid', (type_name,))
+    type_oid = cur.fetchone()[0]
+    cur.execute(COMPOSITE_FIELDS_SQL, (type_name,))
+    fields = []
+    for name, oid, scalar, value_oid in cur.fetchall():
+        if value_oid not in FLOAT_OIDS:
+            raise ValueError("{}.{} is not a float or float array, can't be built with numpy".format(type_name, name))
+        fields.append((name, oid, None if scalar else value_oid, FLOAT_OIDS[value_oid]))
+    return type_oid, fields
+
+
+def _field_source(name, values):
+    """('annual'|'monthly', value column) feeding a composite field ie annual_zonalmean, monthly"""
+    period, _, column = name.partition('_')
+    if period not in ('annual', 'monthly'):
+        raise ValueError("composite field {} is neither annual nor monthly".format(name))
+    return period, values.index(column or values[0])
+
+
+def _read_table(catalog, table, keys, values):
+    """Rows of a geopackage table as a numpy structured array with keys, values (0 for NULL) and NULL flags"""
+    import numpy as np
+
+    names = {launder(c[1]): c[1] for c in catalog.columns(table)}
+    selects = ['"{}"'.format(names[k]) for k in keys]
+    dtype = [(k, 'i8') for k in keys]
+    for i, v in enumerate(values):
+        selects += ['ifnull("{0}", 0)'.format(names[v]), '"{}" IS NULL'.format(names[v])]
+        dtype += [('v{}'.format(i), 'f8'), ('n{}'.format(i), '?')]
+
+    # sized as the rows come in rather than by counting the table first, unless the count is already known
+    count = catalog.known_row_count(table)
+    cursor = catalog.conn.execute('SELECT {} FROM "{}"'.format(', '.join(selects), table))
+    return np.fromiter(cursor, dtype=np.dtype(dtype), count=-1 if count is None else count)
+
+
+def read_temporal_group(gpkg, annual_table, monthly_table, values, year_start=None, year_end=None):
+    """Read the annual and monthly tables of a temporal group into dense arrays indexed by sampleid, year and month.
+
+    Memory is about 13 * 9 bytes per sampleid, year and value column ie 700MB for 100k sampleids over 62 years.
+
+    Args:
+        gpkg (Path): geopackage file
+        annual_table (str): annual table in geopackage
+        monthly_table (str): monthly table in geopackage
+        values (list): laundered value columns ie ['discharge'] or ['zonalmean', 'zonalmin', 'zonalmax']
+        year_start (int, optional): first year, rows before are left out. Defaults to the first year of the data.
+        year_end (int, optional): last year, rows after are left out. Defaults to the last year of the data.
+
+    Returns:
+        dict: sampleids (n,), year_start, year_end, annual (n, years, values), annual_null, monthly
+            (n, years, 12, values), monthly_null (missing months are NULL) and present (n, years): years having
+            both an annual and a monthly row, as the inner join of the sql pivot. None if the tables are empty.
+    """
+    import numpy as np
+
+    with GpkgCatalog(gpkg) as catalog:
+        annual = _read_table(catalog, annual_table, ('sampleid', 'year'), values)
+        monthly = _read_table(catalog, monthly_table, ('sampleid', 'year', 'month'), values)
+    if not len(annual) or not len(monthly):
+        return None
+
+    year_start = int(min(annual['year'].min(), monthly['year'].min())) if year_start is None else year_start
+    year_end = int(max(annual['year'].max(), monthly['year'].max())) if year_end is None else year_end
+    annual = annual[(annual['year'] >= year_start) & (annual['year'] <= year_end)]
+    monthly = monthly[(monthly['year'] >= year_start) & (monthly['year'] <= year_end)
+                      & (monthly['month'] >= 1) & (monthly['month'] <= 12)]
+
+    sampleids = np.union1d(annual['sampleid'], monthly['sampleid'])
+    n, years, k = len(sampleids), year_end - year_start + 1, len(values)
+
+    a_idx = (np.searchsorted(sampleids, annual['sampleid']), annual['year'] - year_start)
+    m_idx = (np.searchsorted(sampleids, monthly['sampleid']), monthly['year'] - year_start, monthly['month'] - 1)
+
+    data = dict(year_start=year_start, year_end=year_end,
+                annual=np.zeros((n, years, k)), annual_null=np.ones((n, years, k), dtype=bool),
+                monthly=np.zeros((n, years, 12, k)), monthly_null=np.ones((n, years, 12, k), dtype=bool))
+    for i in range(k):
+        data['annual'][a_idx + (i,)] = annual['v{}'.format(i)]
+        data['annual_null'][a_idx + (i,)] = annual['n{}'.format(i)]
+        data['monthly'][m_idx + (i,)] = monthly['v{}'.format(i)]
+        data['monthly_null'][m_idx + (i,)] = monthly['n{}'.format(i)]
+
+    has_annual = np.zeros((n, years), dtype=bool)
+    has_annual[a_idx] = True
+    has_monthly = np.zeros((n, years), dtype=bool)
+    has_monthly[m_idx[:2]] = True
+    present = has_annual & has_monthly
+
+    # sampleids without any joined year have no pivot row
+    rows = present.any(axis=1)
+    for name in ('annual', 'annual_null', 'monthly', 'monthly_null'):
+        data[name] = data[name][rows]
+    data['sampleids'] = sampleids[rows]
+    data['present'] = present[rows]
+    return data
+
+
+def _slot_dtype(fields):
+    """Binary COPY encoding of one composite value (a year) with every element present, as a numpy dtype: field
+    length then the record (field count, and oid, length, value of each field, arrays of 12 elements)"""
+    import numpy as np
+
+    spec = [('len', '>i4'), ('nfields', '>i4')]
+    for j, (_, _, elem_oid, fmt) in enumerate(fields):
+        spec += [('oid{}'.format(j), '>i4'), ('len{}'.format(j), '>i4')]
+        if elem_oid is None:
+            spec.append(('v{}'.format(j), fmt))
+        else:
+            spec += [('ndim{}'.format(j), '>i4'), ('flags{}'.format(j), '>i4'), ('elem{}'.format(j), '>i4'),
+                     ('dim{}'.format(j), '>i4'), ('lbound{}'.format(j), '>i4'),
+                     ('el{}'.format(j), [('len', '>i4'), ('v', fmt)], (12,))]
+    return np.dtype(spec)
+
+
+def encode_pivot_rows(data, fields, values, layout='crosstab', type_oid=None, chunk_rows=5000):
+    """Binary COPY rows of a pivot table, chunk_rows sampleids at a time.
+
+    Every year of every sampleid is encoded at full size in one numpy structured array, along with a byte mask
+    dropping the bytes of NULL values and absent years, so a chunk is encoded without a python loop over rows.
+
+    Args:
+        data (dict): arrays from read_temporal_group
+        fields (list): composite fields from composite_fields
+        values (list): value columns data was read with
+        layout (str, optional): one of PIVOT_LAYOUTS. Defaults to 'crosstab'.
+        type_oid (int, optional): oid of the composite type, required by the array layout. Defaults to None.
+        chunk_rows (int, optional): sampleids encoded at once. Defaults to 5000.
+
+    Yields:
+        bytes: encoded rows, without COPY header and trailer
+    """
+    import numpy as np
+
+    slot = _slot_dtype(fields)
+    years = data['present'].shape[1]
+    sources = [_field_source(name, values) for name, _, _, _ in fields]
+
+    if layout == 'array':
+        prefix = np.dtype([('nfields', '>i2'), ('sidlen', '>i4'), ('sampleid', '>i8'), ('len', '>i4'), ('ndim', '>i4'),
+                           ('flags', '>i4'), ('elem', '>i4'), ('dim', '>i4'), ('lbound', '>i4')])
+    else:
+        prefix = np.dtype([('nfields', '>i2'), ('sidlen', '>i4'), ('sampleid', '>i8')])
+
+    for start in range(0, len(data['sampleids']), chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        present = data['present'][rows]
+        n = len(present)
+
+        slots = np.zeros((n, years), dtype=slot)
+        keep = np.ones((n, years, slot.itemsize), dtype=bool)
+        slots['nfields'] = len(fields)
+        for j, ((_, oid, elem_oid, fmt), (period, column)) in enumerate(zip(fields, sources)):
+            size = np.dtype(fmt).itemsize
+            slots['oid{}'.format(j)] = oid
+            if elem_oid is None:
+                null = data[period + '_null'][rows][..., column]
+                slots['v{}'.format(j)] = data[period][rows][..., column]
+                slots['len{}'.format(j)] = np.where(null, -1, size)
+                offset = slot.fields['v{}'.format(j)][1]
+                keep[..., offset:offset + size] &= ~null[..., None]
+            else:
+                null = data[period + '_null'][rows][..., column]
+                elements = slots['el{}'.format(j)]
+                elements['v'] = data[period][rows][..., column]
+                elements['len'] = np.where(null, -1, size)
+                slots['ndim{}'.format(j)] = 1
+                slots['flags{}'.format(j)] = null.any(axis=-1)
+                slots['elem{}'.format(j)] = elem_oid
+                slots['dim{}'.format(j)] = 12
+                slots['lbound{}'.format(j)] = 1
+                slots['len{}'.format(j)] = 20 + 12 * 4 + (~null).sum(axis=-1) * size
+                offset = slot.fields['el{}'.format(j)][1]
+                for m in range(12):
+                    value = offset + m * (4 + size) + 4
+                    keep[..., value:value + size] &= ~null[..., m, None]
+
+        # absent years are NULL, only their length is kept
+        keep[~present, 4:] = False
+        slots['len'] = keep[..., 4:].sum(axis=-1)
+        slots['len'][~present] = -1
+
+        head = np.zeros(n, dtype=prefix)
+        head['sidlen'] = 8
+        head['sampleid'] = data['sampleids'][rows]
+        if layout == 'array':
+            head['nfields'] = 2
+            head['len'] = 20 + keep.reshape(n, -1).sum(axis=1)
+            head['ndim'] = 1
+            head['flags'] = (~present).any(axis=1)
+            head['elem'] = type_oid
+            head['dim'] = years
+            # subscripted by year, as the arrays of sql built pivot tables
+            head['lbound'] = data['year_start']
+        else:
+            head['nfields'] = 1 + years
+
+        encoded = np.concatenate([head.view(np.uint8).reshape(n, -1), slots.view(np.uint8).reshape(n, -1)], axis=1)
+        mask = np.concatenate([np.ones((n, prefix.itemsize), dtype=bool), keep.reshape(n, -1)], axis=1)
+        yield encoded[mask].tobytes()
+
+
+class ChunkStream:
+    """File like object feeding chunks of binary COPY rows to psycopg2 copy_expert, with header and trailer"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray(COPY_HEADER)
+        self._done = False
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buffer += COPY_TRAILER
+                self._done = True
+            else:
+                self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+
+def gpkg_pivot_groups(gpkgs, layout='crosstab', year_start=None, year_end=None):
+    """Temporal groups of model output geopackages which have an annual and a monthly table, pivot tables are named
+    after the postgres tables gpkg2postgis would create
+
+    Args:
+        gpkgs (list): model output geopackage files, geography geopackages are left out
+        layout (str, optional): one of PIVOT_LAYOUTS. Defaults to 'crosstab'.
+        year_start (int, optional): first year, defaults to the first year of each group's data.
+        year_end (int, optional): last year, defaults to the last year of each group's data.
+
+    Returns:
+        list: dicts with gpkg, schema, pivot_table, layout, output, group ('group1'|'group2'), annual and monthly
+            geopackage tables, year_start, year_end and view_names (filled in once executed)
+    """
+    if layout not in PIVOT_LAYOUTS:
+        raise ValueError("unknown pivot layout {}, expected one of {}".format(layout, PIVOT_LAYOUTS))
+
+    groups = []
+    for gpkg in gpkgs:
+        with GpkgCatalog(gpkg) as catalog:
+            gpkg_meta = extract_gpkg_meta(gpkg, catalog=catalog)
+        if not gpkg_meta['is_output']:
+            continue
+
+        pg_tables, gpkg_tables = gpkg_import_tables(gpkg_meta)
+        gpkg_table = dict(zip(pg_tables, gpkg_tables))
+        for (schema, key), temporal_group in TableCatalog(pg_tables).temporal_groups().items():
+            if 'annual' not in temporal_group or 'monthly' not in temporal_group:
+                continue
+            output = temporal_group['annual'].output
+            groups.append(dict(gpkg=gpkg, schema=schema, pivot_table=key + '_pivot', layout=layout,
+                               output=output, group='group1' if output in GROUP1['outputs'] else 'group2',
+                               annual=gpkg_table[temporal_group['annual'].raw],
+                               monthly=gpkg_table[temporal_group['monthly'].raw],
+                               year_start=year_start, year_end=year_end, view_names=[]))
+    return groups
+
+
+def execute_numpy_pivot(db, group, views='yearly', geometry_tiers=False, chunk_rows=5000):
+    """Build the pivot table of a group from its geopackage and load it with a binary COPY, then create its views,
+    in a single transaction on a pooled connection. The previous pivot table and views are replaced (CASCADE).
+
+    Args:
+        db (PostgresDB): database to run on
+        group (dict): group from gpkg_pivot_groups
+        views (str, optional): one of NUMPY_VIEW_MODES. Long views read the annual/monthly tables, which aren't
+            loaded. Defaults to 'yearly'.
+        geometry_tiers (bool, optional): views of polygon units also select the geometry tiers of their geography,
+            see geomtier. Defaults to False.
+        chunk_rows (int, optional): sampleids encoded at once, see encode_pivot_rows. Defaults to 5000.
+
+    Returns:
+        PivotResult: with read, create, copy, primary_key and views stages. The created views are set as the
+            view_names of group.
+    """
+    if views not in NUMPY_VIEW_MODES:
+        raise ValueError("unknown view mode {}, expected one of {}".format(views, NUMPY_VIEW_MODES))
+
+    result = PivotResult(schema=group['schema'], pivot_table=group['pivot_table'], stages=OrderedDict())
+    values = [v.format(output=group['output']) for v in DAILY_PIVOT_VALUES[group['group']]]
+    target = '"{}"."{}"'.format(group['schema'], group['pivot_table'])
+
+    start = time.perf_counter()
+    try:
+        data = read_temporal_group(group['gpkg'], group['annual'], group['monthly'], values,
+                                   year_start=group['year_start'], year_end=group['year_end'])
+    except (KeyError, ValueError) as err:
+        result.error = 'reading {} failed: {}'.format(group['gpkg'], err)
+        return result
+    result.stages['read'] = {'seconds': time.perf_counter() - start}
+    if data is None:
+        result.error = 'no annual or monthly rows'
+        return result
+    years = dict(year_start=data['year_start'], year_end=data['year_end'])
+
+    with db.connection() as conn:
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    stage = time.perf_counter()
+                    cur.execute('SET LOCAL search_path="{}", public'.format(group['schema']))
+                    type_name = COMPOSITE_TYPES[group['group']]
+                    type_oid, fields = composite_fields(cur, type_name)
+                    if group['layout'] == 'array':
+                        columns = '"{}" {}[]'.format(group['output'], type_name)
+                    else:
+                        columns = ', '.join('{} {}'.format(pivot_year_column(group['output'], y), type_name)
+                                            for y in range(data['year_start'], data['year_end'] + 1))
+                    cur.execute('DROP TABLE IF EXISTS {} CASCADE'.format(target))
+                    cur.execute('CREATE TABLE {} (sampleid bigint, {})'.format(target, columns))
+                    result.stages['create'] = {'seconds': time.perf_counter() - stage}
+
+                    stage = time.perf_counter()
+                    stream = ChunkStream(encode_pivot_rows(data, fields, values, layout=group['layout'],
+                                                           type_oid=type_oid, chunk_rows=chunk_rows))
+                    cur.copy_expert('COPY {} FROM STDIN (FORMAT binary)'.format(target), stream, size=1 << 20)
+                    result.stages['copy'] = {'seconds': time.perf_counter() - stage}
+
+                    stage = time.perf_counter()
+                    cur.execute('ALTER TABLE {} ADD PRIMARY KEY (sampleid)'.format(target))
+                    result.stages['primary_key'] = {'seconds': time.perf_counter() - stage}
+                    result.table_seconds = time.perf_counter() - start
+
+                    stage = time.perf_counter()
+                    create_views = group1_create_yearly_views if group['group'] == 'group1' else group2_create_yearly_views
+                    view_sql, view_names = create_views(group['schema'], group['pivot_table'],
+                        layout=group['layout'], materialized=views == 'materialized', geometry_tiers=geometry_tiers,
+                        **years)
+                    cur.execute(view_sql)
+                    group['view_names'] = view_names
+                    result.view_seconds = time.perf_counter() - stage
+                    result.stages['views'] = {'seconds': result.view_seconds}
+        except (PostgresError, ValueError) as err:
+            result.error = str(err).strip()
+
+        # the view sql sets search_path for the session, don't leave it on the pooled connection
+        try:
+            with conn.cursor() as cur:
+                cur.execute('RESET search_path')
+            conn.commit()
+        except PostgresError:
+            pass
+
+    return result
+
+
+def execute_numpy_pivots(db, groups, views='yearly', geometry_tiers=False, jobs=1):
+    """Build the pivot tables and views of groups from gpkg_pivot_groups, jobs groups at a time each on its own
+    connection and transaction, see execute_numpy_pivot. Every running group holds its arrays in memory, see
+    read_temporal_group. A failed group does not stop the others.
+
+    Args:
+        db (PostgresDB): database to run on, its pool should allow jobs connections
+        groups (list): groups from gpkg_pivot_groups
+        views (str, optional): one of NUMPY_VIEW_MODES. Defaults to 'yearly'.
+        geometry_tiers (bool, optional): see execute_numpy_pivot. Defaults to False.
+        jobs (int, optional): number of groups to build concurrently. Defaults to 1.
+
+    Returns:
+        list: PivotResult of each group, in the order of groups
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(execute_numpy_pivot, db, g, views=views, geometry_tiers=geometry_tiers): i for i, g in enumerate(groups)}
+        for future in as_completed(futures):
+            r = future.result()
+            results[futures[future]] = r
+            if r.ok:
+                print('"{}"."{}" ok, table {:.1f}s, views {:.1f}s'.format(r.schema, r.pivot_table, r.table_seconds, r.view_seconds))
+            else:
+                print('"{}"."{}" FAILED'.format(r.schema, r.pivot_table))
+
+    return [results[i] for i in range(len(groups))]
@@ -0,0 +1,298 @@
+"""GDAL-free loading of geopackage attribute tables into postgres with COPY ... FROM STDIN (FORMAT binary)"""
+
+import re
+import struct
+import time
+
+from psycopg2 import sql
+
+from .util import split_pg_tablename, pg_identifier
+
+# PGCOPY signature, flags field, header extension length
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+# geopackage column type -> (postgres type, struct format or None for variable length)
+# postgres types follow what ogr2ogr creates for the same gpkg field types
+GPKG_COLUMN_TYPES = {
+    'BOOLEAN': ('boolean', '?'),
+    'TINYINT': ('smallint', 'h'),
+    'SMALLINT': ('smallint', 'h'),
+    'MEDIUMINT': ('integer', 'i'),
+    'INT': ('bigint', 'q'),
+    'INTEGER': ('bigint', 'q'),
+    'FLOAT': ('real', 'f'),
+    'DOUBLE': ('double precision', 'd'),
+    'REAL': ('double precision', 'd'),
+    'TEXT': ('character varying', None),
+    'BLOB': ('bytea', None),
+}
+
+
+# index types for (sampleid, year) on year partitioned tables
+PARTITION_INDEXES = ('btree', 'brin')
+
+
+def launder(name):
+    """Postgres column name as ogr2ogr would create it with LAUNDER=YES"""
+    return re.sub(r'[^a-z0-9_]', '_', name.lower())
+
+
+def gpkg_copy_columns(table_info):
+    """Map geopackage table columns to postgres columns for a binary COPY
+
+    Args:
+        table_info (list): PRAGMA table_info rows of geopackage table, see GpkgCatalog.columns
+
+    Returns:
+        list: (gpkg column, postgres column, postgres type, struct format) tuples or None if a column type
+            is not supported by the binary loader. The integer primary key is mapped to ogc_fid as with ogr2ogr.
+    """
+    columns = []
+    for _, name, decl_type, _, _, pk in table_info:
+        # TEXT(255) etc.
+        base_type = decl_type.upper().split('(')[0].strip()
+        if base_type not in GPKG_COLUMN_TYPES:
+            return None
+
+        pg_type, fmt = GPKG_COLUMN_TYPES[base_type]
+        if pk and fmt in ('q', 'i'):
+            columns.append((name, 'ogc_fid', 'integer', 'i'))
+        else:
+            columns.append((name, launder(name), pg_type, fmt))
+
+    return columns
+
+
+def _encoder(fmt):
+    if fmt is None:
+        def _encode(v):
+            if not isinstance(v, bytes):
+                v = str(v).encode('utf-8')
+            return struct.pack('>i', len(v)) + v
+    else:
+        field = struct.Struct('>i' + fmt)
+        size = field.size - 4
+
+        def _encode(v):
+            return field.pack(size, v)
+
+    return _encode
+
+
+def year_partition_name(table, start):
+    """Name of the partition of table holding the years from start, '_ydefault' for the default partition"""
+    return pg_identifier(table, '_ydefault' if start is None else '_y{}'.format(start))
+
+
+def create_year_partitions(cur, pg_table_name, first, last, width=1, unlogged=False):
+    """Create the missing partitions of a table range partitioned on year, covering first to last in ranges of
+    width years aligned on multiples of width (so a table keeps the same partitions from load to load), plus a
+    default partition catching any other year.
+
+    A year, or range of years, can later be dropped or replaced on its own with
+    ALTER TABLE ... DETACH/ATTACH PARTITION "<table>_y<start>".
+
+    Args:
+        cur (psycopg2.extensions.cursor): postgres cursor
+        pg_table_name (str): partitioned table name in schema.table form
+        first (int): first year, None if the table is empty
+        last (int): last year
+        width (int, optional): years per partition. Defaults to 1.
+        unlogged (bool, optional): create the partitions UNLOGGED. Defaults to False.
+    """
+    schema, table = split_pg_tablename(pg_table_name)
+    target = sql.Identifier(schema, table)
+    persistence = sql.SQL('UNLOGGED ' if unlogged else '')
+
+    if first is not None:
+        for start in range(first - first % width, last + 1, width):
+            cur.execute(sql.SQL('CREATE {}TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)').format(
+                persistence, sql.Identifier(schema, year_partition_name(table, start)), target), (start, start + width))
+    cur.execute(sql.SQL('CREATE {}TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT').format(
+        persistence, sql.Identifier(schema, year_partition_name(table, None)), target))
+
+
+def attach_fid_sequence(cur, pg_table_name, column='ogc_fid'):
+    """Give column a sequence default as ogr2ogr's serial ogc_fid has, if it has none, and move the sequence past
+    the largest value of column so rows inserted without it don't collide with loaded rows. The sequence is never
+    moved backwards.
+
+    Args:
+        cur (psycopg2.extensions.cursor): postgres cursor
+        pg_table_name (str): postgres table name in schema.table form
+        column (str, optional): integer key column. Defaults to 'ogc_fid'.
+
+    Returns:
+        str: sequence name in "schema"."sequence" form
+    """
+    schema, table = split_pg_tablename(pg_table_name)
+    target = sql.Identifier(schema, table)
+    cur.execute('SELECT pg_get_serial_sequence(%s, %s)', (target.as_string(cur), column))
+    sequence = cur.fetchone()[0]
+    if sequence is None:
+        seq = sql.Identifier(schema, pg_identifier(table, '_{}_seq'.format(column)))
+        sequence = seq.as_string(cur)
+        cur.execute(sql.SQL('CREATE SEQUENCE {} OWNED BY {}').format(seq, sql.Identifier(schema, table, column)))
+        cur.execute(sql.SQL('ALTER TABLE {} ALTER COLUMN {} SET DEFAULT nextval(%s::regclass)').format(
+            target, sql.Identifier(column)), (sequence,))
+
+    cur.execute(sql.SQL("""SELECT setval(%(seq)s, m) FROM (SELECT max({}) AS m FROM {}) s
+                           WHERE m > coalesce(pg_sequence_last_value(%(seq)s), 0)""").format(
+        sql.Identifier(column), target), {'seq': sequence})
+    return sequence
+
+
+class CopyBinaryStream:
+    """File like object feeding sqlite rows to psycopg2 copy_expert as postgres binary COPY data.
+
+    Rows are fetched and encoded batch_size at a time so a table is never held in memory.
+    """
+
+    def __init__(self, cursor, formats, batch_size=50000):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rows = 0
+        self._encoders = [_encoder(f) for f in formats]
+        self._tuple_header = struct.pack('>h', len(formats))
+        # all fixed width columns without NULLs pack in one call
+        if all(f is not None for f in formats):
+            fixed = struct.Struct('>h' + ''.join('i' + f for f in formats))
+            sizes = [struct.calcsize('>' + f) for f in formats]
+            self._fixed = lambda row: fixed.pack(len(formats), *[x for pair in zip(sizes, row) for x in pair])
+        else:
+            self._fixed = None
+
+        self._buffer = bytearray(COPY_HEADER)
+        self._done = False
+
+    def _encode_row(self, row):
+        if self._fixed is not None and None not in row:
+            return self._fixed(row)
+
+        parts = [self._tuple_header]
+        for enc, v in zip(self._encoders, row):
+            parts.append(b'\xff\xff\xff\xff' if v is None else enc(v))
+        return b''.join(parts)
+
+    def _fill(self):
+        batch = self.cursor.fetchmany(self.batch_size)
+        if not batch:
+            self._buffer += COPY_TRAILER
+            self._done = True
+            return
+
+        self.rows += len(batch)
+        self._buffer += b''.join(map(self._encode_row, batch))
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._fill()
+
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+
+def copy_gpkg_table(pg_conn, gpkg_conn, gpkg_table, pg_table_name, columns, update=False, unlogged=False, batch_size=50000,
+                    timings=None, partition_years=None, partition_index='btree', years=None):
+    """Load a geopackage attribute table into postgres with a binary COPY in a single transaction.
+
+    Without update the table is dropped and recreated, with update it is truncated (created if missing).
+    The primary key is added after the data is loaded, along with a sequence default on ogc_fid, see
+    attach_fid_sequence.
+
+    With partition_years, tables with a year column are created range partitioned on year, see
+    create_year_partitions, with an index on (sampleid, year) and (ogc_fid, year) as primary key since it must
+    hold the partition key. The COPY routes rows to their partition. Truncated partitioned tables get partitions
+    for new years, an existing table which isn't partitioned is reloaded as it is.
+
+    Args:
+        pg_conn (psycopg2.extensions.connection): postgres connection
+        gpkg_conn (sqlite3.Connection): open geopackage connection
+        gpkg_table (str): name of table in geopackage
+        pg_table_name (str): postgres table name in schema.table form
+        columns (list): column mapping from gpkg_copy_columns
+        update (bool, optional): truncate and reload rather than overwriting the table. Defaults to False.
+        unlogged (bool, optional): create the table UNLOGGED, for staging tables. Defaults to False.
+        batch_size (int, optional): rows fetched from sqlite per batch. Defaults to 50000.
+        timings (dict, optional): filled with seconds spent per stage: create, copy, index, primary_key and commit.
+            Defaults to None.
+        partition_years (int, optional): years per partition, None for a plain table. Defaults to None.
+        partition_index (str, optional): one of PARTITION_INDEXES, index type on (sampleid, year) of partitioned
+            tables. Defaults to 'btree'.
+        years (tuple, optional): first and last year of the table for its partitions, see GpkgCatalog.year_span.
+            Defaults to reading them from the geopackage table.
+
+    Returns:
+        int, float: rows loaded, seconds spent
+    """
+    start = time.perf_counter()
+    timings = {} if timings is None else timings
+    schema, table = split_pg_tablename(pg_table_name)
+    target = sql.Identifier(schema, table)
+    pg_columns = sql.SQL(', ').join(sql.Identifier(c[1]) for c in columns)
+
+    if partition_index not in PARTITION_INDEXES:
+        raise ValueError("unknown partition index {}, expected one of {}".format(partition_index, PARTITION_INDEXES))
+    pg_names = [c[1] for c in columns]
+    year_column = next((c[0] for c in columns if c[1] == 'year'), None) if partition_years else None
+    partitioned = year_column is not None
+    create_columns = sql.SQL(', ').join(sql.SQL('{} {}').format(sql.Identifier(c[1]), sql.SQL(c[2])) for c in columns)
+    if partitioned:
+        # a partitioned table can't be unlogged, its partitions can
+        create = sql.SQL('CREATE TABLE {} ({}) PARTITION BY RANGE (year)').format(target, create_columns)
+    else:
+        create = sql.SQL('CREATE {}TABLE {} ({})').format(sql.SQL('UNLOGGED ' if unlogged else ''), target, create_columns)
+    has_fid = 'ogc_fid' in pg_names
+
+    with pg_conn:
+        with pg_conn.cursor() as cur:
+            created = True
+            if update:
+                cur.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (target.as_string(cur),))
+                existing = cur.fetchone()
+                if existing is not None:
+                    cur.execute(sql.SQL('TRUNCATE TABLE {}').format(target))
+                    created = False
+                    partitioned = partitioned and existing[0] == 'p'
+                else:
+                    cur.execute(create)
+            else:
+                cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(target))
+                cur.execute(create)
+
+            if partitioned:
+                first, last = years if years is not None else gpkg_conn.execute(
+                    'SELECT min("{0}"), max("{0}") FROM "{1}"'.format(year_column, gpkg_table)).fetchone()
+                create_year_partitions(cur, pg_table_name, first, last, width=partition_years, unlogged=unlogged)
+            timings['create'] = time.perf_counter() - start
+
+            stage = time.perf_counter()
+            select = 'SELECT {} FROM "{}"'.format(', '.join('"{}"'.format(c[0]) for c in columns), gpkg_table)
+            stream = CopyBinaryStream(gpkg_conn.execute(select), [c[3] for c in columns], batch_size=batch_size)
+            cur.copy_expert(sql.SQL('COPY {} ({}) FROM STDIN (FORMAT binary)').format(target, pg_columns).as_string(cur),
+                            stream, size=1 << 20)
+            timings['copy'] = time.perf_counter() - stage
+
+            if created and partitioned and 'sampleid' in pg_names:
+                # created on every partition, and on partitions added later
+                stage = time.perf_counter()
+                cur.execute(sql.SQL('CREATE INDEX {} ON {} USING {} (sampleid, year)').format(
+                    sql.Identifier(pg_identifier(table, '_sampleid_year_idx')), target, sql.SQL(partition_index)))
+                timings['index'] = time.perf_counter() - stage
+
+            if has_fid:
+                stage = time.perf_counter()
+                if created:
+                    cur.execute(sql.SQL('ALTER TABLE {} ADD PRIMARY KEY ({})').format(
+                        target, sql.SQL('ogc_fid, year' if partitioned else 'ogc_fid')))
+                # serial like the ogc_fid ogr2ogr creates, so rows can be appended without one
+                attach_fid_sequence(cur, pg_table_name)
+                timings['primary_key'] = time.perf_counter() - stage
+        stage = time.perf_counter()
+    timings['commit'] = time.perf_counter() - stage
+
+    return stream.rows, time.perf_counter() - start
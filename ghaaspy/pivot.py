@@ -1,9 +1,22 @@
 """Creation of pivot tables & views from ghaas postgres tables"""
 
-import itertools 
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 
-from .sqlgen import group1_create_pivot, group2_create_pivot, GROUP1, GROUP2, group1_create_yearly_views, group2_create_yearly_views
-from .util import group_geography_vs_model, clean_tablenames
+from psycopg2 import Error as PostgresError
+from psycopg2 import sql
+
+from .sqlgen import group1_create_pivot, group2_create_pivot, GROUP1, GROUP2, group1_create_yearly_views, group2_create_yearly_views, \
+    group1_pivot_statements, group2_pivot_statements, group1_create_array_pivot, group2_create_array_pivot, \
+    array_pivot_statements, PIVOT_LAYOUTS, create_long_view, VIEW_MODES, daily_pivot_name, daily_pivot_statements, \
+    create_daily_pivot, create_daily_accessors, long_view_index_statements
+from .geomtier import create_geometry_tiers, geometry_tier_targets
+from .manifest import fetch_manifest
+from .tablename import TEMPORAL_CLASSES, TableCatalog, TableName
+from .util import split_pg_tablename
 
 def group_annual_monthly(table_names):
     """Convert a dict of table names to a dictionary grouping together annual and monthly tables. Keys are
@@ -11,27 +24,13 @@ def group_annual_monthly(table_names):
 
     Args:
         table_names (dict): dictionary of tablenames
-    """
-
-    def group_temporal(x):
-        
-        # remove temporal quanitifier from table name
-        x_short = x.lower().replace('annual','')
-        x_short = x_short.replace('monthly','')
-        x_short = x_short.replace('daily','')
-        x_short = x_short.replace('__','_')
-        if x_short.endswith('_'):
-            x_short = x_short[:-1]
-
-        return x_short
 
+    Returns:
+        dict: {key: set of table names}, see tablename.TableName.group_key
+    """
     annual_monthly = dict()
-    temporal_grouped = itertools.groupby(table_names, group_temporal)
-    for key, group in temporal_grouped:
-        if key not in annual_monthly:
-            annual_monthly[key] = set(group)
-        else: 
-            annual_monthly[key] = annual_monthly[key].union(set(group))
+    for name in TableCatalog(table_names):
+        annual_monthly.setdefault(name.group_key, set()).add(name.raw)
     return annual_monthly
 
 def sift_temporal_group(table_group):
@@ -39,70 +38,436 @@ def sift_temporal_group(table_group):
 
     Args:
         table_group (set): set of tables grouped together as annual/monthly/daily variants
-    
+
     Returns:
-        table_group_dict (dict): {'annual': annual_table, 'monthly':monthly_table, 'daily': daily_table OR None}
+        table_group_dict (dict): {'annual': annual_table, 'monthly':monthly_table, 'daily': daily_table OR None},
+            temporal class as parsed by tablename.TableName
     """
-    table_group_dict = {'annual':None, 'monthly': None, 'daily': None}
-    assert(len(table_group) <= 3)
+    table_group_dict = dict.fromkeys(TEMPORAL_CLASSES)
     for t in table_group:
-        if 'annual' in t:
-            table_group_dict['annual'] = t
-        elif 'monthly' in t:
-            table_group_dict['monthly'] = t
-        elif 'daily' in t:
-            table_group_dict['daily'] = t
-    
+        temporal = TableName.parse(t).temporal
+        if temporal is not None:
+            table_group_dict[temporal] = t
     return table_group_dict
 
 
+def detect_year_spans(conn, table_names, manifest_table=None):
+    """Span of the year column of postgres tables, from the import manifest where it was recorded (incremental
+    imports), otherwise with a min/max query on the table
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        table_names (list): postgres table names prefexed with schema ie schema."my-table_name"
+        manifest_table (str, optional): manifest table in schema.table form, None to always query the tables.
+            Defaults to None.
+
+    Returns:
+        dict: {(schema, table): (first year, last year)}, unquoted names as from split_pg_tablename, tables
+            without a year column or rows are left out
+    """
+    spans = {}
+    if manifest_table is not None:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT to_regclass(%s)', (manifest_table,))
+                has_manifest = cur.fetchone()[0] is not None
+        recorded = fetch_manifest(conn, table_names, manifest_table=manifest_table) if has_manifest else {}
+        for pg_table, entry in recorded.items():
+            if entry['year_min'] is not None:
+                spans[split_pg_tablename(pg_table)] = (entry['year_min'], entry['year_max'])
+
+    with conn:
+        with conn.cursor() as cur:
+            for t in table_names:
+                schema, table = split_pg_tablename(t)
+                if (schema, table) in spans:
+                    continue
+                cur.execute("""SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'year'
+                               AND NOT attisdropped""", (sql.Identifier(schema, table).as_string(cur),))
+                if cur.fetchone() is None:
+                    continue
+                cur.execute(sql.SQL('SELECT min(year), max(year) FROM {}').format(sql.Identifier(schema, table)))
+                first, last = cur.fetchone()
+                if first is not None:
+                    spans[(schema, table)] = (int(first), int(last))
+
+    return spans
+
+
+def build_pivot_groups(table_names, year_start=1958, year_end=2019, layout='crosstab', views='yearly', year_spans=None,
+                       daily=False, geometry_tiers=False):
+    """Generate the sql of every pivot group (a pivot table and its yearly views) for a list of postgres tables
+    generated through import_gpkg. Groups are independent of each other. Tables may come from several schemas.
+
+    Args:
+        table_names (list): postgres table names prefexed with schema ie schema."my-table_name"
+        year_start (int, optional): Start year of data. Defaults to 1958.
+        year_end (int, optional): End year of data. Defaults to 2019.
+        layout (str, optional): one of PIVOT_LAYOUTS, 'crosstab' creates a column per year, 'array' one array
+            column indexed by year. Defaults to 'crosstab'.
+        views (str, optional): one of VIEW_MODES, 'yearly' creates a view per year, 'materialized' an indexed
+            materialized view per year, 'long' one long format view with a function returning the rows of a year,
+            see sqlgen.create_long_view. Long format groups have layout 'long' and build no pivot table, their
+            table_sql indexes the annual and monthly tables on year instead. Defaults to 'yearly'.
+        year_spans (dict, optional): year spans of the tables from detect_year_spans. Each group is sized to the
+            years of its annual and monthly tables combined, year_start and year_end only apply to groups
+            without a detected span. Defaults to None.
+        daily (bool, optional): add a group with layout 'daily' for every daily table, building a daily pivot table
+            next to the annual/monthly one (see sqlgen.daily_pivot_statements), its view_sql creates accessor
+            functions rather than views. Defaults to False.
+        geometry_tiers (bool, optional): yearly views of polygon units also select the simplified geometry tiers of
+            their geography, which must be prepared first (see geomtier.prepare_geometry_tiers). Defaults to False.
+
+    Returns:
+        list: dicts with schema, pivot_table, layout, year_start, year_end, table_sql, table_statements ((stage, sql)
+            tuples of table_sql), view_sql, view_names and functions (schema qualified)
+    """
+    if layout not in PIVOT_LAYOUTS:
+        raise ValueError("unknown pivot layout {}, expected one of {}".format(layout, PIVOT_LAYOUTS))
+    if views not in VIEW_MODES:
+        raise ValueError("unknown view mode {}, expected one of {}".format(views, VIEW_MODES))
+    if geometry_tiers and views == 'long':
+        raise ValueError("geometry tiers are only joined by yearly and materialized views")
+
+    # one region per schema, the temporal groups of a schema in the order their tables were given
+    by_schema = OrderedDict()
+    for (schema, key), temporal_group in TableCatalog(table_names).temporal_groups().items():
+        by_schema.setdefault(schema, []).append((key, temporal_group))
+
+    groups = []
+    for schema, temporal_groups in by_schema.items():
+        groups += _build_schema_pivot_groups(schema, temporal_groups, year_start, year_end, layout, views, year_spans,
+                                             daily, geometry_tiers)
+
+    return groups
+
+
+def _group_years(schema, tables, year_spans, year_start, year_end):
+    """Years covered by any of the tables, falling back on year_start, year_end"""
+    spans = [year_spans[(schema, t)] for t in tables if (schema, t) in year_spans]
+    if not spans:
+        return year_start, year_end
+    return min(s[0] for s in spans), max(s[1] for s in spans)
+
+
+def _build_schema_pivot_groups(schema, temporal_groups, year_start, year_end, layout='crosstab', views='yearly',
+                               year_spans=None, daily=False, geometry_tiers=False):
+    groups = []
+    for key, temporal_group in temporal_groups:
+        pivot_tablename = key+'_pivot' 
+
+        annual, monthly, daily_table = (temporal_group[t].table if t in temporal_group else None
+                                        for t in ('annual', 'monthly', 'daily'))
+
+        output = next(iter(temporal_group.values())).output
+        output_group = 'group1' if output in GROUP1['outputs'] else 'group2'
+
+        if daily and daily_table is not None:
+            daily_pivot = daily_pivot_name(pivot_tablename)
+            daily_start, daily_end = _group_years(schema, [daily_table], year_spans or {}, year_start, year_end)
+            table_statements = daily_pivot_statements(output_group, schema, output, daily_table, daily_pivot,
+                                                      year_start=daily_start, year_end=daily_end)
+            view_sql, functions = create_daily_accessors(output_group, schema, output, daily_pivot)
+            groups.append(dict(schema=schema, pivot_table=daily_pivot, layout='daily', year_start=daily_start,
+                               year_end=daily_end, table_sql=create_daily_pivot(output_group, schema, output,
+                                   daily_table, daily_pivot, year_start=daily_start, year_end=daily_end),
+                               table_statements=table_statements, view_sql=view_sql, view_names=[],
+                               functions=functions))
+
+        # the annual/monthly pivot joins both tables, daily only outputs have none
+        if annual is None or monthly is None:
+            continue
+
+        group_start, group_end = _group_years(schema, [annual, monthly], year_spans or {}, year_start, year_end)
+        years = dict(year_start=group_start, year_end=group_end)
+        if views == 'long':
+            # the view reads the annual and monthly tables, no pivot table
+            table_statements = long_view_index_statements(schema, monthly, annual)
+            view_sql, view_names, functions = create_long_view(output_group, schema, output, monthly, annual,
+                                                               pivot_tablename)
+            groups.append(dict(schema=schema, pivot_table=pivot_tablename, layout='long', year_start=group_start,
+                               year_end=group_end, table_sql=''.join(statement for _, statement in table_statements),
+                               table_statements=table_statements, view_sql=view_sql, view_names=view_names,
+                               functions=functions))
+            continue
 
-def create_pivot_annual_monthly_tables(table_names, output_file, year_start=1958, year_end=2019):
+        # call appropriate sql gen function for group1/group2 outputs
+        if output in GROUP1['outputs']:
+            if layout == 'array':
+                table_sql = group1_create_array_pivot(schema, output, monthly, annual, pivot_tablename, **years)
+                table_statements = array_pivot_statements('group1', schema, output, monthly, annual, pivot_tablename, **years)
+            else:
+                table_sql = group1_create_pivot(schema, output, monthly, annual, pivot_tablename, **years)
+                table_statements = group1_pivot_statements(schema, output, monthly, annual, pivot_tablename, **years)
+            view_sql,view_names = group1_create_yearly_views(schema, pivot_tablename, layout=layout,
+                                                              materialized=views == 'materialized',
+                                                              geometry_tiers=geometry_tiers, **years)
+        else:
+            if layout == 'array':
+                table_sql = group2_create_array_pivot(schema, output, monthly, annual, pivot_tablename, **years)
+                table_statements = array_pivot_statements('group2', schema, output, monthly, annual, pivot_tablename, **years)
+            else:
+                table_sql = group2_create_pivot(schema, output, monthly, annual, pivot_tablename, **years)
+                table_statements = group2_pivot_statements(schema, output, monthly, annual, pivot_tablename, **years)
+            view_sql,view_names = group2_create_yearly_views(schema, pivot_tablename, layout=layout,
+                                                              materialized=views == 'materialized',
+                                                              geometry_tiers=geometry_tiers, **years)
+
+        groups.append(dict(schema=schema, pivot_table=pivot_tablename, layout=layout, year_start=group_start,
+                           year_end=group_end, table_sql=table_sql,
+                           table_statements=table_statements, view_sql=view_sql, view_names=view_names,
+                           functions=[]))
+
+    return groups
+
+
+def create_pivot_annual_monthly_tables(table_names, output_file, year_start=1958, year_end=2019, layout='crosstab',
+                                       views='yearly', year_spans=None, daily=False, geometry_tiers=False):
     """Write sql to file generating pivot tables and accompanying yearly views for a list of postgres tables generated through import_gpkg
 
     Args:
         table_names (list): postgres table names prefexed with schema ie schema."my-table_name"
         output_file (Path): output file to write sql to
+        layout (str, optional): one of PIVOT_LAYOUTS, see build_pivot_groups. Defaults to 'crosstab'.
+        views (str, optional): one of VIEW_MODES, see build_pivot_groups. Defaults to 'yearly'.
+        year_spans (dict, optional): year spans from detect_year_spans, see build_pivot_groups. Defaults to None.
+        daily (bool, optional): also create daily pivot tables, see build_pivot_groups. Defaults to False.
+        geometry_tiers (bool, optional): prepare the geometry tiers of polygon geographies ahead of the pivot groups
+            and join them in the yearly views, see build_pivot_groups. Defaults to False.
 
     Returns:
         pivot_tablenames, view_names_all: lists of tables/views generated by function
     """
-    
-    geography, model_tables = group_geography_vs_model(table_names)
-    schema, tables_names_short = clean_tablenames(model_tables)
-    # group together annual/monthly table pairs
-    annual_monthly = group_annual_monthly(tables_names_short)
-
-    # lists of all pivot tables and views created
-    pivot_tablenames = []
-    view_names_all = []
+    groups = build_pivot_groups(table_names, year_start=year_start, year_end=year_end, layout=layout, views=views,
+                                year_spans=year_spans, daily=daily, geometry_tiers=geometry_tiers)
 
     with open(output_file, 'w') as f:
-        for key, component_tables in annual_monthly.items(): 
-            pivot_tablename = key+'_pivot' 
-            pivot_tablenames.append(pivot_tablename)
-            
-            temporal_group = sift_temporal_group(component_tables)
-            annual = temporal_group['annual']
-            monthly = temporal_group['monthly']
-
-            # extract output name 
-            output = key.split('_')[0]
-
-            table_sql = ""
-            view_sql = ""
-
-            # call appropriate sql gen function for group1/group2 outputs
-            if output in GROUP1['outputs']:
-                table_sql = group1_create_pivot(schema, output, monthly, annual, pivot_tablename, year_start=year_start, year_end=year_end)
-                view_sql,view_names = group1_create_yearly_views(schema, pivot_tablename, year_start=year_start, year_end=year_end)
-                view_names_all += view_names
+        if geometry_tiers:
+            for schema, geography_table in geometry_tier_targets(groups):
+                f.write(create_geometry_tiers(schema, geography_table))
+        for g in groups:
+            f.write(g['table_sql'])
+            f.write(g['view_sql'])
+
+    return [g['pivot_table'] for g in groups if g['layout'] != 'long'], [v for g in groups for v in g['view_names']]
+
+
+# stages whose statement is a query worth explaining, EXPLAIN ANALYZE runs them as well. Stages run once per year
+# are named <stage>_<year>, ie aggregate_1990 of daily pivot tables
+EXPLAIN_STAGES = ('aggregate_join', 'crosstab', 'aggregate')
+
+
+@dataclass
+class PivotResult:
+    """Outcome of executing one pivot group. With instrumentation, stages holds {stage: {'seconds': s}} for
+    every statement run (views as one 'views' stage), plus the EXPLAIN plan under 'plan' if captured."""
+    schema: str
+    pivot_table: str
+    table_seconds: float = 0.0
+    view_seconds: float = 0.0
+    error: str = None
+    stages: dict = None
+    work_mem: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def seconds(self):
+        return self.table_seconds + self.view_seconds
+
+
+def _explained_stage(stage):
+    """Whether a stage is one of EXPLAIN_STAGES, or a year of one"""
+    name, _, year = stage.rpartition('_')
+    return stage in EXPLAIN_STAGES or (name in EXPLAIN_STAGES and year.isdigit())
+
+
+def _run_stage(cur, stages, stage, statement, explain=False):
+    """Execute one statement, recording its wall time (and plan) under stage"""
+    start = time.perf_counter()
+    if explain:
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement)
+        plan = cur.fetchone()[0]
+        # psycopg2 decodes json, depending on the server the plan comes back as text
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        stages[stage] = {'seconds': time.perf_counter() - start, 'plan': plan[0]}
+    else:
+        cur.execute(statement)
+        stages[stage] = {'seconds': time.perf_counter() - start}
+    return stages[stage]['seconds']
+
+
+def execute_pivot_group(db, group, instrument=False, explain=False, work_mem=None):
+    """Create the pivot table and yearly views of a pivot group in a single transaction on a pooled connection.
+    On error the transaction is rolled back, leaving any previous pivot table and views in place.
+
+    Args:
+        db (PostgresDB): database to run on
+        group (dict): pivot group from build_pivot_groups
+        instrument (bool, optional): run the pivot table statements one by one, timing each stage. Defaults to False.
+        explain (bool, optional): capture EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) of the EXPLAIN_STAGES statements,
+            implies instrument. Plan instrumentation adds some overhead to their timing. Defaults to False.
+        work_mem (str, optional): work_mem for the transaction ie '256MB'. Defaults to the server setting.
+
+    Returns:
+        PivotResult: timing of the pivot table and views, or the error
+    """
+    instrument = instrument or explain
+    result = PivotResult(schema=group['schema'], pivot_table=group['pivot_table'],
+                         stages=OrderedDict() if instrument else None)
+    with db.connection() as conn:
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    if work_mem is not None:
+                        cur.execute("SELECT set_config('work_mem', %s, true)", (work_mem,))
+                    cur.execute('SHOW work_mem')
+                    result.work_mem = cur.fetchone()[0]
+
+                    start = time.perf_counter()
+                    if instrument:
+                        for stage, statement in group['table_statements']:
+                            _run_stage(cur, result.stages, stage, statement,
+                                       explain=explain and _explained_stage(stage))
+                    else:
+                        cur.execute(group['table_sql'])
+                    result.table_seconds = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    if instrument:
+                        _run_stage(cur, result.stages, 'views', group['view_sql'])
+                    else:
+                        cur.execute(group['view_sql'])
+                    result.view_seconds = time.perf_counter() - start
+        except PostgresError as err:
+            result.error = str(err).strip()
+
+        # the generated sql sets search_path for the session, don't leave it on the pooled connection
+        try:
+            with conn.cursor() as cur:
+                cur.execute('RESET search_path')
+            conn.commit()
+        except PostgresError:
+            # connection lost, the pool discards it
+            pass
+
+    return result
+
+
+def execute_pivot_groups(db, groups, jobs=1, instrument=False, explain=False, work_mem=None):
+    """Execute pivot groups directly against the database, jobs groups at a time each on its own connection
+    and transaction. A failed group does not stop the others.
+
+    Args:
+        db (PostgresDB): database to run on, its pool should allow jobs connections
+        groups (list): pivot groups from build_pivot_groups
+        jobs (int, optional): number of groups to run concurrently. Defaults to 1.
+        instrument, explain, work_mem: see execute_pivot_group
+
+    Returns:
+        list: PivotResult of each group, in the order of groups
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(execute_pivot_group, db, g, instrument=instrument, explain=explain, work_mem=work_mem): i
+                   for i, g in enumerate(groups)}
+        for future in as_completed(futures):
+            r = future.result()
+            results[futures[future]] = r
+            if r.ok:
+                print('"{}"."{}" ok, table {:.1f}s, views {:.1f}s'.format(r.schema, r.pivot_table, r.table_seconds, r.view_seconds))
             else:
-                table_sql = group2_create_pivot(schema, output, monthly, annual, pivot_tablename, year_start=year_start, year_end=year_end)
-                view_sql,view_names = group2_create_yearly_views(schema, pivot_tablename, year_start=year_start, year_end=year_end)
-                view_names_all += view_names
+                print('"{}"."{}" FAILED'.format(r.schema, r.pivot_table))
+
+    return [results[i] for i in range(len(groups))]
+
+
+def pivot_report(results):
+    """Instrumentation report of executed pivot groups, for finding regressions between runs
+
+    Args:
+        results (list): PivotResult from execute_pivot_groups
+
+    Returns:
+        dict: {schema: {pivot table: {'ok', 'error', 'work_mem', 'seconds', 'stages': {stage: {'seconds'[, 'plan']}}}}}
+    """
+    report = OrderedDict()
+    for r in results:
+        report.setdefault(r.schema, OrderedDict())[r.pivot_table] = dict(
+            ok=r.ok, error=r.error, work_mem=r.work_mem, seconds=r.seconds, stages=r.stages or {})
+    return report
+
 
-            f.write(table_sql)
-            f.write(view_sql)
+def _benchmark_group(db, group, repeat):
+    """Build a pivot group and scan the views of its first, middle and last year inside a transaction which is
+    rolled back"""
+    year_start, year_end = group['year_start'], group['year_end']
+    sample_years = sorted({year_start, (year_start + year_end) // 2, year_end})
+    bench = dict(schema=group['schema'], pivot_table=group['pivot_table'], layout=group['layout'],
+                 year_start=year_start, year_end=year_end, build_seconds=None, table_bytes=None, view_seconds=None,
+                 error=None)
+    target = '"{}"."{}"'.format(group['schema'], group['pivot_table'])
+    with db.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                start = time.perf_counter()
+                for _, statement in group['table_statements']:
+                    cur.execute(statement)
+                bench['build_seconds'] = time.perf_counter() - start
+                cur.execute(group['view_sql'])
 
-    return pivot_tablenames, view_names_all
\ No newline at end of file
+                cur.execute('SELECT pg_total_relation_size(%s::regclass)', (target,))
+                bench['table_bytes'] = cur.fetchone()[0]
+
+                # best of repeat full scans per view, averaged over the sampled years
+                views = [v for v in group['view_names'] if any(v.endswith('_{}"'.format(y)) for y in sample_years)]
+                scans = []
+                for view in views:
+                    best = None
+                    for _ in range(max(1, repeat)):
+                        start = time.perf_counter()
+                        cur.execute('SELECT * FROM {}'.format(view))
+                        cur.fetchall()
+                        elapsed = time.perf_counter() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    scans.append(best)
+                bench['view_seconds'] = sum(scans) / len(scans) if scans else None
+        except PostgresError as err:
+            bench['error'] = str(err).strip()
+        finally:
+            conn.rollback()
+
+    return bench
+
+
+def benchmark_pivot_layouts(db, table_names, year_start=1958, year_end=2019, layouts=PIVOT_LAYOUTS, repeat=3,
+                            year_spans=None):
+    """Compare pivot layouts on build time, table size (with toast and indexes) and per-year view scan time.
+
+    Every layout of every pivot group is built and scanned inside a transaction which is rolled back, so the
+    database is left as it was. The existing pivot table is dropped within that transaction, which locks it
+    (and its views) until the benchmark of the group ends: run against a staging database or off hours.
+
+    Args:
+        db (PostgresDB): database to run on
+        table_names (list): postgres table names prefexed with schema ie schema."my-table_name"
+        year_start (int, optional): Start year of data. Defaults to 1958.
+        year_end (int, optional): End year of data. Defaults to 2019.
+        layouts (tuple, optional): layouts to compare. Defaults to PIVOT_LAYOUTS.
+        repeat (int, optional): scans per view, the fastest counts. Defaults to 3.
+        year_spans (dict, optional): year spans of the tables from detect_year_spans, groups are built and sampled
+            over the years of their tables as by build_pivot_groups. Defaults to None.
+
+    Returns:
+        list: dicts with schema, pivot_table, layout, year_start, year_end, build_seconds, table_bytes,
+            view_seconds (mean over the first, middle and last year views) and error
+    """
+    results = []
+    for layout in layouts:
+        for group in build_pivot_groups(table_names, year_start=year_start, year_end=year_end, layout=layout,
+                                        year_spans=year_spans):
+            results.append(_benchmark_group(db, group, repeat))
+    return results
@@ -0,0 +1,186 @@
+"""Import planning: size estimates, temporal classification and load time estimates from past throughput"""
+
+import fcntl
+import heapq
+import json
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+from .pgcopy import GPKG_COLUMN_TYPES
+from .tablename import TableName, TEMPORAL_CLASSES
+
+THROUGHPUT_FILE = Path.home().joinpath('.ghaaspy_throughput.json')
+
+# bytes/second used until a run of the engine has been measured, deliberately conservative
+DEFAULT_THROUGHPUT = {'attribute': 10e6, 'geometry': 2e6}
+
+# postgres heap tuple header + item pointer
+ROW_OVERHEAD = 28
+
+
+
+def classify_temporal(table_name):
+    """Temporal class of a table from its name
+
+    Args:
+        table_name (str): geopackage or postgres table name
+
+    Returns:
+        str: 'annual', 'monthly', 'daily' or None
+    """
+    return TableName.parse(table_name).temporal
+
+
+def estimate_row_bytes(catalog, gpkg_table, sample=1000):
+    """Estimate bytes per row of a geopackage table once loaded in postgres. Fixed width columns use their type
+    size, variable width columns (text, blobs, geometry) the average length over the first sample rows.
+
+    Args:
+        catalog (GpkgCatalog): catalog of geopackage
+        gpkg_table (str): name of table in geopackage
+        sample (int, optional): rows to sample for variable width columns. Defaults to 1000.
+
+    Returns:
+        int: estimated bytes per row
+    """
+    width = ROW_OVERHEAD
+    variable = []
+    for _, name, decl_type, _, _, _ in catalog.columns(gpkg_table):
+        fmt = GPKG_COLUMN_TYPES.get(decl_type.upper().split('(')[0].strip(), (None, None))[1]
+        if fmt is None:
+            variable.append(name)
+        else:
+            width += struct.calcsize('>' + fmt)
+
+    if variable:
+        averages = ', '.join('avg(length("{}"))'.format(v) for v in variable)
+        row = catalog.conn.execute('SELECT {} FROM (SELECT * FROM "{}" LIMIT {})'.format(
+            averages, gpkg_table, sample)).fetchone()
+        width += sum(int(a or 0) for a in row)
+
+    return width
+
+
+def load_throughput(path=THROUGHPUT_FILE):
+    """Read measured import throughput
+
+    Args:
+        path (Path, optional): throughput history file. Defaults to THROUGHPUT_FILE.
+
+    Returns:
+        dict: {engine: {'attribute'|'geometry': bytes/second}}
+    """
+    if not path.exists():
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def record_throughput(results, plan, engine, path=THROUGHPUT_FILE, weight=0.5):
+    """Update throughput history with the tables imported in a run, as an exponential moving average of
+    bytes/second per engine and table kind. The history is read and rewritten under an exclusive lock on a
+    sibling .lock file and replaced atomically, so concurrent imports don't lose or truncate each other's updates.
+
+    Args:
+        results (list): ImportResult of the run
+        plan (list): plan entries from build_import_plan
+        engine (str): import engine name
+        path (Path, optional): throughput history file. Defaults to THROUGHPUT_FILE.
+        weight (float, optional): weight of this run against history. Defaults to 0.5.
+    """
+    by_table = {p['pg_table']: p for p in plan}
+    measured = {}
+    for r in results:
+        if r.ok and not r.skipped and r.seconds > 0 and r.pg_table in by_table:
+            kind = by_table[r.pg_table]['kind']
+            total_bytes, total_seconds = measured.get(kind, (0, 0.0))
+            measured[kind] = (total_bytes + by_table[r.pg_table]['est_bytes'], total_seconds + r.seconds)
+
+    if not measured:
+        return
+
+    with open(path.with_name(path.name + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        history = load_throughput(path)
+        engine_history = history.setdefault(engine, {})
+        for kind, (total_bytes, total_seconds) in measured.items():
+            rate = total_bytes / total_seconds
+            if kind in engine_history:
+                rate = weight * rate + (1 - weight) * engine_history[kind]
+            engine_history[kind] = rate
+
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(history, f, indent=2)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def build_import_plan(tasks, engine='ogr2ogr', throughput=None, row_counts=None, exact=False):
+    """Plan entries for import tasks, largest first. Rows are taken from row_counts (ie the import manifest) when
+    known, else estimated from the max rowid of the table, which sqlite reads without scanning it. exact counts
+    every table instead, for printing a plan.
+
+    Args:
+        tasks (list): (GpkgCatalog, postgres table name, geopackage table name) tuples as scheduled by import_gpkgs
+        engine (str, optional): import engine used to pick the measured throughput. Defaults to 'ogr2ogr'.
+        throughput (dict, optional): throughput history from load_throughput. Defaults to no history.
+        row_counts (dict, optional): {postgres table name: row count} already known. Defaults to None.
+        exact (bool, optional): count(*) the rows of tables not in row_counts. Defaults to False.
+
+    Returns:
+        list: dicts with gpkg, gpkg_table, pg_table, kind, temporal, rows, est_bytes, est_seconds
+    """
+    rates = dict(DEFAULT_THROUGHPUT)
+    rates.update((throughput or {}).get(engine, {}))
+
+    plan = []
+    for catalog, pg_table, gpkg_table in tasks:
+        kind = 'geometry' if catalog.has_geometry(gpkg_table) else 'attribute'
+        if row_counts and pg_table in row_counts:
+            rows = row_counts[pg_table]
+        else:
+            rows = catalog.row_count(gpkg_table) if exact else catalog.max_rowid(gpkg_table)
+        est_bytes = rows * estimate_row_bytes(catalog, gpkg_table)
+        plan.append(dict(
+            gpkg=str(catalog.gpkg),
+            gpkg_table=gpkg_table,
+            pg_table=pg_table,
+            kind=kind,
+            temporal=classify_temporal(gpkg_table),
+            rows=rows,
+            est_bytes=est_bytes,
+            est_seconds=est_bytes / rates[kind],
+        ))
+
+    plan.sort(key=lambda p: p['est_bytes'], reverse=True)
+    return plan
+
+
+def plan_summary(plan, jobs=1):
+    """Totals of a plan, with the wall time of a largest-first schedule over jobs workers
+
+    Args:
+        plan (list): plan entries from build_import_plan
+        jobs (int, optional): number of concurrent imports. Defaults to 1.
+
+    Returns:
+        dict: tables, rows, est_bytes, est_seconds (serial), est_wall_seconds (with jobs workers)
+    """
+    workers = [0.0] * max(1, jobs)
+    for p in sorted(plan, key=lambda p: p['est_seconds'], reverse=True):
+        heapq.heapreplace(workers, workers[0] + p['est_seconds'])
+
+    return dict(
+        tables=len(plan),
+        rows=sum(p['rows'] for p in plan),
+        est_bytes=sum(p['est_bytes'] for p in plan),
+        est_seconds=sum(p['est_seconds'] for p in plan),
+        est_wall_seconds=max(workers),
+        jobs=max(1, jobs),
+    )
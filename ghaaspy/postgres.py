@@ -1,31 +1,131 @@
+from contextlib import contextmanager
 from pathlib import Path
+import threading
+import time
+import weakref
 
-from psycopg2 import sql, connect
+from psycopg2 import sql, connect, Error as PostgresError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
 
 class PostgresDB:
-    def __init__(self, database=None, user='postgres', password='admin', host='localhost', port=5432, verify=True):
+    """Postgres connection parameters with a thread-safe pool of connections, opened on first use.
+
+    Use db.connection() to borrow a connection, db.transaction() for a cursor in a committed (or rolled back)
+    transaction and db.close() to close the pool. Connections idle in the pool for more than
+    health_check_interval seconds are checked before being handed out and replaced if they went away.
+    """
+
+    def __init__(self, database=None, user='postgres', password='admin', host='localhost', port=5432, verify=True,
+                 minconn=1, maxconn=8, health_check_interval=30):
         self.database = database
         self.host = host
         self.port = int(port)
         self.user = user
         self.password = password
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._slots = None
+        # keyed on the connection itself, ids of discarded connections are reused by new ones
+        self._last_used = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
 
         if verify:
+            self.verify()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def verify(self):
+        """Check the database can be reached, raising psycopg2.OperationalError if not"""
+        with self.connection():
+            pass
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, dbname=self.database, user=self.user,
+                                                    host=self.host, port=self.port, password=self.password)
+                # ThreadedConnectionPool raises once maxconn are out, callers wait for a free slot instead
+                self._slots = threading.BoundedSemaphore(self.maxconn)
+            return self._pool, self._slots
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(conn, 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except PostgresError:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool, waiting if maxconn are in use. An open transaction is rolled back
+        and autocommit reset when the connection is returned, broken connections are discarded.
+
+        Yields:
+            psycopg2.extensions.connection: pooled connection
+        """
+        pool, slots = self._get_pool()
+        slots.acquire()
+        try:
+            conn = pool.getconn()
+            while not self._healthy(conn):
+                # reconnect
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+
             try:
-                self.conn = connect(
-                    dbname=self.database,
-                    user=self.user,
-                    host=self.host,
-                    port=self.port,
-                    password=self.password
-                )
-
-            except Exception as err:
-                print("psycopg2 connect() ERROR:", err)
-                self.conn = None
-    
+                yield conn
+            finally:
+                if not conn.closed:
+                    try:
+                        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                            conn.rollback()
+                        conn.autocommit = False
+                    except PostgresError:
+                        conn.close()
+                self._last_used[conn] = time.monotonic()
+                pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """Cursor on a pooled connection inside a transaction, committed on success and rolled back on error
+
+        Yields:
+            psycopg2.extensions.cursor: cursor
+        """
+        with self.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    yield cur
+
+    def close(self):
+        """Close every connection of the pool. The pool is opened again if the instance is used afterwards."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._slots = None
+                self._last_used = weakref.WeakKeyDictionary()
+
+
     @classmethod
-    def from_pgpass(cls, idsubstring, pgpass=Path.home().joinpath('.pgpass').resolve(), verify=True):
+    def from_pgpass(cls, idsubstring, pgpass=Path.home().joinpath('.pgpass').resolve(), verify=True, **pool_options):
         """Use postgres password file as source of postgres connection. See https://www.postgresql.org/docs/current/libpq-pgpass.html.
         Entries are of form hostname:port:database:username:password
 
@@ -33,6 +133,7 @@ class PostgresDB:
         Args:
             idsubstring (str): identifying substring ie database, hostname:port:database, hostname:port:databse:username
          pgpass (Path, optional): Path of .pgpass file. Defaults to Path.home().joinpath('.pgpass').resolve().
+            pool_options: minconn, maxconn, health_check_interval of the connection pool
 
         Raises:
             FileNotFoundError: if pgpass not valid 
@@ -54,15 +155,16 @@ class PostgresDB:
         assert(len(matches) == 1)
         
         host, port, db, user, password = matches[0].split(':')
-        return cls(database=db, user=user, password=password, host=host, port=port, verify=verify)
+        return cls(database=db, user=user, password=password, host=host, port=port, verify=verify, **pool_options)
     
     @classmethod
-    def from_gdal_string(cls, gdal_pg, verify=True):
+    def from_gdal_string(cls, gdal_pg, verify=True, **pool_options):
         """Get PostgresDB instance form gdal driver style string.
 
         Args:
             gdal_pg (str): postgres connection str https://gdal.org/drivers/vector/pg.html      
             verify (bool, optional): Throw error if not valid connection. Defaults to True.
+            pool_options: minconn, maxconn, health_check_interval of the connection pool
 
         Returns:
             PostgresDB : class instance
@@ -77,8 +179,22 @@ class PostgresDB:
             ('password' in db)
         )
 
-        return cls(database=db['dbname'], user=db['user'], password=db['password'], host=db['host'], port=db['port'], verify=verify)
+        return cls(database=db['dbname'], user=db['user'], password=db['password'], host=db['host'], port=db['port'], verify=verify, **pool_options)
     
+    def connect(self):
+        """Open a new psycopg2 connection to the database, outside of the pool
+
+        Returns:
+            psycopg2.extensions.connection: new connection, caller is responsible for closing
+        """
+        return connect(
+            dbname=self.database,
+            user=self.user,
+            host=self.host,
+            port=self.port,
+            password=self.password
+        )
+
     def get_gdal_string(self):
         """Return gdal driver format postgres connection string
         https://gdal.org/drivers/vector/pg.html
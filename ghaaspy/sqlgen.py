@@ -1,5 +1,11 @@
 """Dynamic sql generation for creating verbose tables / views"""
 
+import hashlib
+
+from .geomtier import GEOMETRY_TIERS, geometry_tier_names, tier_column
+from .tablename import TableName
+from .util import pg_identifier
+
 GROUP1 = {'hunits': ('hydrostn30_confluence', 'hydrostn30_mouth', 'grandv13hydrostn30_dam', 'rivermouth'),
           'outputs': ('discharge', 'riverwidth', 'riverdepth', 'bedloadflux', 'sedimentflux')}
 GROUP2 = {'hunits': ('hydrostn30_basin', 'hydrostn30_subbasin', 'faogaul_country', 'faogaul_state'),
@@ -7,6 +13,12 @@ GROUP2 = {'hunits': ('hydrostn30_basin', 'hydrostn30_subbasin', 'faogaul_country
                       'rainpet', 'snowpack', 'runoff')}
 
 #### SQL generator helper funcs ####
+def pivot_temp_tablename(pivot_table_name):
+    """Temp table used while building a pivot table, named after it so pivot groups can run concurrently
+    or one after another in the same session"""
+    return "pivot_{}".format(hashlib.md5(pivot_table_name.encode()).hexdigest()[:16])
+
+
 def select_years(start, end):
     template = "SELECT {year} UNION ALL"
     selects = [template.format(year=y) for y in range(end, start, -1)]
@@ -36,25 +48,19 @@ def group2_crosstab_columns(start, end, output):
                for y in range(start, end)]
     ct_cols.append(template[:-1].format(output=output, year=end))
     return "\n".join(ct_cols)
-#####################################
 
-def group1_create_pivot(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
-    """Create pivot table for "group 1" outputs combining annual and monthly tables
 
-    Args:
-        schema (str): postgresql schema name
-        output (str): model output name
-        monthly_table (str): existing table with monthly data
-        annual_table (str): existing table with annual data
-        pivot_table_name (str): name of table to be created
-        year_start (int): starting year of data
-        year_end (int): ending year of data
-    """
+def _join_statements(statements):
+    return " \n" + "\n\n".join(stmt for _, stmt in statements) + "\n\n-- DROP monthly/annual tables\n"
+#####################################
 
-    GROUP1_TEMPLATE= """ 
-SET search_path="{schema}", public;
+# stages of the statements creating a pivot table, in execution order. drop_pivot cascades to the views of the
+# previous build, a pivot group recreates its views in the same transaction
+PIVOT_STAGES = ('search_path', 'aggregate_join', 'drop_pivot', 'crosstab', 'drop_temp', 'primary_key')
 
-CREATE TEMP TABLE aaa AS
+GROUP1_STAGE_TEMPLATES = (
+    ('search_path', 'SET search_path="{schema}", public;'),
+    ('aggregate_join', """CREATE TEMP TABLE {temp_table} AS
 
 SELECT a.sampleid as sampleid, a.year as year, ("annual_{output}","monthly_{output}")::model_output_annual_monthly as "{output}" FROM
 (SELECT sampleid, year, array_agg("{output}" ORDER BY month ASC) as "monthly_{output}"
@@ -65,70 +71,268 @@ INNER JOIN
     FROM "{schema}"."{annual_table}"
     ) b
 ON a.sampleid=b.sampleid AND a.year = b.year
-ORDER BY sampleid, year;
-
-DROP TABLE IF EXISTS "{schema}"."{pivot_table_name}";
-CREATE TABLE "{schema}"."{pivot_table_name}" AS
+ORDER BY sampleid, year;"""),
+    ('drop_pivot', 'DROP TABLE IF EXISTS "{schema}"."{pivot_table_name}" CASCADE;'),
+    ('crosstab', """CREATE TABLE "{schema}"."{pivot_table_name}" AS
 	SELECT ct.sampleid,
        {pivot_table_columns}
 FROM crosstab('SELECT sampleid, year, "{output}"
-        FROM aaa
+        FROM {temp_table}
+        ORDER BY sampleid'::text, 
+        '{sel_years}'::text) ct(sampleid bigint,  {crosstab_columns});"""),
+    ('drop_temp', 'DROP TABLE {temp_table};'),
+    ('primary_key', 'ALTER TABLE "{schema}"."{pivot_table_name}" ADD PRIMARY KEY (sampleid);'),
+)
+
+GROUP2_STAGE_TEMPLATES = (
+    ('search_path', 'SET search_path="{schema}", public;'),
+    ('aggregate_join', """CREATE TEMP TABLE {temp_table} AS
+SELECT a.sampleid as sampleid, a.year as year, (annual_zonalmean, annual_zonalmin, annual_zonalmax, monthly_zonalmean,
+                                                monthly_zonalmin, monthly_zonalmax)::model_output_zonal_annual_monthly as zonal_output FROM
+(SELECT sampleid, year, array_agg(zonalmean ORDER BY month ASC) as monthly_zonalmean,
+        array_agg(zonalmin ORDER BY month ASC) as monthly_zonalmin,
+        array_agg(zonalmax ORDER BY month ASC) as monthly_zonalmax
+FROM "{schema}"."{monthly_table}"
+GROUP BY sampleid,year) a
+INNER JOIN
+(SELECT sampleid, year, zonalmean as annual_zonalmean, zonalmin as annual_zonalmin, zonalmax as annual_zonalmax
+    FROM "{schema}"."{annual_table}"
+    ) b
+ON a.sampleid=b.sampleid AND a.year = b.year
+ORDER BY sampleid, year;"""),
+    ('drop_pivot', 'DROP TABLE IF EXISTS "{schema}"."{pivot_table_name}" CASCADE;'),
+    ('crosstab', """CREATE TABLE "{schema}"."{pivot_table_name}" AS
+	SELECT ct.sampleid,
+       {pivot_table_columns}
+FROM crosstab('SELECT sampleid, year, zonal_output
+        FROM {temp_table}
         ORDER BY sampleid'::text, 
-        '{sel_years}'::text) ct(sampleid bigint,  {crosstab_columns});
+'{sel_years}'::text) ct(sampleid bigint, {crosstab_columns});"""),
+    ('drop_temp', 'DROP TABLE {temp_table};'),
+    ('primary_key', 'ALTER TABLE "{schema}"."{pivot_table_name}" ADD PRIMARY KEY (sampleid);'),
+)
 
-DROP TABLE aaa;
 
-ALTER TABLE "{schema}"."{pivot_table_name}" ADD PRIMARY KEY (sampleid);
+def group1_pivot_statements(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Statements of group1_create_pivot one by one, labelled with their stage so they can be timed separately
 
--- DROP monthly/annual tables
-"""
+    Args:
+        see group1_create_pivot
 
-    sel_years = select_years(year_start, year_end)
-    ptbl_cols = pivot_table_columns(year_start, year_end, output)
-    ct_cols = group1_crosstab_columns(year_start, year_end, output)
+    Returns:
+        list: (stage, sql) tuples in execution order, stages are PIVOT_STAGES
+    """
+    params = dict(schema=schema, output=output, monthly_table=monthly_table, annual_table=annual_table,
+                  pivot_table_name=pivot_table_name, pivot_table_columns=pivot_table_columns(year_start, year_end, output),
+                  sel_years=select_years(year_start, year_end),
+                  crosstab_columns=group1_crosstab_columns(year_start, year_end, output),
+                  temp_table=pivot_temp_tablename(pivot_table_name))
+    return [(stage, template.format(**params)) for stage, template in GROUP1_STAGE_TEMPLATES]
 
-    sql = GROUP1_TEMPLATE.format(schema=schema, output=output, monthly_table=monthly_table, annual_table=annual_table, pivot_table_name=pivot_table_name,
-    pivot_table_columns=ptbl_cols, sel_years=sel_years, crosstab_columns=ct_cols)
 
-    return sql
+def group2_pivot_statements(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Statements of group2_create_pivot one by one, labelled with their stage so they can be timed separately
 
+    Args:
+        see group2_create_pivot
 
-def group1_create_yearly_views(schema, pivot_table_name, year_start=1958, year_end=2019):
-    """Create yearly views for pivot tables created by group1_create_pivot
+    Returns:
+        list: (stage, sql) tuples in execution order, stages are PIVOT_STAGES
+    """
+    params = dict(schema=schema, output=output, monthly_table=monthly_table, annual_table=annual_table,
+                  pivot_table_name=pivot_table_name, pivot_table_columns=pivot_table_columns(year_start, year_end, output),
+                  sel_years=select_years(year_start, year_end),
+                  crosstab_columns=group2_crosstab_columns(year_start, year_end, output),
+                  temp_table=pivot_temp_tablename(pivot_table_name))
+    return [(stage, template.format(**params)) for stage, template in GROUP2_STAGE_TEMPLATES]
+
+
+# pivot table layouts: one composite column per year filled by crosstab, or one array of composites indexed by year
+PIVOT_LAYOUTS = ('crosstab', 'array')
+
+ARRAY_PIVOT_STAGES = ('search_path', 'drop_pivot', 'create', 'aggregate', 'primary_key')
+
+# composite type of the pivot columns of group1/group2 outputs
+COMPOSITE_TYPES = {'group1': 'model_output_annual_monthly', 'group2': 'model_output_zonal_annual_monthly'}
+
+# the array column is created NULL and filled through a slice subscript, which gives it the lower bound year_start:
+# element year is the value of that year, whatever span the table was built over. Every sampleid gets one element
+# per year, NULL where the annual or monthly data is missing as with crosstab.
+ARRAY_PIVOT_CREATE_TEMPLATE = """CREATE TABLE "{schema}"."{pivot_table_name}" AS
+SELECT sampleid, NULL::{type_name}[] as "{output}" FROM "{schema}"."{annual_table}" WITH NO DATA;"""
+
+ARRAY_PIVOT_TEMPLATE = """INSERT INTO "{schema}"."{pivot_table_name}" (sampleid, "{output}"[{year_start}:{year_end}])
+SELECT s.sampleid, array_agg(v.value ORDER BY y.year)
+FROM (SELECT DISTINCT sampleid FROM "{schema}"."{annual_table}") s
+CROSS JOIN generate_series({year_start}, {year_end}) y(year)
+LEFT JOIN
+(SELECT a.sampleid, a.year, {value} as value FROM
+    (SELECT sampleid, year, {monthly_aggregates}
+    FROM "{schema}"."{monthly_table}"
+    GROUP BY sampleid,year) a
+    INNER JOIN "{schema}"."{annual_table}" b
+    ON a.sampleid=b.sampleid AND a.year = b.year
+    ) v
+ON v.sampleid=s.sampleid AND v.year=y.year
+GROUP BY s.sampleid;"""
+
+ARRAY_PIVOT_VALUES = {
+    'group1': ('(b."{output}", a."monthly_{output}")::model_output_annual_monthly',
+               'array_agg("{output}" ORDER BY month ASC) as "monthly_{output}"'),
+    'group2': ('(b.zonalmean, b.zonalmin, b.zonalmax, a.monthly_zonalmean, a.monthly_zonalmin, '
+               'a.monthly_zonalmax)::model_output_zonal_annual_monthly',
+               'array_agg(zonalmean ORDER BY month ASC) as monthly_zonalmean, '
+               'array_agg(zonalmin ORDER BY month ASC) as monthly_zonalmin, '
+               'array_agg(zonalmax ORDER BY month ASC) as monthly_zonalmax'),
+}
+
+
+def pivot_year_column(output, year, year_start=1958, layout='crosstab'):
+    """Expression of the composite value of one year in a pivot table
+
+    Args:
+        output (str): model output name
+        year (int): year of the value
+        year_start (int, optional): starting year of the pivot table. Not needed by either layout, array layout
+            tables are subscripted by year (see ARRAY_PIVOT_TEMPLATE). Defaults to 1958.
+        layout (str, optional): one of PIVOT_LAYOUTS. Defaults to 'crosstab'.
+
+    Returns:
+        str: sql expression
+    """
+    if layout == 'array':
+        return '"{}"[{}]'.format(output, year)
+    return '"{}_{}"'.format(output, year)
+
+
+def yearly_value_columns(group, output, year, year_start=1958, layout='crosstab'):
+    """Values of one year of a pivot table, named as the columns of its yearly views
+
+    Args:
+        group (str): 'group1' or 'group2'
+        output (str): model output name
+        year (int): year of the values
+        year_start (int, optional): starting year of the pivot table. Defaults to 1958.
+        layout (str, optional): one of PIVOT_LAYOUTS. Defaults to 'crosstab'.
+
+    Returns:
+        list: (sql expression, column name) tuples, annual then monthly values (of each zonal aggregation)
+    """
+    source = pivot_year_column(output, year, year_start, layout)
+    fields = [('', '')] if group == 'group1' else [('_' + z, '_' + z) for z in ('zonalmean', 'zonalmin', 'zonalmax')]
+
+    columns = []
+    for field, suffix in fields:
+        columns.append(('({}).annual{}'.format(source, field), '{}_{}_annual{}'.format(output, year, suffix)))
+        columns += [('({}).monthly{}[{}]'.format(source, field, m), '{}_{}_{:02d}{}'.format(output, year, m, suffix))
+                    for m in range(1, 13)]
+    return columns
+
+
+def array_pivot_statements(group, schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Statements creating an array layout pivot table: one row per sampleid with a single array column holding the
+    composite value of every year, built in one GROUP BY without crosstab (no tablefunc extension needed).
+    Extending the years appends to the arrays rather than adding columns. The arrays are subscripted by year,
+    their lower bound (array_lower) is the first year.
+
+    Args:
+        group (str): 'group1' or 'group2' output
+        see group1_create_pivot for the others
+
+    Returns:
+        list: (stage, sql) tuples in execution order, stages are ARRAY_PIVOT_STAGES
+    """
+    value, monthly_aggregates = ARRAY_PIVOT_VALUES[group]
+    create = ARRAY_PIVOT_CREATE_TEMPLATE.format(schema=schema, output=output, annual_table=annual_table,
+        pivot_table_name=pivot_table_name, type_name=COMPOSITE_TYPES[group])
+    aggregate = ARRAY_PIVOT_TEMPLATE.format(schema=schema, output=output, monthly_table=monthly_table,
+        annual_table=annual_table, pivot_table_name=pivot_table_name, year_start=year_start, year_end=year_end,
+        value=value.format(output=output), monthly_aggregates=monthly_aggregates.format(output=output))
+
+    return [
+        ('search_path', 'SET search_path="{}", public;'.format(schema)),
+        ('drop_pivot', 'DROP TABLE IF EXISTS "{}"."{}" CASCADE;'.format(schema, pivot_table_name)),
+        ('create', create),
+        ('aggregate', aggregate),
+        ('primary_key', 'ALTER TABLE "{}"."{}" ADD PRIMARY KEY (sampleid);'.format(schema, pivot_table_name)),
+    ]
+
+
+def group1_create_array_pivot(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Create array layout pivot table for "group 1" outputs, see array_pivot_statements
+
+    Args:
+        see group1_create_pivot
+    """
+    return _join_statements(array_pivot_statements('group1', schema, output, monthly_table, annual_table,
+                                                   pivot_table_name, year_start=year_start, year_end=year_end))
+
+
+def group2_create_array_pivot(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Create array layout pivot table for "group 2" outputs, see array_pivot_statements
+
+    Args:
+        see group2_create_pivot
+    """
+    return _join_statements(array_pivot_statements('group2', schema, output, monthly_table, annual_table,
+                                                   pivot_table_name, year_start=year_start, year_end=year_end))
+
+
+def group1_create_pivot(schema, output, monthly_table, annual_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Create pivot table for "group 1" outputs combining annual and monthly tables
+
+    Args:
+        schema (str): postgresql schema name
+        output (str): model output name
+        monthly_table (str): existing table with monthly data
+        annual_table (str): existing table with annual data
+        pivot_table_name (str): name of table to be created
+        year_start (int): starting year of data
+        year_end (int): ending year of data
+    """
+
+    return _join_statements(group1_pivot_statements(schema, output, monthly_table, annual_table, pivot_table_name,
+                                                    year_start=year_start, year_end=year_end))
+
+
+def group1_create_yearly_views(schema, pivot_table_name, year_start=1958, year_end=2019, layout='crosstab',
+                              materialized=False, geometry_tiers=False):
+    """Create yearly views for pivot tables created by group1_create_pivot or group1_create_array_pivot
 
     Args:
         schema (str): schema of postgres database
         pivot_table_name (str): name of pivot table being referenced
         year_start (int, optional): Start year of data. Defaults to 1958.
         year_end (int, optional): End year of data. Defaults to 2019.
+        layout (str, optional): one of PIVOT_LAYOUTS, layout of the pivot table. Defaults to 'crosstab'.
+        materialized (bool, optional): create materialized views indexed for serving, see MATERIALIZED_VIEW_INDEXES.
+            Defaults to False.
+        geometry_tiers (bool, optional): for polygon units, also select the simplified geometry of each tier from
+            the <geography>_tiers materialized view, see geomtier. Defaults to False.
     """    
 
     # extract metadata from pivot_table_name
-    output, hunit, model, resolution, _ = pivot_table_name.split('_')
-
-    # account for dam naming variation
-    hunit_table = ""
-    if hunit == "reservoirdam":
-        hunit_table = "grandv13hydrostn30_dam_{}".format(resolution)
-    else:
-        hunit_table = "hydrostn30_{}_{}".format(hunit, resolution)
+    output = TableName.parse(pivot_table_name).output
+    hunit_table = hunit_table_name(pivot_table_name)
+    tier_columns, tier_join = geometry_tier_join(pivot_table_name) if geometry_tiers else ('', '')
 
     VIEW_TEMPLATE="""
-CREATE OR REPLACE VIEW "{view_name}" AS
+{create_view} "{view_name}" AS
 SELECT sampleid, 
         {unpack_columns}
-        hstn.*
+        hstn.*{tier_columns}
 FROM "{schema}"."{pivot_table_name}"
-INNER JOIN {hunit_table} hstn on sampleid=hstn.id
+INNER JOIN {hunit_table} hstn on sampleid=hstn.id{tier_join}
 ORDER BY sampleid;
 """
     def _unpack_columns(output, year):
-        annual_template = "(\"{output}_{year}\").annual as \"{output}_{year}_annual\","
-        monthly_template = "(\"{output}_{year}\").monthly[{month_num}] as \"{output}_{year}_{month_num_zeropad}\","
+        annual_template = "({source}).annual as \"{output}_{year}_annual\","
+        monthly_template = "({source}).monthly[{month_num}] as \"{output}_{year}_{month_num_zeropad}\","
+        source = pivot_year_column(output, year, year_start, layout)
 
-        cols = [annual_template.format(output=output, year=year),]
+        cols = [annual_template.format(source=source, output=output, year=year),]
         for i in range(1,13):
-            month_col = monthly_template.format(output=output, year=year, month_num=i, month_num_zeropad=str(i).zfill(2))
+            month_col = monthly_template.format(source=source, output=output, year=year, month_num=i, month_num_zeropad=str(i).zfill(2))
             cols.append(month_col)
         
         return "\n".join(cols)
@@ -142,7 +346,10 @@ ORDER BY sampleid;
         unp_cols = _unpack_columns(output, y)
 
         view_sql = VIEW_TEMPLATE.format(schema=schema, view_name=view_name, unpack_columns=unp_cols, 
-        pivot_table_name=pivot_table_name, hunit_table=hunit_table)
+        pivot_table_name=pivot_table_name, hunit_table=hunit_table, tier_columns=tier_columns, tier_join=tier_join,
+        create_view='CREATE MATERIALIZED VIEW' if materialized else 'CREATE OR REPLACE VIEW')
+        if materialized:
+            view_sql += MATERIALIZED_VIEW_INDEXES.format(schema=schema, view_name=view_name)
         
         sql.append(view_sql)
     
@@ -162,89 +369,52 @@ def group2_create_pivot(schema, output, monthly_table, annual_table, pivot_table
         year_end (int): ending year of data
     """
 
-    GROUP2_TEMPLATE="""
-SET search_path="{schema}", public;
-
-CREATE TEMP TABLE bbb AS
-SELECT a.sampleid as sampleid, a.year as year, (annual_zonalmean, annual_zonalmin, annual_zonalmax, monthly_zonalmean,
-                                                monthly_zonalmin, monthly_zonalmax)::model_output_zonal_annual_monthly as zonal_output FROM
-(SELECT sampleid, year, array_agg(zonalmean ORDER BY month ASC) as monthly_zonalmean,
-        array_agg(zonalmin ORDER BY month ASC) as monthly_zonalmin,
-        array_agg(zonalmax ORDER BY month ASC) as monthly_zonalmax
-FROM "{schema}"."{monthly_table}"
-GROUP BY sampleid,year) a
-INNER JOIN
-(SELECT sampleid, year, zonalmean as annual_zonalmean, zonalmin as annual_zonalmin, zonalmax as annual_zonalmax
-    FROM "{schema}"."{annual_table}"
-    ) b
-ON a.sampleid=b.sampleid AND a.year = b.year
-ORDER BY sampleid, year;
-
-DROP TABLE IF EXISTS "{schema}"."{pivot_table_name}";
-CREATE TABLE "{schema}"."{pivot_table_name}" AS
-	SELECT ct.sampleid,
-       {pivot_table_columns}
-FROM crosstab('SELECT sampleid, year, zonal_output
-        FROM bbb
-        ORDER BY sampleid'::text, 
-'{sel_years}'::text) ct(sampleid bigint, {crosstab_columns});
-
-DROP TABLE bbb;
-
-ALTER TABLE "{schema}"."{pivot_table_name}" ADD PRIMARY KEY (sampleid);
-
--- DROP monthly/annual tables
-"""
-    sel_years = select_years(year_start, year_end)
-    ptbl_cols = pivot_table_columns(year_start, year_end, output)
-    ct_cols = group2_crosstab_columns(year_start, year_end, output)
-
-    sql = GROUP2_TEMPLATE.format(schema=schema, output=output, monthly_table=monthly_table, annual_table=annual_table, pivot_table_name=pivot_table_name,
-    pivot_table_columns=ptbl_cols, sel_years=sel_years, crosstab_columns=ct_cols)
-
-    return sql
+    return _join_statements(group2_pivot_statements(schema, output, monthly_table, annual_table, pivot_table_name,
+                                                    year_start=year_start, year_end=year_end))
 
 
-def group2_create_yearly_views(schema, pivot_table_name, year_start=1958, year_end=2019):
-    """Create yearly views for pivot tables created by group2_create_pivot
+def group2_create_yearly_views(schema, pivot_table_name, year_start=1958, year_end=2019, layout='crosstab',
+                              materialized=False, geometry_tiers=False):
+    """Create yearly views for pivot tables created by group2_create_pivot or group2_create_array_pivot
 
     Args:
         schema (str): schema of postgres database
         pivot_table_name (str): name of pivot table being referenced
         year_start (int, optional): Start year of data. Defaults to 1958.
         year_end (int, optional): End year of data. Defaults to 2019.
+        layout (str, optional): one of PIVOT_LAYOUTS, layout of the pivot table. Defaults to 'crosstab'.
+        materialized (bool, optional): create materialized views indexed for serving, see MATERIALIZED_VIEW_INDEXES.
+            Defaults to False.
+        geometry_tiers (bool, optional): for polygon units, also select the simplified geometry of each tier from
+            the <geography>_tiers materialized view, see geomtier. Defaults to False.
     """    
 
     # extract metadata from pivot_table_name
-    output, hunit, model, resolution, _ = pivot_table_name.split('_')
-
-    # account for dam naming variation
-    hunit_table = ""
-    if hunit in ('state','country'):
-        hunit_table = "faogaul_{}_{}".format(hunit,resolution)
-    else:
-        hunit_table = "hydrostn30_{}_{}".format(hunit, resolution)
+    output = TableName.parse(pivot_table_name).output
+    hunit_table = hunit_table_name(pivot_table_name)
+    tier_columns, tier_join = geometry_tier_join(pivot_table_name) if geometry_tiers else ('', '')
 
     VIEW_TEMPLATE="""
-CREATE OR REPLACE VIEW "{view_name}" AS
+{create_view} "{view_name}" AS
 SELECT sampleid, 
         {unpack_columns}
-        hstn.*
+        hstn.*{tier_columns}
 FROM "{schema}"."{pivot_table_name}"
-INNER JOIN {hunit_table} hstn on sampleid=hstn.id
+INNER JOIN {hunit_table} hstn on sampleid=hstn.id{tier_join}
 ORDER BY sampleid;
 """
     def _unpack_columns(output, year):
         zonal_aggregations = ['zonalmean', 'zonalmin', 'zonalmax']
 
-        annual_template = "(\"{output}_{year}\").annual_{zonal_agg} as \"{output}_{year}_annual_{zonal_agg}\","
-        monthly_template = "(\"{output}_{year}\").monthly_{zonal_agg}[{month_num}] as \"{output}_{year}_{month_num_zeropad}_{zonal_agg}\","
+        annual_template = "({source}).annual_{zonal_agg} as \"{output}_{year}_annual_{zonal_agg}\","
+        monthly_template = "({source}).monthly_{zonal_agg}[{month_num}] as \"{output}_{year}_{month_num_zeropad}_{zonal_agg}\","
+        source = pivot_year_column(output, year, year_start, layout)
 
         cols = []
         for z in zonal_aggregations:
-            cols.append(annual_template.format(output=output, year=year, zonal_agg=z))
+            cols.append(annual_template.format(source=source, output=output, year=year, zonal_agg=z))
             for i in range(1,13):
-                month_col = monthly_template.format(output=output, year=year, month_num=i, month_num_zeropad=str(i).zfill(2), zonal_agg=z)
+                month_col = monthly_template.format(source=source, output=output, year=year, month_num=i, month_num_zeropad=str(i).zfill(2), zonal_agg=z)
                 cols.append(month_col)
         
         return "\n".join(cols)
@@ -258,12 +428,297 @@ ORDER BY sampleid;
         unp_cols = _unpack_columns(output, y)
 
         view_sql = VIEW_TEMPLATE.format(schema=schema, view_name=view_name, unpack_columns=unp_cols, 
-        pivot_table_name=pivot_table_name, hunit_table=hunit_table)
+        pivot_table_name=pivot_table_name, hunit_table=hunit_table, tier_columns=tier_columns, tier_join=tier_join,
+        create_view='CREATE MATERIALIZED VIEW' if materialized else 'CREATE OR REPLACE VIEW')
+        if materialized:
+            view_sql += MATERIALIZED_VIEW_INDEXES.format(schema=schema, view_name=view_name)
         
         sql.append(view_sql)
     
     return "\n".join(sql), view_names_full
 
+# view generation modes: a view per year, a materialized view per year, or one long format view with a function
+# selecting a year
+VIEW_MODES = ('yearly', 'materialized', 'long')
+
+LONG_VIEW_TEMPLATE = """
+CREATE OR REPLACE VIEW "{schema}"."{view_name}" AS
+SELECT m.sampleid, m.year, m.month, {monthly_values}, hstn.*
+FROM "{schema}"."{monthly_table}" m
+INNER JOIN {hunit_table} hstn on m.sampleid=hstn.id
+UNION ALL
+SELECT a.sampleid, a.year, NULL, {annual_values}, hstn.*
+FROM "{schema}"."{annual_table}" a
+INNER JOIN {hunit_table} hstn on a.sampleid=hstn.id;
+
+CREATE OR REPLACE FUNCTION "{schema}"."{function_name}"(p_year integer)
+RETURNS SETOF "{schema}"."{view_name}"
+LANGUAGE sql STABLE AS
+$$ SELECT * FROM "{schema}"."{view_name}" WHERE year = p_year ORDER BY sampleid, month NULLS FIRST $$;
+"""
+
+# index on the tables read by a long format view, so its year function reads one year instead of every row
+LONG_VIEW_INDEX_TEMPLATE = 'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{schema}"."{table}" (year, sampleid);\n'
+
+
+# indexes of a materialized yearly view: unique on sampleid (needed by REFRESH ... CONCURRENTLY) and GiST on the
+# geometry columns coming from the geography table, looked up from the catalog as their name depends on the import
+MATERIALIZED_VIEW_INDEXES = """CREATE UNIQUE INDEX ON "{schema}"."{view_name}" (sampleid);
+DO $$
+DECLARE
+    geom_col name;
+BEGIN
+    FOR geom_col IN SELECT a.attname FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+                    WHERE a.attrelid = '"{schema}"."{view_name}"'::regclass AND a.attnum > 0 AND t.typname = 'geometry'
+    LOOP
+        EXECUTE format('CREATE INDEX ON %I.%I USING GIST (%I)', '{schema}', '{view_name}', geom_col);
+    END LOOP;
+END $$;
+"""
+
+
+def refresh_materialized_views(view_names):
+    """Refresh script of materialized yearly views. Each view is refreshed CONCURRENTLY in its own transaction, so
+    readers keep being served the previous contents while it runs, and a view is only locked against other
+    refreshes for its own duration.
+
+    Args:
+        view_names (list): schema qualified names of materialized views
+
+    Returns:
+        str: sql
+    """
+    return "".join('REFRESH MATERIALIZED VIEW CONCURRENTLY {};\n'.format(v) for v in view_names)
+
+
+def hunit_table_name(pivot_table_name):
+    """Geography table the views of a pivot table join, from the hydrological unit in its name
+
+    Args:
+        pivot_table_name (str): name of pivot table ie discharge_confluence_terra+wbm04_01min_pivot
+
+    Returns:
+        str: geography table name, unqualified
+    """
+    return TableName.parse(pivot_table_name).hunit_table()
+
+
+def geometry_tier_join(pivot_table_name):
+    """Columns and join adding the geometry tiers of the geography (see geomtier) to the yearly views of a pivot
+    table, empty for units which aren't polygons
+
+    Returns:
+        str, str: select columns, join clause
+    """
+    name = TableName.parse(pivot_table_name)
+    if not name.is_polygon:
+        return '', ''
+    tiers_view, _ = geometry_tier_names(name.hunit_table())
+    columns = ''.join(',\n        tiers.{}'.format(tier_column(t)) for t, _ in GEOMETRY_TIERS if tier_column(t))
+    return columns, '\nLEFT JOIN "{}" tiers on hstn.id=tiers.id'.format(tiers_view)
+
+
+def long_view_names(pivot_table_name):
+    """Names of the long format view and year function replacing the yearly views of a pivot table
+
+    Returns:
+        str, str: view name, function name
+    """
+    return pivot_table_name.replace('pivot', 'long'), pivot_table_name.replace('pivot', 'by_year')
+
+
+def create_long_view(group, schema, output, monthly_table, annual_table, pivot_table_name):
+    """Create one long format view, a row per sampleid, year and month (NULL for the annual value), in place of the
+    yearly views of a pivot table. A set returning function taking the year returns the rows of one year, it is
+    inlined by the planner so the year filter reaches both tables and their (year, sampleid) index, see
+    long_view_index_statements. The view reads the annual and monthly tables directly, no pivot table is needed.
+    As the view depends on them, reload those tables with swap, update or delta imports, which keep dependent views,
+    an overwriting import can't drop them. Publish the function rather than the view, see geoserver.geoserver_sqlview.
+
+    Args:
+        group (str): 'group1' (value column) or 'group2' (zonalmean, zonalmin, zonalmax columns) output
+        schema (str): postgresql schema name
+        output (str): model output name
+        monthly_table (str): existing table with monthly data
+        annual_table (str): existing table with annual data
+        pivot_table_name (str): name of the pivot table the view replaces the yearly views of
+
+    Returns:
+        str, list, list: sql, schema qualified view name, schema qualified function name
+    """
+    if group == 'group1':
+        monthly_values = 'm."{}" as value'.format(output)
+        annual_values = 'a."{}"'.format(output)
+    else:
+        monthly_values = 'm.zonalmean, m.zonalmin, m.zonalmax'
+        annual_values = 'a.zonalmean, a.zonalmin, a.zonalmax'
+
+    view_name, function_name = long_view_names(pivot_table_name)
+    sql = LONG_VIEW_TEMPLATE.format(schema=schema, view_name=view_name, function_name=function_name,
+        monthly_table=monthly_table, annual_table=annual_table, monthly_values=monthly_values,
+        annual_values=annual_values, hunit_table=hunit_table_name(pivot_table_name))
+
+    return 'SET search_path="{}", public;\n'.format(schema) + sql, \
+        ['"{}"."{}"'.format(schema, view_name)], ['"{}"."{}"'.format(schema, function_name)]
+
+
+def long_view_index_statements(schema, monthly_table, annual_table):
+    """Statements indexing the monthly and annual tables of a long format view on (year, sampleid), taking the
+    place of the pivot table a long format view doesn't need. Existing indexes are kept.
+
+    Returns:
+        list: (stage, sql) tuples
+    """
+    statements = [('search_path', 'SET search_path="{}", public;\n'.format(schema))]
+    for stage, table in (('monthly_year_index', monthly_table), ('annual_year_index', annual_table)):
+        statements.append((stage, LONG_VIEW_INDEX_TEMPLATE.format(
+            schema=schema, table=table, index_name=pg_identifier(table, '_year_sampleid_idx'))))
+    return statements
+
+
+def geoserver_year_sql_view(function_name, default_year=1958):
+    """GeoServer SQL view definition selecting one year of a long format view through its function, the year
+    comes from the viewparams of the WMS/WFS request ie &viewparams=year:1990
+
+    Args:
+        function_name (str): schema qualified function name from create_long_view
+        default_year (int, optional): year served without viewparams. Defaults to 1958.
+
+    Returns:
+        dict: sql and parameters ({name: (default value, validation regex)}) of the SQL view
+    """
+    return dict(sql='SELECT * FROM {}(%year%)'.format(function_name),
+                parameters={'year': (str(default_year), r'^\d{4}$')})
+
+
+# stages of the statements creating a daily pivot table, aggregate runs once per year as aggregate_<year>
+DAILY_PIVOT_STAGES = ('search_path', 'drop_pivot', 'create', 'aggregate', 'primary_key')
+
+# daily value columns of group1/group2 outputs
+DAILY_PIVOT_VALUES = {'group1': ('{output}',), 'group2': ('zonalmean', 'zonalmin', 'zonalmax')}
+
+# every date of the year against the daily rows of each sampleid, so element i of the arrays is day i of the year
+# and days missing from the table are NULL rather than shifting the days after them
+DAILY_PIVOT_TEMPLATE = """SELECT s.sampleid, {year} as year, {aggregates}
+FROM (SELECT DISTINCT sampleid FROM "{schema}"."{daily_table}" WHERE year = {year}) s
+CROSS JOIN generate_series(make_date({year}, 1, 1), make_date({year}, 12, 31), interval '1 day') d(date)
+LEFT JOIN "{schema}"."{daily_table}" t ON t.sampleid = s.sampleid AND t.year = {year}
+    AND t.month = extract(month FROM d.date) AND t.day = extract(day FROM d.date)
+GROUP BY s.sampleid"""
+
+DAILY_ACCESSOR_TEMPLATE = """
+CREATE OR REPLACE FUNCTION "{schema}"."{date_function}"(p_date date)
+RETURNS TABLE(sampleid bigint, {value_types})
+LANGUAGE sql STABLE AS
+$$ SELECT sampleid::bigint, {day_values} FROM "{schema}"."{pivot_table_name}"
+   WHERE year = extract(year FROM p_date)::integer ORDER BY sampleid $$;
+
+CREATE OR REPLACE FUNCTION "{schema}"."{series_function}"(p_sampleid bigint, p_start date, p_end date)
+RETURNS TABLE(date date, {value_types})
+LANGUAGE sql STABLE AS
+$$ SELECT make_date(p.year::integer, 1, 1) + d.doy::integer - 1 AS date, {series_values}
+   FROM "{schema}"."{pivot_table_name}" p, unnest({value_columns}) WITH ORDINALITY d({series_columns}, doy)
+   WHERE p.sampleid = p_sampleid
+   AND p.year BETWEEN extract(year FROM p_start)::integer AND extract(year FROM p_end)::integer
+   AND make_date(p.year::integer, 1, 1) + d.doy::integer - 1 BETWEEN p_start AND p_end
+   ORDER BY 1 $$;
+"""
+
+
+def daily_pivot_name(pivot_table_name):
+    """Name of the daily pivot table next to the annual/monthly pivot table of a group
+
+    Args:
+        pivot_table_name (str): name of the annual/monthly pivot table ie discharge_confluence_terra+wbm04_01min_pivot
+
+    Returns:
+        str: daily pivot table name ie discharge_confluence_terra+wbm04_01min_daily_pivot
+    """
+    if pivot_table_name.endswith('_pivot'):
+        pivot_table_name = pivot_table_name[:-len('_pivot')]
+    return pg_identifier(pivot_table_name, '_daily_pivot')
+
+
+def daily_pivot_statements(group, schema, output, daily_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Statements creating a daily pivot table: one row per sampleid and year with the daily values of the year in
+    a real[] (one array per value column) indexed by day of year, element i is day i of the year and NULL if the
+    daily table lacks that day (ie February 29 of a 365 day calendar). That is ~1.5kB per sampleid and year rather
+    than a column per day.
+
+    The table is filled one year at a time, each statement aggregating a single year of the daily table (a single
+    partition of tables imported with partition_years), so the build never sorts or hashes the whole table.
+
+    Args:
+        group (str): 'group1' or 'group2' output
+        schema (str): postgresql schema name
+        output (str): model output name
+        daily_table (str): existing table with daily data
+        pivot_table_name (str): name of daily pivot table to be created, see daily_pivot_name
+        year_start (int): starting year of data
+        year_end (int): ending year of data
+
+    Returns:
+        list: (stage, sql) tuples in execution order, stages are DAILY_PIVOT_STAGES with aggregate_<year> per year
+    """
+    columns = [c.format(output=output) for c in DAILY_PIVOT_VALUES[group]]
+    aggregates = ', '.join('array_agg(t."{0}"::real ORDER BY d.date) as "{0}"'.format(c) for c in columns)
+    target = '"{}"."{}"'.format(schema, pivot_table_name)
+
+    def _select(year):
+        return DAILY_PIVOT_TEMPLATE.format(schema=schema, daily_table=daily_table, aggregates=aggregates, year=year)
+
+    statements = [
+        ('search_path', 'SET search_path="{}", public;'.format(schema)),
+        ('drop_pivot', 'DROP TABLE IF EXISTS {} CASCADE;'.format(target)),
+        ('create', 'CREATE TABLE {} AS\n{}\nWITH NO DATA;'.format(target, _select(year_start))),
+    ]
+    statements += [('aggregate_{}'.format(year), 'INSERT INTO {}\n{};'.format(target, _select(year)))
+                   for year in range(year_start, year_end + 1)]
+    statements.append(('primary_key', 'ALTER TABLE {} ADD PRIMARY KEY (sampleid, year);'.format(target)))
+    return statements
+
+
+def create_daily_pivot(group, schema, output, daily_table, pivot_table_name, year_start=1958, year_end=2019):
+    """Create daily pivot table, see daily_pivot_statements
+
+    Args:
+        see daily_pivot_statements
+    """
+    return _join_statements(daily_pivot_statements(group, schema, output, daily_table, pivot_table_name,
+                                                   year_start=year_start, year_end=year_end))
+
+
+def create_daily_accessors(group, schema, output, pivot_table_name):
+    """Create the accessor functions of a daily pivot table, in place of yearly views:
+    <daily pivot>_on(date) returns the values of every sampleid on one date (a map), ie for a GeoServer SQL view
+    joining the geography, <daily pivot>_series(sampleid, start, end) the dated values of one sampleid (a
+    hydrograph). Both are inlined by the planner, reading one row per sampleid and year through the primary key.
+
+    Args:
+        group (str): 'group1' or 'group2' output
+        schema (str): postgresql schema name
+        output (str): model output name
+        pivot_table_name (str): name of daily pivot table, see daily_pivot_name
+
+    Returns:
+        str, list: sql, schema qualified function names
+    """
+    columns = [c.format(output=output) for c in DAILY_PIVOT_VALUES[group]]
+    date_function = pg_identifier(pivot_table_name, '_on')
+    series_function = pg_identifier(pivot_table_name, '_series')
+
+    sql = DAILY_ACCESSOR_TEMPLATE.format(schema=schema, pivot_table_name=pivot_table_name,
+        date_function=date_function, series_function=series_function,
+        value_types=', '.join('"{}" real'.format(c) for c in columns),
+        day_values=', '.join('"{}"[extract(doy FROM p_date)::integer]'.format(c) for c in columns),
+        value_columns=', '.join('p."{}"'.format(c) for c in columns),
+        series_columns=', '.join('"{}"'.format(c) for c in columns),
+        series_values=', '.join('d."{}"'.format(c) for c in columns))
+
+    return 'SET search_path="{}", public;\n'.format(schema) + sql, \
+        ['"{}"."{}"'.format(schema, date_function), '"{}"."{}"'.format(schema, series_function)]
+
+
 #### TESTS (well more like demos) ####
 def _group1_create_pivot_test():
     output= "discharge"
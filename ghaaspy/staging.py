@@ -0,0 +1,145 @@
+"""Staging tables swapped atomically into place, so readers never see a missing or half loaded table"""
+
+import hashlib
+
+from psycopg2 import sql
+
+from .util import split_pg_tablename, pg_identifier
+
+# views depending on a table, recursively, with the depth they sit at
+DEPENDENT_VIEWS_SQL = """
+WITH RECURSIVE deps(oid, depth) AS (
+    SELECT r.ev_class, 1
+    FROM pg_depend d
+    JOIN pg_rewrite r ON d.objid = r.oid
+    WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = %(table)s::regclass AND r.ev_class <> d.refobjid
+  UNION
+    SELECT r.ev_class, deps.depth + 1
+    FROM deps
+    JOIN pg_depend d ON d.refobjid = deps.oid
+    JOIN pg_rewrite r ON d.objid = r.oid
+    WHERE d.classid = 'pg_rewrite'::regclass AND r.ev_class <> deps.oid
+)
+SELECT n.nspname, c.relname, c.relkind, pg_get_viewdef(c.oid), max(deps.depth) AS depth,
+       array(SELECT indexdef FROM pg_indexes i WHERE i.schemaname = n.nspname AND i.tablename = c.relname)
+FROM deps
+JOIN pg_class c ON c.oid = deps.oid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+GROUP BY n.nspname, c.relname, c.relkind, c.oid
+ORDER BY depth
+"""
+
+
+def staging_tablename(pg_table_name):
+    """Name of the staging table a postgres table is loaded into before being swapped in. Derived from a hash
+    so it stays well under the 63 character identifier limit.
+
+    Args:
+        pg_table_name (str): postgres table name in schema.table form
+
+    Returns:
+        str: staging table name in "schema"."table" form
+    """
+    schema, table = split_pg_tablename(pg_table_name)
+    return '"{}"."stg_{}"'.format(schema, hashlib.md5(table.encode()).hexdigest()[:16])
+
+
+def finalize_staging(conn, staging_table, logged=True):
+    """Make a bulk loaded staging table ready to serve: SET LOGGED, GiST indexes on geometry columns (postponed
+    during the load) and ANALYZE. The partitions of a partitioned table are set logged one by one.
+
+    SET LOGGED rewrites the table and, unless wal_level is minimal, writes all of it to the WAL, which gives
+    back much of what the UNLOGGED load saved. It is what makes the table survive a crash and reach replicas;
+    with logged=False the table stays UNLOGGED, it is emptied by crash recovery and reload is the only way back.
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        staging_table (str): staging table name in schema.table form
+        logged (bool, optional): SET LOGGED the table. Defaults to True.
+    """
+    target = sql.Identifier(*split_pg_tablename(staging_table))
+
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""SELECT n.nspname, c.relname FROM pg_partition_tree(%s) t
+                           JOIN pg_class c ON c.oid = t.relid JOIN pg_namespace n ON n.oid = c.relnamespace
+                           WHERE t.isleaf AND c.relpersistence = 'u'""",
+                        (target.as_string(cur),))
+            # a plain table is its own single leaf
+            for leaf_schema, leaf in (cur.fetchall() if logged else []):
+                cur.execute(sql.SQL('ALTER TABLE {} SET LOGGED').format(sql.Identifier(leaf_schema, leaf)))
+            cur.execute("""SELECT a.attname FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+                           WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+                           AND t.typname = 'geometry'""", (target.as_string(cur),))
+            for (geom_col,) in cur.fetchall():
+                cur.execute(sql.SQL('CREATE INDEX ON {} USING GIST ({})').format(target, sql.Identifier(geom_col)))
+            cur.execute(sql.SQL('ANALYZE {}').format(target))
+
+
+def _rename_owned(cur, schema, old_prefix, new_prefix, table):
+    """Rename indexes and sequences of table named after old_prefix so the next staging table can reuse the names"""
+    cur.execute("""SELECT c.relname, c.relkind FROM pg_class c
+                   WHERE c.oid IN (SELECT indexrelid FROM pg_index WHERE indrelid = %(table)s::regclass
+                                   UNION
+                                   SELECT objid FROM pg_depend
+                                   WHERE refobjid = %(table)s::regclass AND classid = 'pg_class'::regclass
+                                   AND deptype IN ('a', 'i'))
+                   AND c.relkind IN ('i', 'I', 'S') AND c.relname LIKE %(prefix)s""",
+                {'table': table, 'prefix': old_prefix.replace('_', r'\_') + '%'})
+    for relname, relkind in cur.fetchall():
+        new_name = (new_prefix + relname[len(old_prefix):])[:63]
+        cur.execute(sql.SQL('ALTER {} {} RENAME TO {}').format(
+            sql.SQL('SEQUENCE' if relkind == 'S' else 'INDEX'),
+            sql.Identifier(schema, relname), sql.Identifier(new_name)))
+
+
+def swap_staging(conn, staging_table, live_table):
+    """Replace live_table with staging_table in a single transaction. Views and materialized views depending on
+    the live table are dropped and recreated from their definitions (with their indexes) in the same
+    transaction, so they follow the new table. Grants and comments on those views are not carried over.
+
+    Args:
+        conn (psycopg2.extensions.connection): postgres connection
+        staging_table (str): staging table name in schema.table form
+        live_table (str): postgres table name in schema.table form
+    """
+    schema, live = split_pg_tablename(live_table)
+    _, staging = split_pg_tablename(staging_table)
+    live_id = sql.Identifier(schema, live)
+
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT to_regclass(%s)', (live_id.as_string(cur),))
+            exists = cur.fetchone()[0] is not None
+
+            views = []
+            if exists:
+                cur.execute(sql.SQL('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE').format(live_id))
+                cur.execute(DEPENDENT_VIEWS_SQL, {'table': live_id.as_string(cur)})
+                views = cur.fetchall()
+
+                for view_schema, view, relkind, _, _, _ in reversed(views):
+                    cur.execute(sql.SQL('DROP {} {}').format(
+                        sql.SQL('MATERIALIZED VIEW' if relkind == 'm' else 'VIEW'), sql.Identifier(view_schema, view)))
+                cur.execute(sql.SQL('DROP TABLE {}').format(live_id))
+
+            cur.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(sql.Identifier(schema, staging), sql.Identifier(live)))
+            _rename_owned(cur, schema, staging, live, live_id.as_string(cur))
+
+            # partitions are named after their table ie stg_<hash>_y1990 -> <live>_y1990
+            cur.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                           WHERE i.inhparent = %s::regclass""", (live_id.as_string(cur),))
+            for (partition,) in cur.fetchall():
+                if not partition.startswith(staging):
+                    continue
+                renamed = pg_identifier(live, partition[len(staging):])
+                cur.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(sql.Identifier(schema, partition),
+                                                                        sql.Identifier(renamed)))
+                _rename_owned(cur, schema, partition, renamed, sql.Identifier(schema, renamed).as_string(cur))
+
+            for view_schema, view, relkind, definition, _, indexdefs in views:
+                cur.execute(sql.SQL('CREATE {} {} AS {}').format(
+                    sql.SQL('MATERIALIZED VIEW' if relkind == 'm' else 'VIEW'),
+                    sql.Identifier(view_schema, view), sql.SQL(definition.rstrip().rstrip(';'))))
+                for indexdef in indexdefs:
+                    cur.execute(indexdef)
@@ -0,0 +1,261 @@
+"""Parsed GHAAS table names, and a catalog classifying and grouping thousands of them in one pass.
+
+Model output tables are named output_hunit_temporal_model_resolution once imported, ie
+brazil."discharge_confluence_annual_terra+wbm04_01min", geography tables after their geography table and
+resolution, ie brazil."hydrostn30_confluence_01min". Geopackage table names lack the model and resolution,
+ie Discharge_Confluence_annual. Pivot tables end with _pivot (_daily_pivot), yearly views with the year, long
+format views with _long.
+"""
+
+import re
+from collections import OrderedDict
+
+TEMPORAL_CLASSES = ('annual', 'monthly', 'daily')
+
+# kind of table: geography, model output, pivot table of model outputs, yearly view of a pivot table, long format
+# view of model outputs
+TABLE_KINDS = ('geography', 'model', 'pivot', 'view', 'long')
+
+# hydrological units of model output table names
+HUNITS = ('confluence', 'mouth', 'reservoirdam', 'basin', 'subbasin', 'country', 'state', 'river-mouth', 'rivermouth')
+
+# administrative units, their geography has -9999 rows without geometry
+ADMIN_HUNITS = ('country', 'state')
+
+# units whose geography is polygons, the others are points
+POLYGON_HUNITS = ('basin', 'subbasin') + ADMIN_HUNITS
+
+_RESOLUTION = re.compile(r'^\d+(min|sec|deg|km)$')
+# source of a geography table: network and its resolution ie hydrostn30, grandv13hydrostn30, or the faogaul
+# administrative units
+_GEOGRAPHY = re.compile(r'^([a-z][a-z0-9]*\d|faogaul)$')
+# unit of a geography table ie confluence, dam, river-mouth
+_UNIT = re.compile(r'^[a-z][a-z-]*$')
+_YEAR = re.compile(r'^\d{4}$')
+
+
+class TableName:
+    """Parsed postgres or geopackage table name. Fields which don't apply or can't be told from the name are None,
+    parsing never fails on unexpected names.
+
+    Attributes:
+        raw (str): name as given, ie brazil."discharge_confluence_annual_terra+wbm04_01min"
+        schema (str): unquoted schema or None
+        table (str): unquoted table name
+        output (str): lowercase model output ie discharge
+        hunit (str): lowercase hydrological unit ie confluence, for geography tables the geography table
+            ie hydrostn30_confluence
+        temporal (str): one of TEMPORAL_CLASSES or None
+        model (str): lowercase model short name ie terra+wbm04
+        resolution (str): lowercase resolution ie 01min
+        kind (str): one of TABLE_KINDS
+        year (int): year of a yearly view
+    """
+    __slots__ = ('raw', 'schema', 'table', 'output', 'hunit', 'temporal', 'model', 'resolution', 'kind', 'year')
+
+    def __init__(self, raw, schema, table, output=None, hunit=None, temporal=None, model=None, resolution=None,
+                 kind='model', year=None):
+        self.raw = raw
+        self.schema = schema
+        self.table = table
+        self.output = output
+        self.hunit = hunit
+        self.temporal = temporal
+        self.model = model
+        self.resolution = resolution
+        self.kind = kind
+        self.year = year
+
+    @classmethod
+    def parse(cls, raw):
+        """Parse a table name with or without schema, quoted or not
+
+        Args:
+            raw (str): table name ie brazil."discharge_confluence_annual_terra+wbm04_01min" or Discharge_Confluence_annual
+
+        Returns:
+            TableName
+        """
+        schema, table = _split_schema(raw)
+        parts = table.lower().split('_')
+        temporal = next((p for p in parts if p in TEMPORAL_CLASSES), None)
+        if temporal is not None:
+            parts.remove(temporal)
+
+        # geography: source, unit and, once imported, resolution, without the temporal class and model of outputs
+        if temporal is None and len(parts) in (2, 3) and _GEOGRAPHY.match(parts[0]) and _UNIT.match(parts[1]) \
+                and (len(parts) == 2 or _RESOLUTION.match(parts[2])):
+            resolution = parts.pop() if len(parts) == 3 else None
+            return cls(raw, schema, table, hunit='_'.join(parts), resolution=resolution, kind='geography')
+
+        kind, year = 'model', None
+        if len(parts) > 1 and parts[-1] == 'pivot':
+            kind = 'pivot'
+            parts.pop()
+            # daily pivot tables, see sqlgen.daily_pivot_name
+            if parts[-1] == 'daily':
+                temporal = parts.pop()
+        elif len(parts) > 1 and _YEAR.match(parts[-1]):
+            kind, year = 'view', int(parts.pop())
+        # long format views, see sqlgen.long_view_names
+        elif len(parts) > 1 and parts[-1] == 'long':
+            kind = 'long'
+            parts.pop()
+
+        resolution = parts.pop() if len(parts) > 1 and _RESOLUTION.match(parts[-1]) else None
+        model = parts.pop() if resolution is not None and len(parts) > 2 else None
+
+        output = hunit = None
+        if len(parts) >= 2:
+            # sediment geopackages put the unit first ie River-Mouth_BedloadFlux
+            if parts[0] in HUNITS and parts[1] not in HUNITS:
+                hunit, output = parts[0], '_'.join(parts[1:])
+            else:
+                output, hunit = parts[0], '_'.join(parts[1:])
+        elif parts:
+            output = parts[0]
+
+        return cls(raw, schema, table, output=output, hunit=hunit, temporal=temporal, model=model,
+                   resolution=resolution, kind=kind, year=year)
+
+    @property
+    def key(self):
+        """Lowercase table name without its temporal class, shared by the annual/monthly/daily tables of an output"""
+        parts = self.table.lower().split('_')
+        if self.temporal in parts:
+            parts.remove(self.temporal)
+        return '_'.join(parts)
+
+    @property
+    def group_key(self):
+        """key prefixed with the schema as written in raw, ie brazil."discharge_confluence_terra+wbm04_01min" """
+        end = len(self.raw) - (1 if self.raw.endswith('"') and self.raw != self.table else 0)
+        start = end - len(self.table)
+        return self.raw[:start].lower() + self.key + self.raw[end:]
+
+    @property
+    def is_admin(self):
+        """Whether the table is on administrative units (faogaul country/state)"""
+        return self.hunit is not None and self.hunit.split('_')[-1] in ADMIN_HUNITS
+
+    @property
+    def is_polygon(self):
+        """Whether the geography of the table is polygons (basins, subbasins, countries, states)"""
+        return self.hunit is not None and self.hunit.split('_')[-1] in POLYGON_HUNITS
+
+    def hunit_table(self):
+        """Geography table joined to the values of a model output, pivot table or view, unqualified
+
+        Returns:
+            str: geography table name ie hydrostn30_confluence_01min, None for geography tables
+        """
+        if self.kind == 'geography' or self.hunit is None:
+            return None
+        if self.hunit == 'reservoirdam':
+            return 'grandv13hydrostn30_dam_{}'.format(self.resolution)
+        elif self.hunit in ADMIN_HUNITS:
+            return 'faogaul_{}_{}'.format(self.hunit, self.resolution)
+        return 'hydrostn30_{}_{}'.format(self.hunit, self.resolution)
+
+    def __eq__(self, other):
+        return isinstance(other, TableName) and self.raw == other.raw
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __repr__(self):
+        return 'TableName({!r})'.format(self.raw)
+
+
+def _split_schema(raw):
+    """Unquoted schema (or None) and table of a table name"""
+    if raw.startswith('"'):
+        end = raw.find('"', 1)
+        if end > 0 and raw[end + 1:end + 2] == '.':
+            return raw[1:end], raw[end + 2:].strip('"')
+        return None, raw.strip('"')
+    if '.' in raw:
+        schema, table = raw.split('.', 1)
+        return schema, table.strip('"')
+    return None, raw
+
+
+class TableCatalog:
+    """Table names parsed and indexed by kind and by temporal group in a single pass, in the order given.
+
+    A temporal group holds the annual, monthly and daily tables of one output, hydrological unit, model and
+    resolution in one schema.
+    """
+
+    def __init__(self, table_names):
+        self.names = []
+        self.by_kind = {k: [] for k in TABLE_KINDS}
+        self._groups = OrderedDict()
+        for raw in table_names:
+            self.add(raw)
+
+    def add(self, raw):
+        """Parse and index one table name
+
+        Returns:
+            TableName
+        """
+        name = TableName.parse(raw)
+        self.names.append(name)
+        self.by_kind[name.kind].append(name)
+        if name.kind == 'model':
+            self._groups.setdefault((name.schema, name.key), {}).setdefault(name.temporal, name)
+        return name
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def geography(self):
+        """Raw names of geography tables"""
+        return [n.raw for n in self.by_kind['geography']]
+
+    def model(self):
+        """Raw names of every table which isn't geography, as group_geography_vs_model splits them"""
+        return [n.raw for n in self.names if n.kind != 'geography']
+
+    def temporal_groups(self):
+        """Model output tables grouped with their other temporal classes
+
+        Returns:
+            OrderedDict: {(schema, key): {temporal class or None: TableName}}
+        """
+        return self._groups
+
+
+def _benchmark(n=100000):
+    """Parse and group n synthetic table names, reporting names per second"""
+    import time
+
+    outputs = ('discharge', 'runoff', 'evapotranspiration', 'soilmoisture', 'riverwidth')
+    hunits = ('confluence', 'basin', 'subbasin', 'country', 'reservoirdam')
+    names = []
+    i = 0
+    while len(names) < n:
+        schema = 'region{}'.format(i % 50)
+        model = 'terra+wbm{:02d}'.format(i // 50)
+        for output in outputs:
+            for hunit in hunits:
+                for temporal in TEMPORAL_CLASSES:
+                    names.append('{}."{}_{}_{}_{}_01min"'.format(schema, output, hunit, temporal, model))
+        names.append('{}."hydrostn30_confluence_01min"'.format(schema))
+        i += 1
+    names = names[:n]
+
+    start = time.perf_counter()
+    catalog = TableCatalog(names)
+    groups = catalog.temporal_groups()
+    seconds = time.perf_counter() - start
+    print('{} names, {} temporal groups, {} geography tables in {:.3f}s ({:.0f} names/s)'.format(
+        len(catalog), len(groups), len(catalog.geography()), seconds, len(catalog) / seconds))
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -1,5 +1,10 @@
 """Utility Functions"""
 
+import hashlib
+from pathlib import Path
+
+from .tablename import TableCatalog, TableName
+
 def sanitize_path(p):
     """Make arbitrary path object into absolute path
 
@@ -38,46 +43,55 @@ def group_geography_vs_model(table_names):
 
     Args:
         table_names (list): list of table names
+
+    Returns:
+        list, list: geography tables, model output tables (see tablename.TableCatalog)
     """
-    geography = []
-    model_out = []
-
-    for t in table_names:
-        if any(map(t.lower().__contains__, ['hydrostn','faogaul'])):
-            geography.append(t)
-        else:
-            model_out.append(t)
-    
-    return geography, model_out
+    catalog = TableCatalog(table_names)
+    return catalog.geography(), catalog.model()
 
 
 def clean_tablenames(table_names):
     """Deal with table names with/without embedded schema names. Assumes lists of tables will be self consistent.
 
     Args:
-        table_names ([type]): list of table names
-    
+        table_names (list): list of table names
+
     Returns:
-        schema (str): unquoted name of embedded schema or None
-        table_names (list of str): table_names w/out embedded schemas
+        schema (str): unquoted name of embedded schema or None, from the first table name
+        table_names (list of str): unquoted table_names w/out embedded schemas (see tablename.TableName)
+    """
+    names = [TableName.parse(t) for t in table_names]
+    return names[0].schema, [n.table for n in names]
+
+
+def split_pg_tablename(pg_table_name):
+    """Split a schema.table name as generated by import_gpkg into unquoted schema and table names
 
+    Args:
+        pg_table_name (str): table name in schema.table form ie "brazil"."discharge_confluence_annual_terra+wbm04_01min"
+
+    Returns:
+        str, str: schema, table
+    """
+    schema, table = pg_table_name.replace('"', '').split('.', 1)
+    return schema, table
+
+
+def pg_identifier(name, suffix=''):
+    """Postgres identifier of name followed by suffix, within the 63 character limit. Names too long are cut
+    short and kept distinct with a hash of the full name.
+
+    Args:
+        name (str): unquoted identifier ie a table name
+        suffix (str, optional): kept whole at the end of the identifier. Defaults to ''.
+
+    Returns:
+        str: unquoted identifier
     """
-    import re 
-
-    def _remove_embedded_quotes(t):
-        if t.startswith('"'):
-            t = t[1:]
-        if t.endswith('"'):
-            t = t[:-1]
-        return t
-
-    # check first table name for schema
-    if re.match(r'^"?((\w|-)+|\"(\w|-)+\")"?\."?(\w|-|\+)+"?$', table_names[0]):
-        schema = table_names[0].split('.')[0].replace('"','')
-        tables_clean = [_remove_embedded_quotes(t.split('.')[1]) for t in table_names]
-        return schema, tables_clean
-    else:
-        return None, [_remove_embedded_quotes(t) for t in table_names]
+    if len(name) + len(suffix) <= 63:
+        return name + suffix
+    return '{}_{}{}'.format(name[:63 - len(suffix) - 9], hashlib.md5(name.encode()).hexdigest()[:8], suffix)
 
     
 def copy_dirstruct(inputdir:Path, outputpath:Path, relativeto:Path) -> Path:
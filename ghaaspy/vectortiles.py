@@ -0,0 +1,385 @@
+"""Mapbox vector tiles of pivot tables rendered with ST_AsMVT and cached in MBTiles files, for static serving.
+
+Every year of a pivot table gets its own MBTiles file named after its yearly view ie
+discharge_confluence_terra+wbm04_01min_1990.mbtiles, holding one layer of that name with the same columns as the
+view. Regenerating a year rewrites its file only. Files are written under a temporary name and moved into place
+once complete, so a tile server keeps serving the previous file meanwhile.
+
+Tiles are rendered a zoom level at a time, in batches over pooled connections, and only the children of tiles
+holding features are rendered at the next zoom level. Whether a tile holds features is told from the full geometry,
+not from its rendered tile: small polygons simplified away by a geometry tier or collapsed by ST_AsMVTGeom at low
+zoom levels still have their tiles rendered further down. Requires PostGIS 3 (ST_TileEnvelope).
+"""
+
+import gzip
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import quote
+
+from .geomtier import geometry_tier_names, tier_column, tier_for_scale
+from .sqlgen import GROUP1, yearly_value_columns
+from .tablename import TableName
+
+# web mercator covers latitudes up to
+MAX_LATITUDE = 85.0511287798
+
+# scale denominator of zoom level 0 with 256 pixel tiles of 0.28mm
+ZOOM0_SCALE_DENOMINATOR = 559082264.0287178
+
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+MBTILES_SCHEMA = """
+CREATE TABLE metadata (name text, value text);
+CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);
+CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+"""
+
+TILE_TEMPLATE = """SELECT ST_AsMVT(tile, %(layer)s, {extent}, 'geom') FROM (
+    SELECT p.sampleid, {values},
+           ST_AsMVTGeom(ST_Transform({geom}, 3857), ST_TileEnvelope(%(z)s, %(x)s, %(y)s), {extent}, {buffer}, true) AS geom
+    FROM "{schema}"."{pivot_table}" p
+    INNER JOIN {hunit_table} hstn ON p.sampleid = hstn.id{tier_join}
+    WHERE {geom} && ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), {srid})
+) tile
+WHERE geom IS NOT NULL"""
+
+# any feature in a tile, by the full geometry whichever tier is drawn
+TILE_EXISTS_TEMPLATE = """SELECT EXISTS (
+    SELECT 1 FROM "{schema}"."{pivot_table}" p
+    INNER JOIN {hunit_table} hstn ON p.sampleid = hstn.id
+    WHERE hstn."{geom_column}" && ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), {srid})
+)"""
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """XYZ tile holding a point
+
+    Returns:
+        int, int: tile column, tile row counted from the north
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bounds(bounds, zoom):
+    """XYZ tiles of a zoom level covering bounds
+
+    Args:
+        bounds (tuple): west, south, east, north in degrees
+        zoom (int): zoom level
+
+    Returns:
+        list: (zoom, x, y) tuples
+    """
+    west, south, east, north = bounds
+    x0, y0 = lonlat_to_tile(west, north, zoom)
+    x1, y1 = lonlat_to_tile(east, south, zoom)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def tile_children(tile):
+    """The four tiles of the next zoom level covering tile"""
+    z, x, y = tile
+    return [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+
+
+def zoom_scale_denominator(zoom):
+    """Scale denominator a zoom level is drawn at"""
+    return ZOOM0_SCALE_DENOMINATOR / 2 ** zoom
+
+
+def pivot_tile_source(cur, schema, pivot_table, geometry_tiers=False):
+    """Layout, years and geography of a pivot table, everything needed to render its tiles
+
+    Args:
+        cur (psycopg2.extensions.cursor): postgres cursor
+        schema (str): schema of the pivot table
+        pivot_table (str): pivot table name ie runoff_basin_terra+wbm04_01min_pivot
+        geometry_tiers (bool, optional): draw polygon units with the geometry tier of each zoom level, see geomtier.
+            Defaults to False.
+
+    Returns:
+        dict: schema, pivot_table, output, group, layout, year_start, year_end, hunit_table, geom_column, srid,
+            bounds (west, south, east, north in degrees, None without geometry) and tiers_view (None without tiers)
+    """
+    name = TableName.parse(pivot_table)
+    output = name.output
+    source = dict(schema=schema, pivot_table=pivot_table, output=output, hunit_table=name.hunit_table(),
+                  group='group1' if output in GROUP1['outputs'] else 'group2', tiers_view=None)
+    table = '"{}"."{}"'.format(schema, pivot_table)
+
+    cur.execute('SET search_path="{}", public'.format(schema))
+    cur.execute("""SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0
+                   AND NOT attisdropped""", (table,))
+    columns = [c for (c,) in cur.fetchall()]
+    years = sorted(int(c[len(output) + 1:]) for c in columns if re.match(r'^{}_\d{{4}}$'.format(re.escape(output)), c))
+    if years:
+        source.update(layout='crosstab', year_start=years[0], year_end=years[-1])
+    elif output in columns:
+        # array pivots are subscripted by year, older ones counted from 1 and can't be told apart
+        cur.execute('SELECT min(array_lower("{0}", 1)), max(array_upper("{0}", 1)) FROM {1}'.format(output, table))
+        first, last = cur.fetchone()
+        if first is None:
+            raise ValueError("{} has no years".format(table))
+        if first == 1:
+            raise ValueError("{} is an array layout pivot table not subscripted by year, rebuild it".format(table))
+        source.update(layout='array', year_start=first, year_end=last)
+    else:
+        raise ValueError("{} is not a pivot table of {}".format(table, output))
+
+    cur.execute("""SELECT a.attname FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+                   WHERE a.attrelid = to_regclass(%s) AND a.attnum > 0 AND NOT a.attisdropped
+                   AND t.typname = 'geometry' ORDER BY a.attnum LIMIT 1""", (source['hunit_table'],))
+    row = cur.fetchone()
+    if row is None:
+        raise ValueError("no geometry column in {} joined by {}".format(source['hunit_table'], table))
+    source['geom_column'] = row[0]
+
+    cur.execute("""SELECT ST_SRID(hstn."{geom}"), ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+                   FROM (SELECT ST_Extent(ST_Transform(hstn."{geom}", 4326)) e FROM {table} p
+                         INNER JOIN {hunit_table} hstn ON p.sampleid = hstn.id) extent,
+                        (SELECT "{geom}" FROM {hunit_table} WHERE "{geom}" IS NOT NULL LIMIT 1) hstn
+                """.format(geom=source['geom_column'], table=table, hunit_table=source['hunit_table']))
+    row = cur.fetchone()
+    source['srid'], source['bounds'] = (row[0], tuple(row[1:])) if row and row[1] is not None else (4326, None)
+
+    if geometry_tiers and name.is_polygon:
+        tiers_view, _ = geometry_tier_names(source['hunit_table'])
+        cur.execute('SELECT to_regclass(%s)', (tiers_view,))
+        if cur.fetchone()[0] is None:
+            raise ValueError("{} is missing, prepare the geometry tiers first".format(tiers_view))
+        source['tiers_view'] = tiers_view
+
+    cur.execute('RESET search_path')
+    return source
+
+
+def tile_sql(source, year, zoom, extent=MVT_EXTENT, buffer=MVT_BUFFER):
+    """Query rendering one tile of a year of a pivot table, with z, x, y and layer parameters
+
+    Args:
+        source (dict): from pivot_tile_source
+        year (int): year of the values
+        zoom (int): zoom level, picks the geometry tier of polygon units drawn with tiers
+        extent (int, optional): tile extent in tile coordinates. Defaults to MVT_EXTENT.
+        buffer (int, optional): tile buffer in tile coordinates. Defaults to MVT_BUFFER.
+
+    Returns:
+        str: sql
+    """
+    geom, tier_join = 'hstn."{}"'.format(source['geom_column']), ''
+    column = tier_column(tier_for_scale(zoom_scale_denominator(zoom))) if source['tiers_view'] else None
+    if column is not None:
+        geom = 'tiers."{}"'.format(column)
+        tier_join = '\n    INNER JOIN "{}" tiers ON hstn.id = tiers.id'.format(source['tiers_view'])
+
+    values = ', '.join('{} AS "{}"'.format(expression, name) for expression, name in yearly_value_columns(
+        source['group'], source['output'], year, source['year_start'], source['layout']))
+    return TILE_TEMPLATE.format(values=values, geom=geom, tier_join=tier_join, extent=extent, buffer=buffer,
+                                schema=source['schema'], pivot_table=source['pivot_table'],
+                                hunit_table=source['hunit_table'], srid=source['srid'])
+
+
+def tile_exists_sql(source):
+    """Query telling whether a tile of a pivot table holds any feature, with z, x and y parameters. Checks the
+    bounding box of the full geometry only, much cheaper than rendering the tile.
+
+    Args:
+        source (dict): from pivot_tile_source
+
+    Returns:
+        str: sql
+    """
+    return TILE_EXISTS_TEMPLATE.format(schema=source['schema'], pivot_table=source['pivot_table'],
+                                       hunit_table=source['hunit_table'], geom_column=source['geom_column'],
+                                       srid=source['srid'])
+
+
+class MBTilesWriter:
+    """MBTiles file written under a temporary name and moved into place on commit. Tile rows are flipped to the TMS
+    scheme of MBTiles and tile data gzip compressed, as the MBTiles spec requires of vector tiles."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+        self.conn = sqlite3.connect(self.tmp_path)
+        # the file is only moved into place once complete, durability in between doesn't matter
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.executescript(MBTILES_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def write_tiles(self, tiles):
+        """Add (zoom, x, y, mvt bytes) tiles, in XYZ scheme"""
+        self.conn.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                              ((z, x, 2 ** z - 1 - y, gzip.compress(data, mtime=0)) for z, x, y, data in tiles))
+
+    def write_metadata(self, metadata):
+        """Set metadata entries, values which aren't strings are written as json"""
+        self.conn.execute('DELETE FROM metadata WHERE name IN ({})'.format(','.join('?' * len(metadata))),
+                          list(metadata))
+        self.conn.executemany('INSERT INTO metadata VALUES (?, ?)',
+                              ((k, v if isinstance(v, str) else json.dumps(v)) for k, v in metadata.items()))
+
+    def commit(self):
+        self.conn.commit()
+        self.conn.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.conn.close()
+        self.tmp_path.unlink()
+
+
+def read_mbtiles_tile(path, zoom, x, y):
+    """Decompressed tile of an MBTiles file, in XYZ scheme, None if missing"""
+    conn = sqlite3.connect('file:{}?mode=ro'.format(quote(str(path))), uri=True)
+    try:
+        row = conn.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                           (zoom, x, 2 ** zoom - 1 - y)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else gzip.decompress(row[0])
+
+
+def _render_tiles(db, schema, statements, exists_statement, layer, tiles):
+    """Render a batch of tiles on one pooled connection
+
+    Returns:
+        list, list: (zoom, x, y, mvt bytes) of the tiles rendered non-empty, (zoom, x, y) of the tiles holding
+            features, rendered or not
+    """
+    rendered = []
+    occupied = []
+    with db.transaction() as cur:
+        cur.execute('SET LOCAL search_path="{}", public'.format(schema))
+        for z, x, y in tiles:
+            cur.execute(statements[z], dict(z=z, x=x, y=y, layer=layer))
+            data = cur.fetchone()[0]
+            if data:
+                rendered.append((z, x, y, bytes(data)))
+                occupied.append((z, x, y))
+                continue
+            # features can render empty at this zoom level and still show further down
+            cur.execute(exists_statement, dict(z=z, x=x, y=y))
+            if cur.fetchone()[0]:
+                occupied.append((z, x, y))
+    return rendered, occupied
+
+
+def build_year_tiles(db, source, year, path, min_zoom=0, max_zoom=8, executor=None, batch_size=64):
+    """Render the tiles of one year of a pivot table into an MBTiles file, replacing the file
+
+    Args:
+        db (PostgresDB): database to render with
+        source (dict): from pivot_tile_source
+        year (int): year to render
+        path (Path): MBTiles file
+        min_zoom (int, optional): first zoom level. Defaults to 0.
+        max_zoom (int, optional): last zoom level. Defaults to 8.
+        executor (ThreadPoolExecutor, optional): runs the tile batches, its workers should not outnumber the
+            connections of db. Defaults to rendering in the calling thread.
+        batch_size (int, optional): tiles rendered per connection borrowed. Defaults to 64.
+
+    Returns:
+        dict: year, path, tiles, bytes (uncompressed) and seconds
+    """
+    start = time.perf_counter()
+    layer = source['pivot_table'].replace('pivot', str(year))
+    statements = {z: tile_sql(source, year, z) for z in range(min_zoom, max_zoom + 1)}
+    exists_statement = tile_exists_sql(source)
+    stats = dict(year=year, path=str(path), tiles=0, bytes=0, seconds=0.0)
+
+    with MBTilesWriter(path) as writer:
+        candidates = tiles_in_bounds(source['bounds'], min_zoom) if source['bounds'] else []
+        for zoom in range(min_zoom, max_zoom + 1):
+            batches = [candidates[i:i + batch_size] for i in range(0, len(candidates), batch_size)]
+            render_args = (db, source['schema'], statements, exists_statement, layer)
+            if executor is None:
+                results = (_render_tiles(*render_args, b) for b in batches)
+            else:
+                results = (f.result() for f in as_completed(
+                    [executor.submit(_render_tiles, *render_args, b) for b in batches]))
+
+            occupied = []
+            for tiles, batch_occupied in results:
+                writer.write_tiles(tiles)
+                occupied += batch_occupied
+                stats['tiles'] += len(tiles)
+                stats['bytes'] += sum(len(t[3]) for t in tiles)
+            candidates = [child for tile in sorted(occupied) for child in tile_children(tile)]
+
+        west, south, east, north = source['bounds'] or (-180, -MAX_LATITUDE, 180, MAX_LATITUDE)
+        fields = {'sampleid': 'Number'}
+        fields.update((name, 'Number') for _, name in yearly_value_columns(
+            source['group'], source['output'], year, source['year_start'], source['layout']))
+        writer.write_metadata(dict(
+            name=layer, format='pbf', type='overlay', minzoom=str(min_zoom), maxzoom=str(max_zoom),
+            bounds='{},{},{},{}'.format(west, south, east, north),
+            center='{},{},{}'.format((west + east) / 2, (south + north) / 2, min_zoom),
+            description='{} of "{}"."{}"'.format(year, source['schema'], source['pivot_table']),
+            json={'vector_layers': [dict(id=layer, fields=fields, minzoom=min_zoom, maxzoom=max_zoom)]}))
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def build_pivot_mbtiles(db, schema, pivot_table, output_dir, year_start=None, year_end=None, min_zoom=0, max_zoom=8,
+                        jobs=1, geometry_tiers=False, batch_size=64):
+    """Render MBTiles files of the years of a pivot table, one file per year named after its yearly view. Files of
+    other years in output_dir are left as they are, so a single updated year can be regenerated.
+
+    Args:
+        db (PostgresDB): database to render with, its pool should allow jobs connections
+        schema (str): schema of the pivot table
+        pivot_table (str): pivot table name
+        output_dir (Path): directory of the MBTiles files
+        year_start (int, optional): first year to render. Defaults to the first year of the pivot table.
+        year_end (int, optional): last year to render. Defaults to the last year of the pivot table.
+        min_zoom (int, optional): first zoom level. Defaults to 0.
+        max_zoom (int, optional): last zoom level. Defaults to 8.
+        jobs (int, optional): tile batches rendered concurrently. Defaults to 1.
+        geometry_tiers (bool, optional): see pivot_tile_source. Defaults to False.
+        batch_size (int, optional): see build_year_tiles. Defaults to 64.
+
+    Returns:
+        list: stats of each year from build_year_tiles
+    """
+    with db.transaction() as cur:
+        source = pivot_tile_source(cur, schema, pivot_table, geometry_tiers=geometry_tiers)
+
+    year_start = source['year_start'] if year_start is None else max(year_start, source['year_start'])
+    year_end = source['year_end'] if year_end is None else min(year_end, source['year_end'])
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for year in range(year_start, year_end + 1):
+            path = output_dir / '{}.mbtiles'.format(pivot_table.replace('pivot', str(year)))
+            stats = build_year_tiles(db, source, year, path, min_zoom=min_zoom, max_zoom=max_zoom,
+                                     executor=executor if jobs > 1 else None, batch_size=batch_size)
+            print('{} {} tiles, {:.1f}s'.format(path.name, stats['tiles'], stats['seconds']))
+            results.append(stats)
+    return results
@@ -8,12 +8,15 @@ setup(name='ghaaspy',
       author_email='dvignoles@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=['geoserver-rest', 'gdal',],
+      install_requires=['geoserver-rest', 'gdal', 'psycopg2'],
+      extras_require={'async': ['asyncpg'], 'numpy': ['numpy']},
       python_requires='>=3.9.2',      
       entry_points = {
           'console_scripts': ['gpkg2postgis=ghaaspy.cmd.gpkg2postgis:main', 
           'postgis2geoserver=ghaaspy.cmd.postgis2geoserver:main',
+          'postgis2mbtiles=ghaaspy.cmd.postgis2mbtiles:main',
           'postgis_pivot=ghaaspy.cmd.postgis_pivot:main',
+          'gpkg_pivot=ghaaspy.cmd.gpkg_pivot:main',
           'rgis2mosaic=ghaaspy.cmd.rgis2mosaic:main'],
       },
       package_data={'': ['ghaas_*.txt']},
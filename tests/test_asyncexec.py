@@ -0,0 +1,116 @@
+import unittest
+import asyncio
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from ghaaspy.asyncexec import *
+from ghaaspy.pivot import build_pivot_groups
+from ghaaspy.postgres import PostgresDB
+
+class FakePool:
+    """Stand-in for an asyncpg pool. Statements are logged as they run, 'FAIL' raises and 'SLOW' sleeps long enough
+    to be cancelled."""
+
+    def __init__(self):
+        self.log = []
+        self.active = self.max_active = 0
+        self.closed = False
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            yield self
+        finally:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, statement):
+        await asyncio.sleep(0.01)
+        if statement == 'FAIL':
+            raise RuntimeError('relation does not exist')
+        if statement == 'SLOW':
+            await asyncio.sleep(10)
+        self.log.append(statement)
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAsyncExec(unittest.TestCase):
+
+    def run_fake(self, batches, stop_after=None, **kwargs):
+        pool = FakePool()
+
+        async def create_pool(**kwargs):
+            return pool
+
+        async def stop_later(stop):
+            await asyncio.sleep(stop_after)
+            stop.set()
+
+        async def run():
+            stop = asyncio.Event()
+            if stop_after is not None:
+                asyncio.ensure_future(stop_later(stop))
+            return await run_batches_async(PostgresDB(verify=False), batches, progress=None, stop=stop, **kwargs)
+
+        with mock.patch('asyncpg.create_pool', create_pool):
+            results = asyncio.run(run())
+        self.assertTrue(pool.closed)
+        return pool, results
+
+    def test_pivot_batches(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"',
+                  '"se-asia"."discharge_confluence_annual_terra+wbm04_01min"',
+                  '"se-asia"."discharge_confluence_monthly_terra+wbm04_01min"']
+        batches = pivot_batches(build_pivot_groups(tables, year_start=1958, year_end=1960))
+
+        self.assertEqual([(b.schema, b.name) for b in batches],
+                         [('brazil', 'discharge_confluence_terra+wbm04_01min_pivot'),
+                          ('se-asia', 'discharge_confluence_terra+wbm04_01min_pivot')])
+        # pivot table before its views
+        self.assertIn('CREATE TABLE', batches[0].statements[0])
+        self.assertIn('CREATE OR REPLACE VIEW', batches[0].statements[1])
+
+    def test_run_batches(self):
+        batches = [SqlBatch(schema=s, name=str(i), statements=['{} {} a'.format(s, i), '{} {} b'.format(s, i)])
+                   for i in range(3) for s in ('brazil', 'se-asia', 'usa')]
+        batches.insert(1, SqlBatch(schema='brazil', name='broken', statements=['FAIL']))
+        pool, results = self.run_fake(batches, concurrency=2)
+
+        # in order within each schema, a failed batch doesn't stop the next ones
+        for schema in ('brazil', 'se-asia', 'usa'):
+            self.assertEqual([s for s in pool.log if s.startswith(schema)],
+                             ['{} {} {}'.format(schema, i, p) for i in range(3) for p in 'ab'])
+        self.assertEqual(pool.max_active, 2)
+
+        self.assertEqual([r.name for r in results], [b.name for b in batches])
+        self.assertEqual(results[1].status, 'failed')
+        self.assertEqual(results[1].error, 'relation does not exist')
+        self.assertEqual(sum(r.ok for r in results), 9)
+
+    def test_cancel(self):
+        batches = [SqlBatch(schema='brazil', name='slow', statements=['SLOW']),
+                   SqlBatch(schema='brazil', name='pending', statements=['brazil 1']),
+                   SqlBatch(schema='se-asia', name='waiting', statements=['se-asia 0'])]
+
+        pool, results = self.run_fake(batches, stop_after=0.05, concurrency=1)
+        self.assertEqual([r.status for r in results], ['cancelled'] * 3)
+        self.assertEqual(pool.log, [])
+
+        # a failure stops the run when asked to
+        batches = [SqlBatch(schema='brazil', name='broken', statements=['FAIL']),
+                   SqlBatch(schema='brazil', name='pending', statements=['brazil 1'])]
+        pool, results = self.run_fake(batches, concurrency=1, stop_on_error=True)
+        self.assertEqual([r.status for r in results], ['failed', 'cancelled'])
+        self.assertEqual(pool.log, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import unittest
+import sqlite3
+
+from ghaaspy.delta import *
+from ghaaspy.pgcopy import gpkg_copy_columns, copy_gpkg_table
+from ghaaspy.postgres import PostgresDB
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+
+TABLE_INFO = [(0, 'fid', 'INTEGER', 1, None, 1), (1, 'SampleID', 'INTEGER', 0, None, 0),
+              (2, 'Year', 'MEDIUMINT', 0, None, 0), (3, 'Month', 'MEDIUMINT', 0, None, 0),
+              (4, 'Discharge', 'REAL', 0, None, 0)]
+
+class TestDelta(unittest.TestCase):
+
+    def test_delta_keys(self):
+        monthly = gpkg_copy_columns([(0, 'fid', 'INTEGER', 1, None, 1), (1, 'SampleID', 'INTEGER', 0, None, 0),
+                                     (2, 'Year', 'MEDIUMINT', 0, None, 0), (3, 'Month', 'MEDIUMINT', 0, None, 0),
+                                     (4, 'Discharge', 'REAL', 0, None, 0)])
+        self.assertEqual(delta_keys(monthly), ['sampleid', 'year', 'month'])
+
+        no_period = gpkg_copy_columns([(0, 'fid', 'INTEGER', 1, None, 1), (1, 'SampleID', 'INTEGER', 0, None, 0),
+                                       (2, 'Discharge', 'REAL', 0, None, 0)])
+        self.assertIsNone(delta_keys(no_period))
+
+        no_sampleid = gpkg_copy_columns([(0, 'fid', 'INTEGER', 1, None, 1), (1, 'Year', 'MEDIUMINT', 0, None, 0)])
+        self.assertIsNone(delta_keys(no_sampleid))
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_merge_gpkg_table(self):
+        schema = 'ghaaspy-test'
+        pg_table = '"{}"."discharge_confluence_monthly_terra+wbm04_01min"'.format(schema)
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"'.format(schema))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        gpkg = sqlite3.connect(':memory:')
+        gpkg.execute('CREATE TABLE monthly (fid INTEGER PRIMARY KEY, SampleID INTEGER, Year MEDIUMINT, '
+                     'Month MEDIUMINT, Discharge REAL)')
+        gpkg.executemany('INSERT INTO monthly (SampleID, Year, Month, Discharge) VALUES (?, ?, ?, ?)',
+                         [(s, 1990, m, s * m) for s in (1, 2) for m in (1, 2)])
+        columns = gpkg_copy_columns(TABLE_INFO)
+        keys = delta_keys(columns)
+
+        with db.connection() as conn:
+            copy_gpkg_table(conn, gpkg, 'monthly', pg_table, columns)
+            self.assertEqual(changed_periods(conn, gpkg, 'monthly', pg_table, columns, keys), [])
+
+            # month 2 changed, month 3 new
+            gpkg.execute('UPDATE monthly SET Discharge = -1 WHERE Month = 2 AND SampleID = 2')
+            gpkg.executemany('INSERT INTO monthly (SampleID, Year, Month, Discharge) VALUES (?, ?, ?, ?)',
+                             [(1, 1990, 3, 3.0), (2, 1990, 3, 6.0)])
+            self.assertEqual(changed_periods(conn, gpkg, 'monthly', pg_table, columns, keys), [(1990, 2), (1990, 3)])
+
+            rows, periods, _ = merge_gpkg_table(conn, gpkg, 'monthly', pg_table, columns, keys)
+            self.assertEqual((rows, periods), (4, 2))
+            self.assertEqual(changed_periods(conn, gpkg, 'monthly', pg_table, columns, keys), [])
+
+            # two sampleids swapping values keep the sum of the period
+            gpkg.execute('UPDATE monthly SET Discharge = 3 - Discharge WHERE Month = 1')
+            self.assertEqual(changed_periods(conn, gpkg, 'monthly', pg_table, columns, keys), [(1990, 1)])
+            gpkg.execute('UPDATE monthly SET Discharge = 3 - Discharge WHERE Month = 1')
+
+            with conn.cursor() as cur:
+                cur.execute('SELECT sampleid, month, discharge FROM {} ORDER BY month, sampleid'.format(pg_table))
+                self.assertEqual(cur.fetchall(), [(1, 1, 1.0), (2, 1, 2.0), (1, 2, 2.0), (2, 2, -1.0),
+                                                  (1, 3, 3.0), (2, 3, 6.0)])
+                # new rows took ids from the sequence (updated rows use some up too), later plain inserts carry on
+                cur.execute('SELECT count(DISTINCT ogc_fid), max(ogc_fid) FROM {}'.format(pg_table))
+                distinct, max_fid = cur.fetchone()
+                self.assertEqual(distinct, 6)
+                cur.execute('INSERT INTO {} (sampleid, year, month) VALUES (3, 1990, 1) RETURNING ogc_fid'.format(
+                    pg_table))
+                self.assertGreater(cur.fetchone()[0], max_fid)
+            conn.rollback()
+
+    def drop_schema(self, db, schema):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import unittest
+
+from ghaaspy.geomtier import *
+from ghaaspy.postgres import PostgresDB
+from ghaaspy.sqlgen import group1_create_yearly_views, group2_create_yearly_views
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+
+class TestGeomTier(unittest.TestCase):
+
+    def test_tier_for_scale(self):
+        self.assertEqual(tier_for_scale(250000), 'full')
+        self.assertEqual(tier_for_scale(1000000), 'medium')
+        self.assertEqual(tier_for_scale(10000000), 'coarse')
+        self.assertEqual(tier_for_scale(100000000), 'overview')
+        self.assertIsNone(tier_column('full'))
+        self.assertEqual(tier_column('coarse'), 'geom_coarse')
+
+        # a pixel at 1:1,000,000 is 280m
+        self.assertAlmostEqual(tier_tolerance('medium'), 280 / 111320)
+        self.assertEqual(tier_scale_ranges()[-1], ('overview', 25000000, None))
+
+        rules = tier_style_rules('<PolygonSymbolizer>{geometry}</PolygonSymbolizer>')
+        self.assertEqual(rules.count('<Rule>'), len(GEOMETRY_TIERS))
+        self.assertIn('<MinScaleDenominator>5000000</MinScaleDenominator><MaxScaleDenominator>25000000'
+                      '</MaxScaleDenominator><PolygonSymbolizer><Geometry><ogc:PropertyName>geom_coarse', rules)
+
+    def test_geometry_tiers(self):
+        groups = [dict(schema='brazil', pivot_table='runoff_country_terra+wbm04_01min_pivot', layout='crosstab'),
+                  dict(schema='brazil', pivot_table='runoff_country_terra+wbm19_01min_pivot', layout='array'),
+                  dict(schema='brazil', pivot_table='discharge_confluence_terra+wbm04_01min_pivot', layout='crosstab'),
+                  dict(schema='brazil', pivot_table='runoff_basin_terra+wbm04_01min_daily_pivot', layout='daily')]
+        self.assertEqual(geometry_tier_targets(groups), [('brazil', 'faogaul_country_01min')])
+
+        sql = create_geometry_tiers('brazil', 'faogaul_country_01min')
+        self.assertIn('"brazil"."faogaul_country_01min_tiers" USING GIST (geom_overview)', sql)
+        self.assertIn('ST_Subdivide(%3$I, 256)', sql)
+
+        # polygon units join the tiers, point units are left as they were
+        view_sql, _ = group2_create_yearly_views('brazil', 'runoff_country_terra+wbm04_01min_pivot', 1958, 1959,
+                                                 geometry_tiers=True)
+        self.assertIn('tiers.geom_medium', view_sql)
+        self.assertIn('LEFT JOIN "faogaul_country_01min_tiers" tiers on hstn.id=tiers.id', view_sql)
+        self.assertEqual(group1_create_yearly_views('brazil', 'discharge_confluence_terra+wbm04_01min_pivot',
+                                                    geometry_tiers=True),
+                         group1_create_yearly_views('brazil', 'discharge_confluence_terra+wbm04_01min_pivot'))
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_refresh_geometry_tiers(self):
+        schema = 'ghaaspy-test'
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        # stand-ins for the views of create_geometry_tiers, which needs PostGIS
+        with db.transaction() as cur:
+            cur.execute("""DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"; SET search_path = "{0}";
+                CREATE TABLE faogaul_country_01min (id int, geom text);
+                CREATE TABLE "runoff_country_annual_terra+wbm04_01min" (sampleid int);
+                INSERT INTO faogaul_country_01min VALUES (1, 'a');
+                CREATE MATERIALIZED VIEW faogaul_country_01min_tiers AS SELECT id, geom AS geom_medium FROM faogaul_country_01min;
+                CREATE UNIQUE INDEX ON faogaul_country_01min_tiers (id);
+                CREATE MATERIALIZED VIEW faogaul_country_01min_subdivided AS
+                    SELECT id, row_number() OVER (PARTITION BY id) AS part, geom FROM faogaul_country_01min;
+                CREATE UNIQUE INDEX ON faogaul_country_01min_subdivided (id, part);
+                INSERT INTO faogaul_country_01min VALUES (2, 'b');
+                RESET search_path""".format(schema))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        # the views an overwriting import drops with the geography
+        self.assertEqual(tiered_geography(db, ['{}."faogaul_country_01min"'.format(schema),
+                                               '"{}"."runoff_country_annual_terra+wbm04_01min"'.format(schema)]),
+                         {'{}."faogaul_country_01min"'.format(schema): [(schema, 'faogaul_country_01min')]})
+
+        refreshed = refresh_geometry_tiers(db, ['{}."faogaul_country_01min"'.format(schema),
+                                                '"{}"."runoff_country_annual_terra+wbm04_01min"'.format(schema)])
+        self.assertEqual(refreshed, ['"ghaaspy-test"."faogaul_country_01min_subdivided"',
+                                     '"ghaaspy-test"."faogaul_country_01min_tiers"'])
+        with db.transaction() as cur:
+            for view in refreshed:
+                cur.execute('SELECT count(*) FROM {}'.format(view))
+                self.assertEqual(cur.fetchone()[0], 2)
+
+    def drop_schema(self, db, schema):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ghaaspy.geoserver import *
+
+class MockGeoserver(BaseHTTPRequestHandler):
+    """Stand-in for the featuretypes endpoint of the geoserver REST api. Layers named in fail_once answer 503 on
+    their first request, layers already in published answer 500 'already exists'."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        name = ET.fromstring(body).findtext('name')
+        with server.lock:
+            server.requests.append((self.path, body))
+            server.ports.add(self.client_address[1])
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            if name in server.fail_once:
+                server.fail_once.remove(name)
+                status, text = 503, 'busy'
+            elif name in server.published:
+                status, text = 500, "Resource named '{}' already exists in namespace".format(name)
+            else:
+                server.published.add(name)
+                status, text = 201, name
+        time.sleep(0.02)
+        with server.lock:
+            server.in_flight -= 1
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGeoserver(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockGeoserver)
+        self.server.lock = threading.Lock()
+        self.server.requests, self.server.ports, self.server.published = [], set(), set()
+        self.server.fail_once = {'runoff_country_terra-wbm04_01min_1990'}
+        self.server.in_flight = self.server.max_in_flight = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/geoserver/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_geoserver_sqlview(self):
+        self.assertEqual(geoserver_sqlview('brazil."runoff_country_terra+wbm04_01min_1990"'),
+                         ('runoff_country_terra-wbm04_01min_1990',
+                          'SELECT * FROM brazil."runoff_country_terra+wbm04_01min_1990" WHERE geom is not NULL',
+                          'sampleid'))
+        self.assertEqual(geoserver_sqlview('brazil.faogaul_country_01min', geography=True)[2], 'id')
+
+        # long format views are published through their year function, a row per sampleid and month
+        self.assertEqual(geoserver_sqlview('brazil."runoff_basin_terra+wbm04_01min_long"'),
+                         ('runoff_basin_terra-wbm04_01min_by_year',
+                          'SELECT * FROM "brazil"."runoff_basin_terra+wbm04_01min_by_year"(%year%)', 'sampleid,month'))
+        self.assertEqual(geoserver_sqlview_parameters('brazil."runoff_basin_terra+wbm04_01min_long"'),
+                         {'year': ('1958', r'^\d{4}$')})
+        self.assertEqual(geoserver_sqlview_parameters('brazil."runoff_country_terra+wbm04_01min_1990"'), {})
+
+    def test_publish_geoserver_sqlviews(self):
+        views = ['brazil."runoff_country_terra+wbm04_01min_{}"'.format(y) for y in range(1990, 2010)]
+        self.server.published.add('runoff_country_terra-wbm04_01min_2009')
+
+        with GeoserverSession(self.url, 'admin', 'geoserver', pool_size=4, backoff=0.01) as session:
+            results = publish_geoserver_sqlviews(session, views, 'brazil', 'ghaas', jobs=4)
+
+        self.assertEqual([r.view for r in results], views)
+        self.assertEqual([r.status for r in results], ['created'] * 19 + ['exists'])
+        self.assertEqual(results[0].attempts, 2)
+        self.assertEqual(results[0].status_code, 201)
+        report = publish_report(results)
+        self.assertEqual(report['counts'], {'created': 19, 'exists': 1})
+        self.assertEqual(report['attempts'], 21)
+
+        # concurrent requests over at most pool_size kept alive connections
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(len(self.server.ports), 4)
+
+        path, body = self.server.requests[0]
+        self.assertEqual(path, '/geoserver/rest/workspaces/ghaas/datastores/brazil/featuretypes')
+        virtual_table = ET.fromstring(body).find('metadata/entry/virtualTable')
+        self.assertEqual(virtual_table.findtext('keyColumn'), 'sampleid')
+        self.assertTrue(virtual_table.findtext('sql').startswith('SELECT * FROM brazil."runoff_country_terra+wbm04'))
+
+    def test_publish_long_view(self):
+        with GeoserverSession(self.url, 'admin', 'geoserver') as session:
+            result = session.publish_sqlview('brazil."runoff_basin_terra+wbm04_01min_long"', 'brazil', 'ghaas')
+        self.assertEqual((result.status, result.layer), ('created', 'runoff_basin_terra-wbm04_01min_by_year'))
+
+        _, body = self.server.requests[0]
+        virtual_table = ET.fromstring(body).find('metadata/entry/virtualTable')
+        self.assertEqual(virtual_table.findtext('sql'),
+                         'SELECT * FROM "brazil"."runoff_basin_terra+wbm04_01min_by_year"(%year%)')
+        self.assertEqual([k.text for k in virtual_table.findall('keyColumn')], ['sampleid', 'month'])
+        parameter = virtual_table.find('parameter')
+        self.assertEqual((parameter.findtext('name'), parameter.findtext('defaultValue'),
+                          parameter.findtext('regexpValidator')), ('year', '1958', r'^\d{4}$'))
+
+        # the other views have no parameters
+        body = featuretype_xml('runoff_country_terra-wbm04_01min_1990', 'ghaas', 'SELECT 1', 'sampleid')
+        self.assertIsNone(ET.fromstring(body).find('metadata/entry/virtualTable/parameter'))
+
+    def test_publish_failures(self):
+        self.server.fail_once.clear()
+        with GeoserverSession(self.url, 'admin', 'geoserver', retries=0) as session:
+            self.server.fail_once.add('runoff_country_terra-wbm04_01min_1990')
+            result = session.publish_sqlview('brazil."runoff_country_terra+wbm04_01min_1990"', 'brazil', 'ghaas')
+        self.assertFalse(result.ok)
+        self.assertEqual((result.status_code, result.attempts, result.error), (503, 1, 'busy'))
+
+        # nothing listening
+        with GeoserverSession('http://127.0.0.1:1/geoserver', 'admin', 'geoserver', retries=1, backoff=0.01) as session:
+            result = session.publish_sqlview('brazil.faogaul_country_01min', 'brazil', 'ghaas', geography=True)
+        self.assertEqual((result.status, result.status_code, result.attempts), ('failed', None, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,59 @@
+import os
 import unittest
+import sqlite3
+import tempfile
 from pathlib import Path
+from unittest import mock
 
 from ghaaspy.gpkg import *
 from ghaaspy.util import *
 from ghaaspy.pivot import *
+from ghaaspy.sqlgen import pivot_temp_tablename, PIVOT_STAGES, ARRAY_PIVOT_STAGES, geoserver_year_sql_view, \
+    refresh_materialized_views, daily_pivot_statements, create_daily_accessors
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+
+class FakeEngine:
+    """Import engine loading nothing, every table imports without rows"""
+
+    def __init__(self, pg_con, update=False, unlogged=False):
+        self.imported = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def import_table(self, catalog, pg_table_name, gpkg_table):
+        self.imported.append(pg_table_name)
+        return 0, '', None
+
+def _make_gpkg(path):
+    """Minimal geopackage with one attribute table and one feature table"""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE gpkg_contents (table_name TEXT PRIMARY KEY, data_type TEXT, identifier TEXT, description TEXT,
+                                    last_change DATETIME, min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                                    srs_id INTEGER);
+        CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, geometry_type_name TEXT,
+                                            srs_id INTEGER, z TINYINT, m TINYINT);
+        CREATE TABLE "Discharge_Confluence_annual" (fid INTEGER PRIMARY KEY, "SampleID" INTEGER, "Year" MEDIUMINT,
+                                                    "Discharge" REAL);
+        CREATE TABLE "hydroSTN30_Confluence" (fid INTEGER PRIMARY KEY, geom MULTIPOINT, "ID" INTEGER);
+        CREATE TABLE "rtree_hydroSTN30_Confluence_geom" (id INTEGER, minx REAL, maxx REAL, miny REAL, maxy REAL);
+        INSERT INTO gpkg_contents VALUES ('Discharge_Confluence_annual', 'attributes', NULL, '', NULL,
+                                          NULL, NULL, NULL, NULL, 0);
+        INSERT INTO gpkg_contents VALUES ('hydroSTN30_Confluence', 'features', NULL, '', NULL, -10, -5, 10, 5, 4326);
+        INSERT INTO gpkg_geometry_columns VALUES ('hydroSTN30_Confluence', 'geom', 'MULTIPOINT', 4326, 0, 0);
+        INSERT INTO "Discharge_Confluence_annual" VALUES (1, 1, 1958, 0.5);
+        INSERT INTO "Discharge_Confluence_annual" VALUES (2, 1, 1959, 1.5);
+        INSERT INTO "Discharge_Confluence_annual" VALUES (3, 2, 1958, 2.5);
+    """)
+    conn.commit()
+    conn.close()
+
 
 class TestGpkg(unittest.TestCase):
 
@@ -138,6 +188,437 @@ class TestGpkg(unittest.TestCase):
         self.assertEqual(sift_temporal_group(table_group1), {'annual':'my_table_annual', 'monthly':'my_table_monthly', 'daily':'my_table_daily'})
         self.assertEqual(sift_temporal_group(table_group2), {'annual':'my_table_annual', 'monthly':'my_table_monthly', 'daily':None})
 
+    def test_build_pivot_groups(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"',
+                  'brazil."runoff_basin_annual_terra+wbm04_01min"',
+                  'brazil."runoff_basin_monthly_terra+wbm04_01min"']
+        groups = build_pivot_groups(tables, year_start=1958, year_end=1960)
+
+        self.assertEqual(sorted(g['pivot_table'] for g in groups),
+                         ['discharge_confluence_terra+wbm04_01min_pivot', 'runoff_basin_terra+wbm04_01min_pivot'])
+        for g in groups:
+            self.assertEqual(g['schema'], 'brazil')
+            self.assertEqual(len(g['view_names']), 3)
+            # temp tables are named after the pivot table so groups can share a session
+            self.assertIn('CREATE TEMP TABLE {} AS'.format(pivot_temp_tablename(g['pivot_table'])), g['table_sql'])
+            # staged statements are the pivot table sql split up for timing
+            self.assertEqual(tuple(stage for stage, _ in g['table_statements']), PIVOT_STAGES)
+            for _, statement in g['table_statements']:
+                self.assertIn(statement, g['table_sql'])
+
+    def test_array_pivot_layout(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"']
+        group, = build_pivot_groups(tables, year_start=1958, year_end=1960, layout='array')
+
+        self.assertEqual(tuple(stage for stage, _ in group['table_statements']), ARRAY_PIVOT_STAGES)
+        self.assertNotIn('crosstab', group['table_sql'])
+        self.assertIn('generate_series(1958, 1960)', group['table_sql'])
+        # arrays are subscripted by year, their lower bound is the first year
+        self.assertIn('"discharge"[1958:1960])', group['table_sql'])
+        self.assertIn('("discharge"[1958]).annual as "discharge_1958_annual"', group['view_sql'])
+        self.assertIn('("discharge"[1960]).monthly[12] as "discharge_1960_12"', group['view_sql'])
+
+        with self.assertRaises(ValueError):
+            build_pivot_groups(tables, layout='columnar')
+
+    def test_long_views(self):
+        tables = ['brazil."runoff_basin_annual_terra+wbm04_01min"',
+                  'brazil."runoff_basin_monthly_terra+wbm04_01min"']
+        group, = build_pivot_groups(tables, year_start=1958, year_end=2019, views='long')
+
+        # one view and one function instead of a view per year
+        self.assertEqual(group['view_names'], ['"brazil"."runoff_basin_terra+wbm04_01min_long"'])
+        self.assertEqual(group['functions'], ['"brazil"."runoff_basin_terra+wbm04_01min_by_year"'])
+        self.assertIn('m.zonalmean, m.zonalmin, m.zonalmax', group['view_sql'])
+        self.assertIn('INNER JOIN hydrostn30_basin_01min hstn', group['view_sql'])
+
+        # no pivot table, the tables read by the view are indexed for the year function instead
+        self.assertEqual(group['layout'], 'long')
+        self.assertNotIn('runoff_basin_terra+wbm04_01min_pivot', group['table_sql'])
+        self.assertIn('CREATE INDEX IF NOT EXISTS "runoff_basin_monthly_terra+wbm04_01min_year_sampleid_idx" ON '
+                      '"brazil"."runoff_basin_monthly_terra+wbm04_01min" (year, sampleid)', group['table_sql'])
+        self.assertEqual([stage for stage, _ in group['table_statements']],
+                         ['search_path', 'monthly_year_index', 'annual_year_index'])
+
+        sql_view = geoserver_year_sql_view(group['functions'][0], default_year=1990)
+        self.assertEqual(sql_view['sql'], 'SELECT * FROM "brazil"."runoff_basin_terra+wbm04_01min_by_year"(%year%)')
+        self.assertEqual(sql_view['parameters']['year'][0], '1990')
+
+    def test_materialized_views(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"']
+        group, = build_pivot_groups(tables, year_start=1958, year_end=1959, views='materialized')
+
+        self.assertEqual(group['view_sql'].count('CREATE MATERIALIZED VIEW'), 2)
+        self.assertNotIn('CREATE OR REPLACE VIEW', group['view_sql'])
+        # concurrent refresh needs a unique index
+        self.assertIn('CREATE UNIQUE INDEX ON "brazil"."discharge_confluence_terra+wbm04_01min_1959" (sampleid)',
+                      group['view_sql'])
+        self.assertEqual(refresh_materialized_views(group['view_names']).splitlines()[0],
+                         'REFRESH MATERIALIZED VIEW CONCURRENTLY "brazil"."discharge_confluence_terra+wbm04_01min_1958";')
+
+    def test_pivot_year_spans(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"',
+                  'brazil."runoff_basin_annual_terra+wbm04_01min"',
+                  'brazil."runoff_basin_monthly_terra+wbm04_01min"']
+        spans = {('brazil', 'discharge_confluence_annual_terra+wbm04_01min'): (1990, 2000),
+                 ('brazil', 'discharge_confluence_monthly_terra+wbm04_01min'): (1989, 1999)}
+        groups = {g['pivot_table']: g for g in build_pivot_groups(tables, year_start=1958, year_end=2019, year_spans=spans)}
+
+        # sized to the years of both tables, groups without a span keep the given years
+        discharge = groups['discharge_confluence_terra+wbm04_01min_pivot']
+        self.assertEqual((discharge['year_start'], discharge['year_end']), (1989, 2000))
+        self.assertEqual(len(discharge['view_names']), 12)
+        self.assertNotIn('discharge_2001', discharge['table_sql'])
+        runoff = groups['runoff_basin_terra+wbm04_01min_pivot']
+        self.assertEqual((runoff['year_start'], runoff['year_end']), (1958, 2019))
+
+    def test_daily_pivot(self):
+        tables = ['brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_monthly_terra+wbm04_01min"',
+                  'brazil."discharge_confluence_daily_terra+wbm04_01min"',
+                  'brazil."runoff_basin_daily_terra+wbm04_01min"']
+        self.assertEqual(len(build_pivot_groups(tables, year_start=1958, year_end=1960)), 1)
+
+        groups = {g['pivot_table']: g for g in build_pivot_groups(tables, year_start=1958, year_end=1960, daily=True)}
+        self.assertEqual(sorted(groups), ['discharge_confluence_terra+wbm04_01min_daily_pivot',
+                                          'discharge_confluence_terra+wbm04_01min_pivot',
+                                          'runoff_basin_terra+wbm04_01min_daily_pivot'])
+
+        # built one year at a time
+        runoff = groups['runoff_basin_terra+wbm04_01min_daily_pivot']
+        self.assertEqual([stage for stage, _ in runoff['table_statements']],
+                         ['search_path', 'drop_pivot', 'create', 'aggregate_1958', 'aggregate_1959', 'aggregate_1960',
+                          'primary_key'])
+        self.assertIn('array_agg(t."zonalmax"::real ORDER BY d.date)', runoff['table_sql'])
+        self.assertEqual(runoff['view_names'], [])
+        self.assertEqual(runoff['functions'], ['"brazil"."runoff_basin_terra+wbm04_01min_daily_pivot_on"',
+                                               '"brazil"."runoff_basin_terra+wbm04_01min_daily_pivot_series"'])
+        self.assertIn('"zonalmean"[extract(doy FROM p_date)::integer]', runoff['view_sql'])
+
+        # each year's aggregate is explained
+        from ghaaspy.pivot import _explained_stage
+        self.assertEqual([stage for stage, _ in runoff['table_statements'] if _explained_stage(stage)],
+                         ['aggregate_1958', 'aggregate_1959', 'aggregate_1960'])
+        self.assertTrue(_explained_stage('aggregate_join'))
+
+    def test_run_imports(self):
+        class _Engine:
+            # stand in for an import engine, fails on gpkg table 'b'
+            def import_table(self, catalog, pg_table_name, gpkg_table):
+                if gpkg_table == 'b':
+                    return 3, 'oops', None
+                return 0, '', 10
+
+        class _Catalog:
+            gpkg = Path('my.gpkg')
+
+        pg_tables = ['s."a"', 's."b"', 's."c"']
+        tasks = [(_Catalog, pg, gt) for pg, gt in zip(pg_tables, ['a', 'b', 'c'])]
+
+        results = run_imports(_Engine(), tasks, jobs=2)
+        self.assertEqual([r.pg_table for r in results], pg_tables, "results should keep table order")
+        # engines which don't time their stages report the whole load as one
+        self.assertEqual(list(results[0].stages), ['load'])
+        report = import_report(results)
+        self.assertEqual(list(report['s']), ['a', 'b', 'c'])
+        self.assertFalse(report['s']['b']['ok'])
+        self.assertEqual([r.ok for r in results], [True, False, True])
+        self.assertEqual(results[1].returncode, 3)
+        self.assertEqual(results[1].stderr, 'oops')
+        self.assertEqual(results[0].rows, 10)
+
+    def test_vectortranslate_engine(self):
+        # GDAL's python bindings stand-in, recording options and datasets opened
+        gdal = mock.MagicMock()
+        gdal.VectorTranslateOptions.side_effect = lambda **kwargs: kwargs
+        gdal.OpenEx.side_effect = lambda path, flags: mock.MagicMock(name=path)
+        with mock.patch.dict('sys.modules', {'osgeo': mock.MagicMock(gdal=gdal), 'osgeo.gdal': gdal}):
+            engine = VectorTranslateEngine('dbname=x', unlogged=True)
+
+        options = engine._options('brazil."runoff_country_annual_terra+wbm04_01min"', 'Runoff_Country_annual')
+        self.assertEqual((options['accessMode'], options['layerName'], options['layers']),
+                         ('overwrite', 'brazil.runoff_country_annual_terra+wbm04_01min', ['Runoff_Country_annual']))
+        self.assertEqual(options['layerCreationOptions'], ['OVERWRITE=YES', 'UNLOGGED=YES', 'SPATIAL_INDEX=NONE'])
+        engine.update = True
+        self.assertEqual(engine._options('brazil.t', 't')['accessMode'], 'append')
+        self.assertNotIn('layerCreationOptions', engine._options('brazil.t', 't'))
+
+        catalog = mock.MagicMock(gpkg=Path('brazil_terra+wbm04_01min.gpkg'))
+        pg_opens = lambda: [c for c in gdal.OpenEx.call_args_list if c[0][0].startswith('PG:')]
+        with engine:
+            gdal.VectorTranslate.return_value = 1
+            self.assertEqual(engine.import_table(catalog, 'brazil.t', 't')[0], 0)
+            self.assertEqual(engine.import_table(catalog, 'brazil.t', 't')[0], 0)
+            self.assertEqual(len(pg_opens()), 1)
+
+            # the postgres dataset of a failed load isn't reused
+            gdal.VectorTranslate.return_value = None
+            self.assertEqual(engine.import_table(catalog, 'brazil.t', 't')[0], 1)
+            gdal.VectorTranslate.return_value = 1
+            self.assertEqual(engine.import_table(catalog, 'brazil.t', 't')[0], 0)
+            self.assertEqual(len(pg_opens()), 2)
+        self.assertEqual(gdal.OpenEx.call_count, 3)
+
+    def test_gpkg_catalog(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkg = Path(tmp).joinpath('Brazil_TerraClimate+WBMstableDist04_01min.gpkg')
+            _make_gpkg(gpkg)
+
+            with GpkgCatalog(gpkg) as catalog:
+                self.assertEqual(catalog.tables, ['Discharge_Confluence_annual', 'hydroSTN30_Confluence'])
+                self.assertFalse(catalog.has_geometry('Discharge_Confluence_annual'))
+                self.assertTrue(catalog.has_geometry('hydroSTN30_Confluence'))
+                self.assertEqual(catalog.table('hydroSTN30_Confluence').geometry_type, 'MULTIPOINT')
+                self.assertEqual(catalog.table('hydroSTN30_Confluence').extent, (-10, -5, 10, 5))
+                self.assertEqual(catalog.row_count('Discharge_Confluence_annual'), 3)
+                self.assertEqual(catalog.max_rowid('hydroSTN30_Confluence'), 0)
+                self.assertEqual([c[1] for c in catalog.columns('Discharge_Confluence_annual')],
+                                 ['fid', 'SampleID', 'Year', 'Discharge'])
+
+            meta = extract_gpkg_meta(gpkg)
+            self.assertEqual(meta['model_short'], 'terra+wbm04')
+            self.assertEqual(meta['tables'], ['Discharge_Confluence_annual', 'hydroSTN30_Confluence'])
+            self.assertEqual(gpkg_import_tables(meta), (['"brazil"."discharge_confluence_annual_terra+wbm04_01min"'],
+                                                        ['Discharge_Confluence_annual']))
+            self.assertIsNone(meta['catalog'])
+
+            with GpkgCatalog(gpkg) as catalog:
+                meta = extract_gpkg_meta(gpkg, catalog=catalog)
+                self.assertIs(meta['catalog'], catalog)
+            self.assertEqual(meta['tables'], ['Discharge_Confluence_annual', 'hydroSTN30_Confluence'])
+
+    def test_embedded_geography_dedup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkgs = [Path(tmp).joinpath('Brazil_TerraClimate+{}_01min.gpkg'.format(m))
+                     for m in ('WBMstableDist04', 'WBMstableDist19', 'WBMstablePrist')]
+            for gpkg in gpkgs:
+                _make_gpkg(gpkg)
+            conn = sqlite3.connect(gpkgs[2])
+            conn.execute('INSERT INTO "hydroSTN30_Confluence" VALUES (1, x\'00\', 7)')
+            conn.commit()
+            conn.close()
+
+            tasks, gpkg_metas = collect_import_tasks(gpkgs, include_embedded_geography_tables=True)
+            geography = [t for t in tasks if t[2] == 'hydroSTN30_Confluence']
+            self.assertEqual(len(tasks), 4)
+            self.assertEqual([(t[0].gpkg, t[1]) for t in geography], [(gpkgs[0], 'brazil."hydrostn30_confluence_01min"')])
+            self.assertTrue(is_embedded_geography(gpkg_metas[gpkgs[0]], 'hydroSTN30_Confluence'))
+            self.assertFalse(is_embedded_geography(gpkg_metas[gpkgs[0]], 'Discharge_Confluence_annual'))
+
+            digests = [m['catalog'].content_digest('hydroSTN30_Confluence') for m in gpkg_metas.values()]
+            self.assertEqual(digests[0], digests[1])
+            self.assertNotEqual(digests[0], digests[2])
+            for gpkg_meta in gpkg_metas.values():
+                gpkg_meta['catalog'].close()
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_geography_conflict(self):
+        from ghaaspy.manifest import fetch_manifest
+        from ghaaspy.postgres import PostgresDB
+
+        schema = 'ghaaspy-test'
+        manifest_table = '"{}".gpkg_import_manifest'.format(schema)
+        geography = '{}."hydrostn30_confluence_01min"'.format(schema)
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"; CREATE TABLE "{0}".{1} (id int)'.format(
+                schema, '"hydrostn30_confluence_01min"'))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkgs = [Path(tmp).joinpath(schema, '{}_TerraClimate+{}_01min.gpkg'.format(schema, m))
+                     for m in ('WBMstableDist04', 'WBMstableDist19')]
+            for gpkg in gpkgs:
+                gpkg.parent.mkdir(exist_ok=True)
+                _make_gpkg(gpkg)
+            conn = sqlite3.connect(gpkgs[1])
+            conn.execute('INSERT INTO "hydroSTN30_Confluence" VALUES (1, x\'00\', 7)')
+            conn.commit()
+            conn.close()
+
+            def run(gpkg):
+                with mock.patch.dict(IMPORT_ENGINES, {'fake': FakeEngine}):
+                    results, _ = import_gpkgs(TEST_PG, [gpkg], include_embedded_geography_tables=True, engine='fake',
+                                              manifest_table=manifest_table, throughput_file=None)
+                return {r.pg_table: r for r in results}
+
+            with GpkgCatalog(gpkgs[0]) as catalog:
+                digest = catalog.content_digest('hydroSTN30_Confluence')
+
+            # the first copy is loaded and recorded with the rows counted by its digest
+            self.assertTrue(run(gpkgs[0])[geography].ok)
+            with db.connection() as conn:
+                entry = fetch_manifest(conn, [geography], manifest_table=manifest_table)[geography]
+            self.assertEqual((entry['row_count'], entry['content_digest'], entry['content_hash']), (0, digest, digest))
+
+            # a differing copy fails without touching the manifest, an identical one is skipped
+            conflict = run(gpkgs[1])[geography]
+            self.assertEqual((conflict.ok, conflict.skipped), (False, True))
+            self.assertIn(str(gpkgs[0]), conflict.stderr)
+            identical = run(gpkgs[0])[geography]
+            self.assertEqual((identical.ok, identical.skipped), (True, True))
+            with db.connection() as conn:
+                self.assertEqual(fetch_manifest(conn, [geography], manifest_table=manifest_table)[geography]['content_digest'],
+                                 digest)
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_overwrite_geometry_tiers(self):
+        from psycopg2 import Error as PostgresError
+        from ghaaspy.postgres import PostgresDB
+
+        schema = 'ghaaspy-test'
+        geography = '{}."hydrostn30_confluence_01min"'.format(schema)
+        quoted = '"{}"."hydrostn30_confluence_01min"'.format(schema)
+        manifest_table = '"{}".gpkg_import_manifest'.format(schema)
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        # a stand-in for the tiers view of create_geometry_tiers, which needs PostGIS
+        with db.transaction() as cur:
+            cur.execute("""DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}";
+                CREATE TABLE {1} (id int);
+                CREATE MATERIALIZED VIEW "{0}".hydrostn30_confluence_01min_tiers AS SELECT id FROM {1}""".format(
+                schema, quoted))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        class _OverwriteEngine(FakeEngine):
+            # drops and creates tables as ogr2ogr -lco OVERWRITE=YES does
+            def import_table(self, catalog, pg_table_name, gpkg_table):
+                with db.transaction() as cur:
+                    cur.execute('DROP TABLE IF EXISTS "{0}"."{1}" CASCADE; CREATE TABLE "{0}"."{1}" (id int)'.format(
+                        *split_pg_tablename(pg_table_name)))
+                return super().import_table(catalog, pg_table_name, gpkg_table)
+
+        def run(gpkg, prepare):
+            with mock.patch.dict(IMPORT_ENGINES, {'fake': _OverwriteEngine}), \
+                    mock.patch('ghaaspy.gpkg.prepare_geometry_tiers', side_effect=prepare) as prepared:
+                results, _ = import_gpkgs(TEST_PG, [gpkg], include_embedded_geography_tables=True, engine='fake',
+                                          manifest_table=manifest_table, throughput_file=None)
+            return {r.pg_table: r for r in results}, prepared
+
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkg = Path(tmp).joinpath(schema, '{}_TerraClimate+WBMstableDist04_01min.gpkg'.format(schema))
+            gpkg.parent.mkdir()
+            _make_gpkg(gpkg)
+
+            # the tiers dropped with the geography are prepared again
+            results, prepared = run(gpkg, lambda db, targets: [])
+            self.assertTrue(results[geography].ok)
+            prepared.assert_called_once_with(mock.ANY, [(schema, 'hydrostn30_confluence_01min')])
+
+            # tiers which can't be prepared again fail the table
+            with db.transaction() as cur:
+                cur.execute("""DELETE FROM {0};
+                    CREATE MATERIALIZED VIEW "{1}".hydrostn30_confluence_01min_tiers AS SELECT id FROM {2}""".format(
+                    manifest_table, schema, quoted))
+
+            def fail(db, targets):
+                raise PostgresError('no geometry column')
+            results, _ = run(gpkg, fail)
+            self.assertFalse(results[geography].ok)
+            self.assertIn('no geometry column', results[geography].stderr)
+
+    def test_benchmark_pivot_layouts(self):
+        from ghaaspy.pivot import _benchmark_group
+        from ghaaspy.postgres import PostgresDB
+
+        schema = 'ghaaspy-test'
+        tables = ['"{}"."discharge_confluence_{}_terra+wbm04_01min"'.format(schema, t) for t in ('annual', 'monthly')]
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute("""DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}";
+                CREATE TABLE {1} (ogc_fid serial, sampleid int, year int, discharge float);
+                CREATE TABLE {2} (ogc_fid serial, sampleid int, year int, month int, discharge float);
+                CREATE TABLE "{0}".hydrostn30_confluence_01min (id int, geom text);
+                INSERT INTO {1} (sampleid, year, discharge)
+                    SELECT s, y, s * y FROM generate_series(1, 3) s, generate_series(1990, 1994) y;
+                INSERT INTO {2} (sampleid, year, month, discharge)
+                    SELECT s, y, m, s * y FROM generate_series(1, 3) s, generate_series(1990, 1994) y,
+                    generate_series(1, 12) m""".format(schema, *tables))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        with db.connection() as conn:
+            year_spans = detect_year_spans(conn, tables)
+        results = benchmark_pivot_layouts(db, tables, layouts=('crosstab', 'array'), repeat=1, year_spans=year_spans)
+        self.assertEqual([(r['layout'], r['year_start'], r['year_end'], r['error']) for r in results],
+                         [('crosstab', 1990, 1994, None), ('array', 1990, 1994, None)])
+        self.assertTrue(all(r['table_bytes'] > 0 and r['view_seconds'] is not None for r in results))
+
+        # the array layout keeps its own first year
+        group = build_pivot_groups(tables, layout='array', year_spans=year_spans)[0]
+        with db.transaction() as cur:
+            for _, statement in group['table_statements']:
+                cur.execute(statement)
+            cur.execute('SELECT array_lower(discharge, 1), array_upper(discharge, 1), (discharge[1991]).annual '
+                        'FROM "discharge_confluence_terra+wbm04_01min_pivot" WHERE sampleid = 2')
+            self.assertEqual(cur.fetchone(), (1990, 1994, 2 * 1991))
+            cur.execute('RESET search_path; DROP TABLE "{}"."discharge_confluence_terra+wbm04_01min_pivot"'.format(schema))
+
+        # a failing group is reported, and like the others leaves nothing behind
+        group = build_pivot_groups(tables, layout='array', year_spans=year_spans)[0]
+        group['view_sql'] = 'SELECT * FROM missing_table'
+        bench = _benchmark_group(db, group, repeat=1)
+        self.assertIn('missing_table', bench['error'])
+        self.assertIsNone(bench['view_seconds'])
+        with db.transaction() as cur:
+            cur.execute('SELECT to_regclass(%s)', ('"{}"."discharge_confluence_terra+wbm04_01min_pivot"'.format(schema),))
+            self.assertIsNone(cur.fetchone()[0])
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_daily_pivot_days(self):
+        from ghaaspy.postgres import PostgresDB
+
+        schema = 'ghaaspy-test'
+        daily_table = 'discharge_confluence_daily_terra+wbm04_01min'
+        pivot_table = 'discharge_confluence_terra+wbm04_01min_daily_pivot'
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        # a 365 day calendar in leap year 1960, sampleid 2 lacks January 2
+        with db.transaction() as cur:
+            cur.execute("""DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}";
+                CREATE TABLE "{0}"."{1}" (sampleid int, year int, month int, day int, discharge float);
+                INSERT INTO "{0}"."{1}"
+                    SELECT s, 1960, extract(month FROM d), extract(day FROM d), s * 1000 + extract(doy FROM d)
+                    FROM generate_series(1, 2) s, generate_series('1960-01-01'::date, '1960-12-31', '1 day') d
+                    WHERE to_char(d, 'MM-DD') <> '02-29' AND (s, d) <> (2, '1960-01-02')""".format(schema, daily_table))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        with db.transaction() as cur:
+            for _, statement in daily_pivot_statements('group1', schema, 'discharge', daily_table, pivot_table,
+                                                       year_start=1960, year_end=1960):
+                cur.execute(statement)
+            cur.execute(create_daily_accessors('group1', schema, 'discharge', pivot_table)[0])
+            cur.execute('SELECT array_length(discharge, 1), discharge[2], discharge[60], discharge[366] '
+                        'FROM "{}" ORDER BY sampleid'.format(pivot_table))
+            self.assertEqual(cur.fetchall(), [(366, 1002.0, None, 1366.0), (366, None, None, 2366.0)])
+            # days after a missing one keep their date
+            cur.execute('SELECT * FROM "{}_on"(\'1960-03-01\')'.format(pivot_table))
+            self.assertEqual(cur.fetchall(), [(1, 1061.0), (2, 2061.0)])
+            cur.execute('RESET search_path')
+
+    def drop_schema(self, db, schema):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+
+    def test_find_gpkgs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            a = root.joinpath('Brazil', 'ModelA', 'Brazil_TerraClimate+WBMstableDist04_01min.gpkg')
+            b = root.joinpath('SE-Asia', 'ModelB', 'SE-Asia_TerraClimate+WBMstablePrist_01min.gpkg')
+            for g in (a, b):
+                g.parent.mkdir(parents=True)
+                g.touch()
+            root.joinpath('Brazil', 'notes.txt').touch()
+
+            self.assertEqual(find_gpkgs([root]), [sanitize_path(a), sanitize_path(b)])
+            self.assertEqual(find_gpkgs([str(root.joinpath('*', '*', 'SE-Asia_*.gpkg'))]), [sanitize_path(b)])
+            self.assertEqual(find_gpkgs([a, root.joinpath('Brazil')]), [sanitize_path(a)], "duplicates should be removed")
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import os
+import unittest
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from ghaaspy.gpkg import GpkgCatalog
+from ghaaspy.manifest import *
+from ghaaspy.postgres import PostgresDB
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+
+class TestManifest(unittest.TestCase):
+
+    def test_table_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkg = Path(tmp) / 'brazil_terra+wbm04_01min.gpkg'
+            conn = sqlite3.connect(gpkg)
+            conn.execute('CREATE TABLE runoff (sampleid INTEGER, year INTEGER, value REAL, name TEXT)')
+            conn.executemany('INSERT INTO runoff VALUES (?, ?, ?, ?)',
+                             [(1, 1990, 1.5, 'a'), (2, 1990, 2.5, 'bb'), (1, 1991, None, 'a')])
+            conn.commit()
+
+            with GpkgCatalog(gpkg) as catalog:
+                stats = table_stats(catalog, 'runoff')
+            self.assertEqual((stats['row_count'], stats['year_min'], stats['year_max']), (3, 1990, 1991))
+
+            # values swapped between rows keep every column total the same
+            conn.execute('UPDATE runoff SET value = 4.0 - value WHERE year = 1990')
+            conn.commit()
+            with GpkgCatalog(gpkg) as catalog:
+                self.assertEqual(table_stats(catalog, 'runoff')['row_count'], 3)
+                self.assertNotEqual(table_stats(catalog, 'runoff')['content_hash'], stats['content_hash'])
+            conn.close()
+
+    def drop_schema(self, db, schema):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_fetch_manifest(self):
+        schema = 'ghaaspy-test'
+        manifest_table = '"{}".gpkg_import_manifest'.format(schema)
+        loaded = '"{}"."runoff_country_annual_terra+wbm04_01min"'.format(schema)
+        dropped = '"{}"."runoff_country_monthly_terra+wbm04_01min"'.format(schema)
+
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"; CREATE TABLE {1} (sampleid int)'.format(
+                schema, loaded))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        with db.connection() as conn:
+            ensure_manifest(conn, manifest_table=manifest_table)
+            entry = dict(gpkg_path='brazil_terra+wbm04_01min.gpkg', gpkg_table='runoff', gpkg_mtime=0.0, gpkg_size=1,
+                         row_count=3, content_hash='hash', content_digest=None, year_min=1990, year_max=1991)
+            record_manifest(conn, [dict(entry, pg_table=loaded), dict(entry, pg_table=dropped)],
+                            manifest_table=manifest_table)
+
+            # hyphenated schema, table gone from the database
+            self.assertEqual(list(fetch_manifest(conn, [loaded, dropped], manifest_table=manifest_table)), [loaded])
+            # unquoted names are neither downcased nor parsed as identifiers
+            mixed_case = '"{}"."Runoff_country_annual"'.format(schema)
+            with conn.cursor() as cur:
+                cur.execute('CREATE TABLE {} (sampleid int)'.format(mixed_case))
+            conn.commit()
+            unquoted = mixed_case.replace('"', '')
+            record_manifest(conn, [dict(entry, pg_table=unquoted)], manifest_table=manifest_table)
+            self.assertEqual(fetch_manifest(conn, [unquoted], manifest_table=manifest_table)[unquoted]['row_count'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
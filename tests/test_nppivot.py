@@ -0,0 +1,136 @@
+import unittest
+import sqlite3
+import struct
+import tempfile
+from pathlib import Path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ghaaspy.nppivot import *
+
+# group1 composite: float8 annual, float8[] monthly
+FIELDS = [('annual', 701, None, '>f8'), ('monthly', 1022, 701, '>f8')]
+
+
+def _make_output(path):
+    """Annual and monthly tables of two sampleids: sampleid 2 lacks 1959, sampleid 1 has a NULL and a missing month"""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE "Discharge_Confluence_annual" (fid INTEGER PRIMARY KEY, "SampleID" INTEGER, "Year" MEDIUMINT,
+                                                    "Discharge" REAL);
+        CREATE TABLE "Discharge_Confluence_monthly" (fid INTEGER PRIMARY KEY, "SampleID" INTEGER, "Year" MEDIUMINT,
+                                                     "Month" MEDIUMINT, "Discharge" REAL);
+        INSERT INTO "Discharge_Confluence_annual" ("SampleID", "Year", "Discharge")
+            VALUES (1, 1958, 0.5), (1, 1959, NULL), (2, 1958, 2.5), (2, 1959, 3.5);
+    """)
+    rows = [(s, y, m, s * 100 + (y - 1958) * 12 + m) for s in (1, 2) for y in (1958, 1959) for m in range(1, 13)
+            if not (s == 2 and y == 1959) and not (s == 1 and y == 1959 and m == 12)]
+    conn.executemany('INSERT INTO "Discharge_Confluence_monthly" ("SampleID", "Year", "Month", "Discharge") '
+                     'VALUES (?, ?, ?, ?)', rows)
+    conn.execute('UPDATE "Discharge_Confluence_monthly" SET "Discharge" = NULL WHERE "SampleID" = 1 AND "Year" = 1958 '
+                 'AND "Month" = 3')
+    conn.commit()
+    conn.close()
+
+
+def _decode_row(buf, offset, years):
+    """Decode a binary COPY crosstab row of FIELDS composites into (sampleid, [(annual, [monthly]) or None])"""
+    nfields, _, sampleid = struct.unpack_from('>hiq', buf, offset)
+    assert nfields == 1 + years
+    offset += 14
+    slots = []
+    for _ in range(years):
+        (length,) = struct.unpack_from('>i', buf, offset)
+        offset += 4
+        if length < 0:
+            slots.append(None)
+            continue
+        end = offset + length
+        offset += 4
+        values = []
+        for _, _, elem_oid, _ in FIELDS:
+            _, flen = struct.unpack_from('>ii', buf, offset)
+            offset += 8
+            if flen < 0:
+                values.append(None)
+            elif elem_oid is None:
+                values.append(struct.unpack_from('>d', buf, offset)[0])
+                offset += flen
+            else:
+                offset += 20
+                elements = []
+                for _ in range(12):
+                    (elen,) = struct.unpack_from('>i', buf, offset)
+                    offset += 4
+                    elements.append(None if elen < 0 else struct.unpack_from('>d', buf, offset)[0])
+                    offset += max(elen, 0)
+                values.append(elements)
+        assert offset == end
+        slots.append(tuple(values))
+    return sampleid, slots, offset
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestNumpyPivot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.gpkg = Path(self.tmp.name) / 'Brazil_TerraClimate+WBMstableDist04_01min.gpkg'
+        _make_output(self.gpkg)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_temporal_group(self):
+        data = read_temporal_group(self.gpkg, 'Discharge_Confluence_annual', 'Discharge_Confluence_monthly',
+                                   ['discharge'])
+        self.assertEqual((data['year_start'], data['year_end']), (1958, 1959))
+        self.assertEqual(list(data['sampleids']), [1, 2])
+        self.assertEqual(data['present'].tolist(), [[True, True], [True, False]])
+        self.assertEqual(data['monthly'].shape, (2, 2, 12, 1))
+        self.assertTrue(data['annual_null'][0, 1, 0])
+        self.assertTrue(data['monthly_null'][0, 0, 2, 0])
+        self.assertTrue(data['monthly_null'][0, 1, 11, 0])
+        self.assertEqual(data['monthly'][1, 0, 4, 0], 205)
+
+        # rows outside the requested years are left out
+        data = read_temporal_group(self.gpkg, 'Discharge_Confluence_annual', 'Discharge_Confluence_monthly',
+                                   ['discharge'], year_start=1959, year_end=1959)
+        self.assertEqual(list(data['sampleids']), [1])
+
+    def test_encode_pivot_rows(self):
+        data = read_temporal_group(self.gpkg, 'Discharge_Confluence_annual', 'Discharge_Confluence_monthly',
+                                   ['discharge'])
+        buf = b''.join(encode_pivot_rows(data, FIELDS, ['discharge'], chunk_rows=1))
+
+        sampleid, slots, offset = _decode_row(buf, 0, 2)
+        self.assertEqual(sampleid, 1)
+        self.assertEqual(slots[0][0], 0.5)
+        self.assertEqual(slots[0][1][:4], [101.0, 102.0, None, 104.0])
+        self.assertEqual(slots[1][0], None)
+        self.assertEqual(slots[1][1][-1], None)
+
+        sampleid, slots, offset = _decode_row(buf, offset, 2)
+        self.assertEqual((sampleid, slots[0][0], slots[1]), (2, 2.5, None))
+        self.assertEqual(offset, len(buf))
+
+        stream = ChunkStream(encode_pivot_rows(data, FIELDS, ['discharge'], layout='array', type_oid=1))
+        copied = b''.join(iter(lambda: stream.read(7), b''))
+        self.assertTrue(copied.startswith(COPY_HEADER) and copied.endswith(COPY_TRAILER))
+        # the array lower bound is the first year, after the row's field count, sampleid and array header
+        lbound = len(COPY_HEADER) + 2 + 4 + 8 + 4 * 5
+        self.assertEqual(struct.unpack('>i', copied[lbound:lbound + 4])[0], data['year_start'])
+
+    def test_gpkg_pivot_groups(self):
+        groups = gpkg_pivot_groups([self.gpkg], layout='array')
+        self.assertEqual(len(groups), 1)
+        self.assertEqual((groups[0]['schema'], groups[0]['pivot_table'], groups[0]['group'], groups[0]['monthly']),
+                         ('brazil', 'discharge_confluence_terra+wbm04_01min_pivot', 'group1',
+                          'Discharge_Confluence_monthly'))
+
+
+if __name__ == '__main__':
+    unittest.main()
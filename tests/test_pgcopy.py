@@ -0,0 +1,112 @@
+import os
+import unittest
+import sqlite3
+import struct
+
+from ghaaspy.pgcopy import *
+from ghaaspy.postgres import PostgresDB
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+
+class TestPgcopy(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.executescript("""
+            CREATE TABLE "Runoff_Basin_annual" (fid INTEGER PRIMARY KEY, "SampleID" INTEGER, "Year" MEDIUMINT,
+                                                "ZonalMean" REAL, "Note" TEXT(20));
+            CREATE TABLE "hydroSTN30_Basin" (fid INTEGER PRIMARY KEY, geom POLYGON, "ID" INTEGER);
+            INSERT INTO "Runoff_Basin_annual" VALUES (1, 10, 1958, 0.5, NULL);
+            INSERT INTO "Runoff_Basin_annual" VALUES (2, 10, 1959, 1.5, 'x');
+        """)
+
+    def test_gpkg_copy_columns(self):
+        table_info = self.conn.execute('PRAGMA table_info("Runoff_Basin_annual")').fetchall()
+        self.assertEqual(gpkg_copy_columns(table_info), [
+            ('fid', 'ogc_fid', 'integer', 'i'),
+            ('SampleID', 'sampleid', 'bigint', 'q'),
+            ('Year', 'year', 'integer', 'i'),
+            ('ZonalMean', 'zonalmean', 'double precision', 'd'),
+            ('Note', 'note', 'character varying', None),
+        ])
+        table_info = self.conn.execute('PRAGMA table_info("hydroSTN30_Basin")').fetchall()
+        self.assertIsNone(gpkg_copy_columns(table_info), "geometry column type is not supported")
+
+    def test_copy_binary_stream(self):
+        cursor = self.conn.execute('SELECT fid, "ZonalMean", "Note" FROM "Runoff_Basin_annual" ORDER BY fid')
+        stream = CopyBinaryStream(cursor, ['i', 'd', None], batch_size=1)
+
+        data = b''
+        chunk = stream.read(7)
+        while chunk:
+            data += chunk
+            chunk = stream.read(7)
+
+        row1 = struct.pack('>hiiid', 3, 4, 1, 8, 0.5) + struct.pack('>i', -1)
+        row2 = struct.pack('>hiiid', 3, 4, 2, 8, 1.5) + struct.pack('>i', 1) + b'x'
+        self.assertEqual(data, COPY_HEADER + row1 + row2 + COPY_TRAILER)
+        self.assertEqual(stream.rows, 2)
+
+    def test_year_partition_name(self):
+        self.assertEqual(year_partition_name('discharge_monthly', 1990), 'discharge_monthly_y1990')
+        self.assertEqual(year_partition_name('discharge_monthly', None), 'discharge_monthly_ydefault')
+
+        # stays unique and within the 63 character identifier limit
+        long_table = 'discharge_confluence_monthly_terraclimate+wbmstabledist04_01min'
+        names = {year_partition_name(long_table, y) for y in range(1990, 2000)}
+        self.assertEqual(len(names), 10)
+        self.assertTrue(all(len(n) <= 63 for n in names))
+        self.assertTrue(all(n.endswith('_y199{}'.format(i)) for i, n in enumerate(sorted(names))))
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_year_partitions(self):
+        schema = 'ghaaspy-test'
+        pg_table = '"{}"."runoff_basin_monthly_terra+wbm04_01min"'.format(schema)
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"'.format(schema))
+        self.addCleanup(self.drop_schema, db, schema)
+
+        self.conn.executemany('INSERT INTO "Runoff_Basin_annual" ("SampleID", "Year", "ZonalMean") VALUES (?, ?, ?)',
+                              [(10, y, 1.0) for y in (1961, 1962, 1965)])
+        columns = gpkg_copy_columns(self.conn.execute('PRAGMA table_info("Runoff_Basin_annual")').fetchall())
+        with db.connection() as conn:
+            # a year span given by the caller is used as is, without reading the geopackage
+            rows, _ = copy_gpkg_table(conn, self.conn, 'Runoff_Basin_annual', pg_table, columns, partition_years=5,
+                                      years=(1958, 1962))
+            self.assertEqual(rows, 5)
+            with conn.cursor() as cur:
+                cur.execute("""SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), count(t.*)
+                               FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                               LEFT JOIN "ghaaspy-test"."runoff_basin_monthly_terra+wbm04_01min" t ON t.tableoid = c.oid
+                               WHERE i.inhparent = %s::regclass GROUP BY 1, 2 ORDER BY 1""", (pg_table,))
+                self.assertEqual(cur.fetchall(), [
+                    ('runoff_basin_monthly_terra+wbm04_01min_y1955', "FOR VALUES FROM (1955) TO (1960)", 2),
+                    ('runoff_basin_monthly_terra+wbm04_01min_y1960', "FOR VALUES FROM (1960) TO (1965)", 2),
+                    ('runoff_basin_monthly_terra+wbm04_01min_ydefault', "DEFAULT", 1)])
+
+                cur.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'runoff_basin_monthly_terra+wbm04_01min'")
+                self.assertEqual(sorted(i[0].split(' USING ')[1] for i in cur.fetchall()),
+                                 ['btree (ogc_fid, year)', 'btree (sampleid, year)'])
+
+            # reloading adds partitions for new years, read from the geopackage
+            copy_gpkg_table(conn, self.conn, 'Runoff_Basin_annual', pg_table, columns, update=True, partition_years=5)
+            with conn.cursor() as cur:
+                cur.execute('SELECT count(*) FROM "ghaaspy-test"."runoff_basin_monthly_terra+wbm04_01min_ydefault"')
+                self.assertEqual(cur.fetchone()[0], 0)
+                cur.execute('SELECT count(*) FROM "ghaaspy-test"."runoff_basin_monthly_terra+wbm04_01min_y1965"')
+                self.assertEqual(cur.fetchone()[0], 1)
+                # ogc_fid carries on from the loaded rows
+                cur.execute('INSERT INTO {} (sampleid, year) VALUES (11, 1965) RETURNING ogc_fid'.format(pg_table))
+                self.assertEqual(cur.fetchone()[0], 6)
+            conn.commit()
+
+    def drop_schema(self, db, schema):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(schema))
+
+
+if __name__ == '__main__':
+    unittest.main()
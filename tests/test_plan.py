@@ -0,0 +1,67 @@
+import unittest
+import sqlite3
+import tempfile
+from pathlib import Path
+from threading import Thread
+from types import SimpleNamespace
+
+from ghaaspy.gpkg import GpkgCatalog
+from ghaaspy.plan import *
+
+class TestPlan(unittest.TestCase):
+
+    def test_classify_temporal(self):
+        self.assertEqual(classify_temporal('River-Mouth_BedloadFlux_daily'), 'daily')
+        self.assertEqual(classify_temporal('"brazil"."discharge_confluence_monthly_terra+wbm04_01min"'), 'monthly')
+        self.assertEqual(classify_temporal('Discharge_Confluence_annual'), 'annual')
+        self.assertIsNone(classify_temporal('hydroSTN30_Confluence'))
+
+    def test_plan_summary(self):
+        plan = [dict(rows=10, est_bytes=100, est_seconds=s) for s in (4.0, 3.0, 3.0, 2.0)]
+        summary = plan_summary(plan, jobs=2)
+        self.assertEqual(summary['tables'], 4)
+        self.assertEqual(summary['est_seconds'], 12.0)
+        # largest first over 2 workers: [4, 2] and [3, 3]
+        self.assertEqual(summary['est_wall_seconds'], 6.0)
+
+    def test_build_import_plan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gpkg = Path(tmp) / 'brazil_terra+wbm04_01min.gpkg'
+            conn = sqlite3.connect(gpkg)
+            conn.execute('CREATE TABLE Runoff_Country_annual (sampleid INTEGER, year INTEGER, value REAL)')
+            conn.executemany('INSERT INTO Runoff_Country_annual VALUES (?, ?, ?)', [(i, 1990, 1.0) for i in range(10)])
+            conn.execute('DELETE FROM Runoff_Country_annual WHERE sampleid < 4')
+            conn.commit()
+            conn.close()
+
+            pg = 'brazil."runoff_country_annual_terra+wbm04_01min"'
+            with GpkgCatalog(gpkg) as catalog:
+                tasks = [(catalog, pg, 'Runoff_Country_annual')]
+                # max rowid unless counting is asked for or the count is known
+                self.assertEqual(build_import_plan(tasks)[0]['rows'], 10)
+                self.assertEqual(catalog._row_counts, {})
+                self.assertEqual(build_import_plan(tasks, exact=True)[0]['rows'], 6)
+                self.assertEqual(build_import_plan(tasks, row_counts={pg: 7})[0]['rows'], 7)
+                self.assertEqual(build_import_plan(tasks)[0]['temporal'], 'annual')
+
+    def test_record_throughput(self):
+        plan = [dict(pg_table='t{}'.format(i), kind='attribute', est_bytes=1000) for i in range(2)]
+        results = [SimpleNamespace(pg_table='t{}'.format(i), ok=True, skipped=False, seconds=1.0) for i in range(2)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'throughput.json'
+            threads = [Thread(target=record_throughput, args=(results, plan, 'engine{}'.format(i)),
+                              kwargs=dict(path=path)) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            # no update lost, no temporary file left behind
+            history = load_throughput(path)
+            self.assertEqual(sorted(history), ['engine{}'.format(i) for i in range(8)])
+            self.assertEqual(history['engine0'], {'attribute': 1000.0})
+            self.assertEqual(sorted(p.name for p in Path(tmp).iterdir()), ['throughput.json', 'throughput.json.lock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,46 @@
 import unittest
+import threading
+from unittest import mock
 from ghaaspy.postgres import PostgresDB
 from pathlib import Path
 
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+class FakeConnection:
+    """Stand-in for a psycopg2 connection, broken connections fail any statement"""
+
+    def __init__(self, connections):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.statements = []
+        self.rollbacks = 0
+        self.info = mock.Mock(transaction_status=TRANSACTION_STATUS_IDLE)
+        connections.append(self)
+
+    def cursor(self):
+        cur = mock.MagicMock()
+        cur.__enter__.return_value = cur
+        cur.execute.side_effect = self.execute
+        return cur
+
+    def execute(self, statement):
+        if self.broken:
+            raise OperationalError('server closed the connection unexpectedly')
+        self.statements.append(statement)
+        self.info.transaction_status = TRANSACTION_STATUS_INTRANS
+
+    def get_transaction_status(self):
+        return self.info.transaction_status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
 class TestPostgres(unittest.TestCase):
 
     def test_from_pgpass(self):
@@ -31,6 +70,76 @@ class TestPostgres(unittest.TestCase):
     def test_get_gdal_string(self):
         mydb1 = PostgresDB(database='mydiddlydb', user='dvignoles', password='supersecure', host='800.888.8888', port='41968', verify=False)
         self.assertEqual(mydb1.get_gdal_string(), 'dbname=mydiddlydb host=800.888.8888 port=41968 user=dvignoles password=supersecure')
+
+    def fake_db(self, **pool_options):
+        connections = []
+        patcher = mock.patch('psycopg2.connect', lambda *args, **kwargs: FakeConnection(connections))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db = PostgresDB(database='mydb1', verify=False, **pool_options)
+        self.addCleanup(db.close)
+        return db, connections
+
+    def test_reconnect(self):
+        db, connections = self.fake_db(health_check_interval=30)
+        with db.connection() as conn:
+            first = conn
+        # returned recently, handed out again without a check
+        with db.connection() as conn:
+            self.assertIs(conn, first)
+        self.assertEqual(first.statements, ['SELECT 1'])
+
+        first.broken = True
+        db.health_check_interval = 0
+        with db.connection() as conn:
+            self.assertIsNot(conn, first)
+            self.assertEqual(conn.statements, ['SELECT 1'])
+        self.assertTrue(first.closed)
+        self.assertEqual(len(connections), 2)
+
+    def test_maxconn(self):
+        db, connections = self.fake_db(maxconn=1)
+        borrowed, release = threading.Event(), threading.Event()
+
+        def hold():
+            with db.connection():
+                borrowed.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        borrowed.wait()
+
+        waiter = threading.Thread(target=db.verify)
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+
+        release.set()
+        holder.join()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(connections), 1)
+
+    def test_rollback_on_return(self):
+        db, connections = self.fake_db()
+        with db.connection() as conn:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('INSERT INTO t VALUES (1)')
+            self.assertEqual(conn.get_transaction_status(), TRANSACTION_STATUS_INTRANS)
+
+        self.assertEqual(conn.get_transaction_status(), TRANSACTION_STATUS_IDLE)
+        self.assertEqual(conn.rollbacks, 2)
+        self.assertFalse(conn.autocommit)
+
+        # a connection failing the rollback is closed and not handed out again
+        conn.rollback = mock.Mock(side_effect=OperationalError())
+        with db.connection() as conn:
+            conn.info.transaction_status = TRANSACTION_STATUS_INTRANS
+        self.assertTrue(conn.closed)
+        with db.connection() as other:
+            self.assertIsNot(other, conn)
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
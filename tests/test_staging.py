@@ -0,0 +1,126 @@
+import os
+import unittest
+import sqlite3
+
+from ghaaspy.staging import *
+from ghaaspy.pgcopy import copy_gpkg_table, gpkg_copy_columns
+from ghaaspy.postgres import PostgresDB
+
+# gdal style connection string of a scratch database, tests needing postgres are skipped without it
+TEST_PG = os.environ.get('GHAASPY_TEST_PG')
+SCHEMA = 'ghaaspy-test'
+
+
+class TestStaging(unittest.TestCase):
+    def test_staging_tablename(self):
+        long_name = 'brazil."discharge_confluence_monthly_terraclimate+wbmstabledist04_01min_{}"'.format('x' * 40)
+        staging = staging_tablename(long_name)
+        schema, table = staging.split('.')
+
+        self.assertEqual(schema, '"brazil"')
+        self.assertTrue(table.startswith('"stg_'))
+        self.assertLessEqual(len(table.strip('"')), 63)
+        self.assertEqual(staging, staging_tablename(long_name))
+        self.assertNotEqual(staging, staging_tablename('brazil.other'))
+
+    def scratch_db(self):
+        db = PostgresDB.from_gdal_string(TEST_PG)
+        self.addCleanup(db.close)
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS "{0}" CASCADE; CREATE SCHEMA "{0}"'.format(SCHEMA))
+        self.addCleanup(self.drop_schema, db)
+        return db
+
+    def drop_schema(self, db):
+        with db.transaction() as cur:
+            cur.execute('DROP SCHEMA "{}" CASCADE'.format(SCHEMA))
+
+    def load(self, conn, pg_table, years, unlogged=False, partition_years=1):
+        gpkg = sqlite3.connect(':memory:')
+        gpkg.execute('CREATE TABLE monthly (fid INTEGER PRIMARY KEY, SampleID INTEGER, Year MEDIUMINT, Month MEDIUMINT)')
+        gpkg.executemany('INSERT INTO monthly (SampleID, Year, Month) VALUES (1, ?, 1)', [(y,) for y in years])
+        columns = gpkg_copy_columns(gpkg.execute('PRAGMA table_info(monthly)').fetchall())
+        copy_gpkg_table(conn, gpkg, 'monthly', pg_table, columns, unlogged=unlogged, partition_years=partition_years)
+
+    def relations(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("""SELECT c.relname, c.relkind, c.relpersistence FROM pg_class c
+                           JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s ORDER BY 1""", (SCHEMA,))
+            return cur.fetchall()
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_swap_partitioned(self):
+        live = '"{}"."discharge_monthly"'.format(SCHEMA)
+        staging = staging_tablename(live)
+        stg = staging.split('.')[1].strip('"')
+        db = self.scratch_db()
+
+        with db.connection() as conn:
+            self.load(conn, live, [1990])
+            self.load(conn, staging, [1990, 1991], unlogged=True)
+            self.assertIn((stg + '_y1991', 'r', 'u'), self.relations(conn))
+
+            # every partition is set logged
+            finalize_staging(conn, staging)
+            self.assertEqual({r[2] for r in self.relations(conn) if r[1] in 'rp'}, {'p'})
+
+            swap_staging(conn, staging, live)
+            self.assertEqual([r[:2] for r in self.relations(conn)], [
+                ('discharge_monthly', 'p'),
+                ('discharge_monthly_ogc_fid_seq', 'S'),
+                ('discharge_monthly_pkey', 'I'),
+                ('discharge_monthly_sampleid_year_idx', 'I'),
+                ('discharge_monthly_y1990', 'r'),
+                ('discharge_monthly_y1990_pkey', 'i'),
+                ('discharge_monthly_y1990_sampleid_year_idx', 'i'),
+                ('discharge_monthly_y1991', 'r'),
+                ('discharge_monthly_y1991_pkey', 'i'),
+                ('discharge_monthly_y1991_sampleid_year_idx', 'i'),
+                ('discharge_monthly_ydefault', 'r'),
+                ('discharge_monthly_ydefault_pkey', 'i'),
+                ('discharge_monthly_ydefault_sampleid_year_idx', 'i')])
+            with conn.cursor() as cur:
+                cur.execute('SELECT count(*) FROM "{}"."discharge_monthly_y1991"'.format(SCHEMA))
+                self.assertEqual(cur.fetchone()[0], 1)
+
+    @unittest.skipUnless(TEST_PG, "GHAASPY_TEST_PG is not set")
+    def test_swap_views(self):
+        live = '"{}"."discharge_monthly"'.format(SCHEMA)
+        staging = staging_tablename(live)
+        db = self.scratch_db()
+
+        with db.connection() as conn:
+            self.load(conn, live, [1990], partition_years=None)
+            with conn.cursor() as cur:
+                cur.execute("""SET search_path = "{}";
+                    CREATE VIEW discharge_1990 AS SELECT * FROM discharge_monthly WHERE year = 1990;
+                    CREATE MATERIALIZED VIEW discharge_years AS SELECT DISTINCT year FROM discharge_1990;
+                    CREATE UNIQUE INDEX discharge_years_idx ON discharge_years (year);
+                    RESET search_path""".format(SCHEMA))
+            conn.commit()
+            self.load(conn, staging, [1990, 1990, 1991], unlogged=True, partition_years=None)
+
+            # left unlogged, still indexed and analyzed
+            finalize_staging(conn, staging, logged=False)
+            with conn.cursor() as cur:
+                cur.execute('SELECT relpersistence, reltuples FROM pg_class WHERE oid = %s::regclass', (staging,))
+                self.assertEqual(cur.fetchone(), ('u', 3))
+
+            swap_staging(conn, staging, live)
+            self.assertEqual([r[:2] for r in self.relations(conn)], [
+                ('discharge_1990', 'v'),
+                ('discharge_monthly', 'r'),
+                ('discharge_monthly_ogc_fid_seq', 'S'),
+                ('discharge_monthly_pkey', 'i'),
+                ('discharge_years', 'm'),
+                ('discharge_years_idx', 'i')])
+            with conn.cursor() as cur:
+                # the views follow the new table
+                cur.execute('SELECT count(*) FROM "{}".discharge_1990'.format(SCHEMA))
+                self.assertEqual(cur.fetchone()[0], 2)
+                cur.execute('SELECT relpersistence FROM pg_class WHERE oid = %s::regclass', (live,))
+                self.assertEqual(cur.fetchone()[0], 'u')
+
+
+if __name__ == '__main__':
+    unittest.main()
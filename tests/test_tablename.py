@@ -0,0 +1,68 @@
+import unittest
+
+from ghaaspy.tablename import *
+
+class TestTableName(unittest.TestCase):
+
+    def test_parse(self):
+        name = TableName.parse('brazil."discharge_confluence_annual_terra+wbm04_01min"')
+        self.assertEqual((name.schema, name.table), ('brazil', 'discharge_confluence_annual_terra+wbm04_01min'))
+        self.assertEqual((name.output, name.hunit, name.temporal, name.model, name.resolution, name.kind),
+                         ('discharge', 'confluence', 'annual', 'terra+wbm04', '01min', 'model'))
+        self.assertEqual(name.key, 'discharge_confluence_terra+wbm04_01min')
+        self.assertEqual(name.group_key, 'brazil."discharge_confluence_terra+wbm04_01min"')
+
+        # geopackage table names, sediment geopackages put the unit first
+        name = TableName.parse('River-Mouth_BedloadFlux_daily')
+        self.assertEqual((name.schema, name.output, name.hunit, name.temporal, name.model),
+                         (None, 'bedloadflux', 'river-mouth', 'daily', None))
+
+        name = TableName.parse('"brazil"."hydrostn30_confluence_01min"')
+        self.assertEqual((name.kind, name.hunit, name.resolution), ('geography', 'hydrostn30_confluence', '01min'))
+        self.assertEqual([TableName.parse(t).kind for t in ('hydroSTN30_Confluence', 'FAOGAUL_Country',
+                                                            'grandv13hydrostn30_dam_01min', 'faogaul_state_01min')],
+                         ['geography'] * 4)
+
+        # told apart by structure, not by the words in the name
+        name = TableName.parse('brazil."hydrostnflux_confluence_annual_terra+wbm04_01min"')
+        self.assertEqual((name.kind, name.output, name.hunit, name.model), ('model', 'hydrostnflux', 'confluence',
+                                                                            'terra+wbm04'))
+        self.assertEqual(TableName.parse('HydroSTN30_Confluence_monthly').kind, 'model')
+
+        pivot = TableName.parse('evapotranspiration_state_terra+wbm04_01min_pivot')
+        self.assertEqual((pivot.kind, pivot.output, pivot.hunit), ('pivot', 'evapotranspiration', 'state'))
+        self.assertEqual(pivot.hunit_table(), 'faogaul_state_01min')
+        self.assertTrue(pivot.is_admin)
+        self.assertEqual(TableName.parse('discharge_reservoirdam_terra+wbm04_01min_daily_pivot').temporal, 'daily')
+
+        view = TableName.parse('"brazil"."discharge_reservoirdam_terra+wbm04_01min_1990"')
+        self.assertEqual((view.kind, view.year), ('view', 1990))
+        self.assertEqual(view.hunit_table(), 'grandv13hydrostn30_dam_01min')
+
+        long = TableName.parse('brazil."runoff_basin_terra+wbm04_01min_long"')
+        self.assertEqual((long.kind, long.output, long.hunit, long.resolution), ('long', 'runoff', 'basin', '01min'))
+
+        # unexpected names don't raise
+        self.assertEqual(TableName.parse('misc').output, 'misc')
+        self.assertIsNone(TableName.parse('misc').hunit_table())
+
+    def test_catalog(self):
+        catalog = TableCatalog(['brazil."discharge_confluence_monthly_terra+wbm04_01min"',
+                                'brazil."runoff_basin_annual_terra+wbm04_01min"',
+                                'brazil."hydrostn30_confluence_01min"',
+                                'brazil."discharge_confluence_annual_terra+wbm04_01min"',
+                                'peru."discharge_confluence_annual_terra+wbm04_01min"'])
+
+        self.assertEqual(catalog.geography(), ['brazil."hydrostn30_confluence_01min"'])
+        self.assertEqual(len(catalog.model()), 4)
+
+        # grouped regardless of order, per schema
+        groups = catalog.temporal_groups()
+        self.assertEqual(list(groups), [('brazil', 'discharge_confluence_terra+wbm04_01min'),
+                                        ('brazil', 'runoff_basin_terra+wbm04_01min'),
+                                        ('peru', 'discharge_confluence_terra+wbm04_01min')])
+        self.assertEqual(sorted(groups[('brazil', 'discharge_confluence_terra+wbm04_01min')]), ['annual', 'monthly'])
+
+
+if __name__ == '__main__':
+    unittest.main()
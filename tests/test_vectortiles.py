@@ -0,0 +1,132 @@
+import unittest
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from ghaaspy.vectortiles import *
+
+SOURCE = dict(schema='brazil', pivot_table='runoff_country_terra+wbm04_01min_pivot', output='runoff', group='group2',
+              layout='crosstab', year_start=1958, year_end=2019, hunit_table='faogaul_country_01min',
+              geom_column='wkb_geometry', srid=4326, bounds=(-74.0, -34.0, -34.8, 5.3), tiers_view=None)
+
+
+class FakeTileDB:
+    """Renders a single small feature in tile (2, 1, 1), which every tile of zoom 0 and 1 holding it renders
+    empty, as ST_AsMVTGeom does with features smaller than a tile coordinate"""
+
+    def __init__(self):
+        self.executed = []
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
+    def fetchone(self):
+        statement, params = self.executed[-1]
+        z, x, y = params['z'], params['x'], params['y']
+        holds = (x, y) == (1 >> (2 - z), 1 >> (2 - z)) if z <= 2 else (x >> (z - 2), y >> (z - 2)) == (1, 1)
+        if statement.startswith('SELECT EXISTS'):
+            return (holds,)
+        return (b'mvt' if holds and z >= 2 else None,)
+
+
+class FakeSourceCursor:
+    """Answers the catalog queries of pivot_tile_source for an array layout pivot table with the given bounds"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.statement = None
+
+    def execute(self, statement, params=None):
+        self.statement = statement
+
+    def fetchall(self):
+        return [('sampleid',), ('runoff',)]
+
+    def fetchone(self):
+        if 'array_lower' in self.statement:
+            return self.bounds
+        if 'pg_attribute' in self.statement:
+            return ('wkb_geometry',)
+        return (4326, -74.0, -34.0, -34.8, 5.3)
+
+
+class TestVectorTiles(unittest.TestCase):
+
+    def test_tiles(self):
+        self.assertEqual(lonlat_to_tile(0, 0, 0), (0, 0))
+        self.assertEqual(lonlat_to_tile(-180, 90, 3), (0, 0))
+        self.assertEqual(lonlat_to_tile(180, -90, 3), (7, 7))
+
+        # brazil is 2 by 2 tiles at zoom 3
+        self.assertEqual(tiles_in_bounds(SOURCE['bounds'], 3), [(3, 2, 3), (3, 2, 4), (3, 3, 3), (3, 3, 4)])
+        self.assertEqual(tile_children((3, 2, 3)), [(4, 4, 6), (4, 4, 7), (4, 5, 6), (4, 5, 7)])
+
+    def test_tile_sql(self):
+        sql = tile_sql(SOURCE, 1990, 5)
+        self.assertIn('("runoff_1990").monthly_zonalmax[12] AS "runoff_1990_12_zonalmax"', sql)
+        self.assertIn('ST_Transform(hstn."wkb_geometry", 3857)', sql)
+        self.assertIn('INNER JOIN faogaul_country_01min hstn', sql)
+
+        tiered = dict(SOURCE, tiers_view='faogaul_country_01min_tiers')
+        self.assertIn('ST_Transform(tiers."geom_overview", 3857)', tile_sql(tiered, 1990, 3))
+        self.assertIn('ST_Transform(hstn."wkb_geometry", 3857)', tile_sql(tiered, 1990, 10))
+
+    def test_array_tile_source(self):
+        # the years of an array layout pivot table are its array bounds
+        source = pivot_tile_source(FakeSourceCursor((1958, 2019)), 'brazil', SOURCE['pivot_table'])
+        self.assertEqual((source['layout'], source['year_start'], source['year_end']), ('array', 1958, 2019))
+        self.assertIn('("runoff"[1990]).monthly_zonalmax[12]', tile_sql(source, 1990, 5))
+
+        # arrays counted from 1 predate the year subscripts
+        with self.assertRaises(ValueError):
+            pivot_tile_source(FakeSourceCursor((1, 62)), 'brazil', SOURCE['pivot_table'])
+
+    def test_build_year_tiles(self):
+        db = FakeTileDB()
+        source = dict(SOURCE, bounds=(-170.0, -80.0, 170.0, 80.0))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'runoff_country_terra+wbm04_01min_1990.mbtiles'
+            stats = build_year_tiles(db, source, 1990, path, max_zoom=3)
+
+            # empty at zoom 0 and 1, the feature still gets its tiles further down
+            self.assertEqual(read_mbtiles_tile(path, 2, 1, 1), b'mvt')
+            self.assertEqual(read_mbtiles_tile(path, 3, 2, 2), b'mvt')
+            self.assertIsNone(read_mbtiles_tile(path, 0, 0, 0))
+            self.assertEqual(stats['tiles'], 5)
+
+        # only the children of tiles holding the feature are rendered
+        rendered = [(p['z'], p['x'], p['y']) for s, p in db.executed if p and not s.startswith('SELECT EXISTS')]
+        self.assertEqual(len(rendered), 1 + 4 + 4 + 4)
+        self.assertIn('hstn."wkb_geometry" && ST_Transform(ST_TileEnvelope', tile_exists_sql(source))
+
+    def test_mbtiles_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'runoff_country_terra+wbm04_01min_1990.mbtiles'
+            with MBTilesWriter(path) as writer:
+                writer.write_tiles([(3, 2, 3, b'tile'), (3, 3, 4, b'other')])
+                writer.write_metadata({'name': path.stem, 'minzoom': '3', 'json': {'vector_layers': []}})
+                self.assertFalse(path.exists())
+
+            self.assertEqual(read_mbtiles_tile(path, 3, 2, 3), b'tile')
+            self.assertIsNone(read_mbtiles_tile(path, 3, 2, 4))
+            conn = sqlite3.connect(path)
+            # tile rows are TMS, counted from the south
+            self.assertEqual(conn.execute('SELECT tile_row FROM tiles WHERE tile_column = 2').fetchone()[0], 4)
+            self.assertEqual(dict(conn.execute('SELECT * FROM metadata'))['json'], '{"vector_layers": []}')
+            conn.close()
+
+            # a failed regeneration leaves the previous file in place
+            with self.assertRaises(RuntimeError):
+                with MBTilesWriter(path) as writer:
+                    raise RuntimeError()
+            self.assertEqual(read_mbtiles_tile(path, 3, 2, 3), b'tile')
+            self.assertEqual(list(Path(tmp).iterdir()), [path])
+
+
+if __name__ == '__main__':
+    unittest.main()